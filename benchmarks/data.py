@@ -0,0 +1,136 @@
+"""
+生成 benchmark 使用的 sqlite 数据库
+python benchmarks/data.py bench.db --rows 1000000
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE users (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name VARCHAR(32) NOT NULL DEFAULT '',
+  note VARCHAR(234) NOT NULL DEFAULT '123',
+  score INTEGER NOT NULL DEFAULT 0,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+  deleted_at TIMESTAMP NULL,
+  updated_by VARCHAR(255) NULL,
+  created_by VARCHAR(255) NOT NULL DEFAULT ''
+);
+CREATE INDEX idx_users_name ON users (name);
+CREATE INDEX idx_users_created_at ON users (created_at);
+CREATE VIRTUAL TABLE users_fts USING fts5(note, content='users', content_rowid='id');
+CREATE TRIGGER users_fts_insert AFTER INSERT ON users BEGIN
+  INSERT INTO users_fts (rowid, note) VALUES (new.id, new.note);
+END;
+CREATE TRIGGER users_fts_delete AFTER DELETE ON users BEGIN
+  INSERT INTO users_fts (users_fts, rowid, note) VALUES ('delete', old.id, old.note);
+END;
+CREATE TRIGGER users_fts_update AFTER UPDATE OF note ON users BEGIN
+  INSERT INTO users_fts (users_fts, rowid, note) VALUES ('delete', old.id, old.note);
+  INSERT INTO users_fts (rowid, note) VALUES (new.id, new.note);
+END;
+CREATE TABLE bench_meta (rows INTEGER NOT NULL, seed INTEGER NOT NULL);
+"""
+
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet',
+         'kilo', 'lima', 'mike', 'november', 'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango')
+START = datetime.datetime(2020, 1, 1)
+# 生成的 created_at 的范围 秒
+SPAN = 3 * 365 * 24 * 3600
+
+
+def _rows(count: int, seed: int):
+    rand = random.Random(seed)
+    for i in range(count):
+        created_at = START + datetime.timedelta(seconds=rand.randrange(SPAN))
+        yield (
+            'user{}'.format(rand.randrange(count // 10 + 1)),
+            ' '.join(rand.choice(WORDS) for _ in range(8)),
+            rand.randrange(1000),
+            created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'bench',
+        )
+
+
+def existing_rows(path: str, seed: int = 0) -> int:
+    """
+    已经生成的数据库的行数
+    :param path:
+    :param seed:
+    :return: 不存在或者 seed 不同时返回 None
+    """
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute('SELECT rows, seed FROM bench_meta').fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        conn.close()
+    if row is None or row[1] != seed:
+        return None
+    return row[0]
+
+
+def generate(path: str, rows: int, seed: int = 0, batch: int = 10000):
+    """
+    生成数据库 已经存在时覆盖
+    同样的 rows 和 seed 生成同样的数据 按 batch 分批写入 内存占用和 rows 无关
+    :param path:
+    :param rows:
+    :param seed:
+    :param batch:
+    :return:
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript('PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;')
+        conn.executescript(SCHEMA)
+        sql = 'INSERT INTO users (name, note, score, created_at, updated_at, created_by) VALUES (?, ?, ?, ?, ?, ?)'
+        data = _rows(rows, seed)
+        while True:
+            chunk = [row for _, row in zip(range(batch), data)]
+            if not chunk:
+                break
+            conn.executemany(sql, chunk)
+        conn.execute('INSERT INTO bench_meta (rows, seed) VALUES (?, ?)', (rows, seed))
+        conn.commit()
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+
+
+def ensure(path: str, rows: int, seed: int = 0):
+    """
+    数据库不存在或者行数不同时重新生成
+    :param path:
+    :param rows:
+    :param seed:
+    :return:
+    """
+    if existing_rows(path, seed) != rows:
+        generate(path, rows, seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    generate(args.path, args.rows, args.seed)
+    print('{} rows in {:.1f}s'.format(args.rows, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+基于 SqliteDB 和 flask 测试客户端的性能测试
+python benchmarks/run.py --rows 100000 --output result.json --baseline benchmarks/baseline.json
+结果比基线慢超过 tolerance 时返回 1
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask
+import sqlalchemy
+from sqlalchemy.sql import select
+import easyapi
+from easyapi.sql import search_sql
+from easyapi_tools.util import type_to_json
+from data import ensure, START, SPAN
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PER_PAGE = 20
+
+CASES = []
+
+
+def case(name: str):
+    """
+    注册一个测试 被装饰的函数接收 Env 返回不带参数的操作
+    :param name:
+    :return:
+    """
+
+    def decorator(func):
+        CASES.append((name, func))
+        return func
+
+    return decorator
+
+
+class Env:
+    """
+    测试用的 db dao controller 和 flask 客户端
+    """
+
+    def __init__(self, path: str, rows: int, seed: int):
+        self.rows = rows
+        self.rand = random.Random(seed)
+        # 只测库本身的开销 不等待磁盘
+        self.db = easyapi.SqliteDB(path, pragmas={'synchronous': 'OFF'})
+        self.db.connect()
+
+        class UserDao(easyapi.BusinessBaseDao):
+            __tablename__ = 'users'
+            __db__ = self.db
+            __fulltext__ = ('note',)
+
+        class UserController(easyapi.BaseController):
+            __dao__ = UserDao
+
+        class UserHandler(easyapi.FlaskBaseHandler):
+            __controller__ = UserController
+
+        self.dao = UserDao
+        self.controller = UserController
+        app = flask.Flask(__name__)
+        easyapi.register_api(app, UserHandler, 'users', '/users')
+        self.client = app.test_client()
+
+    def ids(self, count: int = 1000):
+        """
+        循环使用的随机 id
+        :param count:
+        :return:
+        """
+        return itertools.cycle([self.rand.randint(1, self.rows) for _ in range(count)])
+
+    def names(self, count: int = 1000):
+        return itertools.cycle(['user{}'.format(self.rand.randrange(self.rows // 10 + 1)) for _ in range(count)])
+
+    def times(self, count: int = 1000):
+        return itertools.cycle([START + datetime.timedelta(seconds=self.rand.randrange(SPAN)) for _ in range(count)])
+
+    def cleanup(self):
+        """
+        删除写入测试新增的行 恢复软删除的行
+        :return:
+        """
+        self.db.execute(None, 'DELETE FROM users WHERE id > ?', self.rows)
+        self.db.execute(None, 'UPDATE users SET deleted_at = NULL WHERE deleted_at IS NOT NULL')
+        self.db.execute(None, "UPDATE sqlite_sequence SET seq = ? WHERE name = 'users'", self.rows)
+
+    def close(self):
+        self.cleanup()
+        self.db.close()
+
+
+@case('dao.get')
+def dao_get(env: Env):
+    ids = env.ids()
+    return lambda: env.dao.get(query={'id': next(ids)})
+
+
+@case('dao.query.eq')
+def dao_query_eq(env: Env):
+    names = env.names()
+    return lambda: env.dao.query(query={'name': next(names)}, pager=easyapi.Pager(page=1, per_page=PER_PAGE))
+
+
+def _range_case(operator: str):
+    def factory(env: Env):
+        times = env.times()
+        pager = easyapi.Pager(page=1, per_page=PER_PAGE)
+        sorter = easyapi.Sorter(sort_by='created_at', desc=operator.startswith('_lt'))
+        return lambda: env.dao.query(query={operator + 'created_at': next(times)}, pager=pager, sorter=sorter)
+
+    return factory
+
+
+for _operator in ('_gt_', '_gte_', '_lt_', '_lte_'):
+    case('dao.query.' + _operator.strip('_'))(_range_case(_operator))
+
+
+@case('dao.query.like')
+def dao_query_like(env: Env):
+    names = env.names()
+    return lambda: env.dao.query(query={'_like_name': next(names)[:6]}, pager=easyapi.Pager(page=1, per_page=PER_PAGE))
+
+
+@case('dao.query.search')
+def dao_query_search(env: Env):
+    return lambda: env.dao.query(query={'_search_note': 'echo golf'}, pager=easyapi.Pager(page=1, per_page=PER_PAGE))
+
+
+@case('dao.query.in')
+def dao_query_in(env: Env):
+    ids = env.ids()
+    return lambda: env.dao.query(query={'_in_id': [next(ids) for _ in range(PER_PAGE)]})
+
+
+@case('dao.query.match')
+def dao_query_match(env: Env):
+    return lambda: env.dao.query(query={'_match_note': 'echo golf'}, pager=easyapi.Pager(page=1, per_page=PER_PAGE))
+
+
+@case('dao.query.cursor')
+def dao_query_cursor(env: Env):
+    return lambda: env.dao.query(pager=easyapi.Pager(per_page=PER_PAGE, cursor=''))
+
+
+@case('dao.query_with_total')
+def dao_query_with_total(env: Env):
+    names = env.names()
+    return lambda: env.dao.query_with_total(query={'name': next(names)}, pager=easyapi.Pager(page=1, per_page=PER_PAGE))
+
+
+@case('dao.count')
+def dao_count(env: Env):
+    times = env.times()
+    return lambda: env.dao.count(query={'_gt_created_at': next(times)})
+
+
+@case('dao.insert')
+def dao_insert(env: Env):
+    return lambda: env.dao.insert(data={'name': 'bench', 'note': 'insert'})
+
+
+@case('dao.update')
+def dao_update(env: Env):
+    ids = env.ids()
+    return lambda: env.dao.update(where_dict={'id': next(ids)}, data={'updated_by': 'bench'})
+
+
+@case('dao.delete')
+def dao_delete(env: Env):
+    # 软删除 cleanup 时恢复
+    ids = itertools.cycle(range(1, env.rows + 1))
+    return lambda: env.dao.delete(where_dict={'id': next(ids)})
+
+
+@case('controller.query')
+def controller_query(env: Env):
+    names = env.names()
+    return lambda: env.controller.query(query={'name': next(names)}, pager=easyapi.Pager(page=1, per_page=PER_PAGE))
+
+
+@case('handler.get')
+def handler_get(env: Env):
+    ids = env.ids()
+    return lambda: env.client.get('/users/{}'.format(next(ids)))
+
+
+@case('handler.query')
+def handler_query(env: Env):
+    names = env.names()
+    return lambda: env.client.post('/users', json={'_method': 'GET', '_args': {
+        'name': next(names), '_per_page': PER_PAGE, '_page': 1}})
+
+
+@case('handler.insert')
+def handler_insert(env: Env):
+    return lambda: env.client.post('/users', json={'name': 'bench', 'note': 'insert'})
+
+
+@case('handler.update')
+def handler_update(env: Env):
+    ids = env.ids()
+    return lambda: env.client.put('/users/{}'.format(next(ids)), json={'updated_by': 'bench'})
+
+
+@case('handler.delete')
+def handler_delete(env: Env):
+    ids = itertools.cycle(range(env.rows, 0, -1))
+    return lambda: env.client.delete('/users/{}'.format(next(ids)))
+
+
+@case('sql.search_sql')
+def sql_search_sql(env: Env):
+    table = env.dao.__table__
+    dialect = env.db.dialect
+    query = {'name': 'user1', '_gt_score': 10, '_lte_created_at': START, '_in_id': [1, 2, 3], '_like_note': 'echo'}
+    return lambda: search_sql(select([table]), query, table, bind=True).compile(dialect=dialect)
+
+
+@case('util.type_to_json')
+def util_type_to_json(env: Env):
+    row = env.db.execute(None, select([env.dao.__table__]).limit(1)).fetchone()
+    return lambda: type_to_json(row)
+
+
+@case('util.row_serializer')
+def util_row_serializer(env: Env):
+    row = env.db.execute(None, select([env.dao.__table__]).limit(1)).fetchone()
+    serializer = env.dao.__serializer__
+    return lambda: serializer(row)
+
+
+def measure(op, repeat: int, min_time: float) -> float:
+    """
+    和 timeit 一样 先确定次数再重复测量 取最快的一次
+    :param op:
+    :param repeat:
+    :param min_time: 每次测量的最短时间 秒
+    :return: 每次操作的秒数
+    """
+    timer = timeit.Timer(op)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / elapsed) + 1) if elapsed else number * 10
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(env: Env, names: list = None, repeat: int = 5, min_time: float = 0.2) -> dict:
+    results = {}
+    for name, factory in CASES:
+        if names and not any(name.startswith(n) for n in names):
+            continue
+        op = factory(env)
+        op()
+        per_op = measure(op, repeat, min_time)
+        results[name] = {'per_op': per_op, 'ops': 1 / per_op}
+        print('{:<28}{:>12.1f} us{:>12.0f} ops/s'.format(name, per_op * 1e6, 1 / per_op))
+        env.cleanup()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    和基线比较
+    :param results:
+    :param baseline:
+    :param tolerance: 允许变慢的比例 0.2 表示 20%
+    :return: 变慢的测试 [(名字, 基线, 结果, 比例), ...]
+    """
+    regressions = []
+    for name, item in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = item['per_op'] / base['per_op']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append((name, base['per_op'], item['per_op'], ratio))
+            flag = '  REGRESSION'
+        print('{:<28}{:>8.2f}x{}'.format(name, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default=os.path.join(HERE, 'bench.db'), help='sqlite 数据库 不存在时生成')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2)
+    parser.add_argument('--only', nargs='*', help='只运行这些前缀的测试 例如 dao.query handler')
+    parser.add_argument('--output', help='结果写入的 json 文件')
+    parser.add_argument('--baseline', help='比较的基线 json 文件')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='允许变慢的比例')
+    parser.add_argument('--save-baseline', action='store_true', help='把结果写入 --baseline')
+    args = parser.parse_args()
+
+    ensure(args.db, args.rows, args.seed)
+    env = Env(args.db, args.rows, args.seed)
+    try:
+        results = run(env, args.only, args.repeat, args.min_time)
+    finally:
+        env.close()
+    report = {
+        'meta': {
+            'rows': args.rows,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if not args.baseline:
+        return 0
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['meta']['rows'] != args.rows:
+        print('baseline has {} rows, got {}'.format(baseline['meta']['rows'], args.rows))
+        return 2
+    regressions = compare(results, baseline, args.tolerance)
+    for name, base, new, ratio in regressions:
+        print('{} regressed: {:.1f} us -> {:.1f} us ({:.2f}x)'.format(name, base * 1e6, new * 1e6, ratio))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
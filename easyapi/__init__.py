@@ -1,8 +1,18 @@
-from .transcation import Transaction, get_tx
+from .transcation import Transaction, get_tx, AsyncTransaction, get_async_tx, get_unit_of_work, retry_tx, \
+    RetryPolicy
 from .context import EasyApiContext
-from .db_util import MysqlDB, AbcBaseDB, PostgreDB, SqliteDB
-from .sql import search_sql, Pager, Sorter
-from .dao import DaoMetaClass, BaseDao, BusinessBaseDao
-from .controller import ControllerMetaClass, BaseController
+from .loader import DataLoader, AsyncDataLoader
+from .cache import AbcCache, LRU, SqliteCache
+from .instrument import AbcInstrument, QueryEvent, QueryStats, SlowQueryLog
+from .advisor import IndexAdvisor
+from .db_util import MysqlDB, AbcBaseDB, PostgreDB, SqliteDB, ROUTING_WEIGHTED, ROUTING_LEAST_CONNECTIONS, \
+    PoolConfig, PRE_PING_ALWAYS, PRE_PING_IDLE, PRE_PING_NEVER
+from .async_db_util import AbcAsyncBaseDB, AsyncMysqlDB, AsyncSqliteDB
+from .encoder import AbcJsonEncoder, StdJsonEncoder, OrjsonEncoder
+from .sql import search_sql, Pager, Sorter, FullText, RELEVANCE, TOTAL_COUNT, TOTAL_CONNECTION, TOTAL_WINDOW, \
+    TOTAL_HAS_MORE
+from .dao import DaoMetaClass, BaseDao, BusinessBaseDao, AsyncBaseDao, AsyncBusinessBaseDao
+from .controller import ControllerMetaClass, BaseController, AsyncBaseController
 from .handler import FlaskBaseHandler, FlaskHandlerMeta, register_api
+from .async_handler import AsyncBaseHandler, AsyncHandlerMeta, register_async_api
 from easyapi_tools.errors import BusinessError
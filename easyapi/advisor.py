@@ -0,0 +1,187 @@
+import logging
+import threading
+from sqlalchemy import Table, UniqueConstraint
+from easyapi.sql import _iter_conditions
+
+logger = logging.getLogger(__name__)
+
+# 操作符能否使用 b-tree 索引
+OPERATOR_EQUAL = ('=', '_in_')
+OPERATOR_RANGE = ('_gt_', '_gte_', '_lt_', '_lte_', '_like_')  # _like_ 是前缀匹配
+OPERATOR_NO_INDEX = ('_search_',)  # LIKE '%x%' 不能使用索引
+# _match_ 使用全文索引 不参与 b-tree 索引的检查
+
+
+def table_indexes(table: Table) -> list:
+    """
+    表上已有的索引 包括主键和唯一约束
+    :param table:
+    :return: [(索引名, (字段, ...)), ...]
+    """
+    indexes = []
+    if table.primary_key.columns:
+        indexes.append(('PRIMARY', tuple(c.name for c in table.primary_key.columns)))
+    for index in table.indexes:
+        indexes.append((index.name, tuple(c.name for c in index.columns)))
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            indexes.append((constraint.name, tuple(c.name for c in constraint.columns)))
+    return indexes
+
+
+def query_conditions(query: dict) -> tuple:
+    """
+    查询条件的 (字段, 操作符) 不关心值
+    :param query:
+    :return:
+    """
+    return tuple(sorted({(column, operator) for _, operator, column, _ in _iter_conditions(query or {})}))
+
+
+def advise(table: Table, conditions: tuple, sort: str = None) -> dict:
+    """
+    检查一种查询能否使用索引
+    最左前缀规则 等值条件的字段在前 然后是一个范围条件或者排序字段
+    :param table:
+    :param conditions: query_conditions 的结果
+    :param sort: 排序字段
+    :return: {'index': 可以使用的索引名, 'no_index': 不能使用索引的条件, 'suggest': 建议的索引字段}
+    """
+    conditions = [(column, operator) for column, operator in conditions if column in table.c]
+    if sort is not None and sort not in table.c:
+        sort = None
+    equal = sorted({column for column, operator in conditions if operator in OPERATOR_EQUAL})
+    ranges = sorted({column for column, operator in conditions if operator in OPERATOR_RANGE} - set(equal))
+    no_index = ['{}{}'.format(operator, column) for column, operator in conditions if operator in OPERATOR_NO_INDEX]
+    indexed = set(equal) | set(ranges)
+    if not indexed and sort:
+        # 没有可用的条件时 排序字段上的索引可以避免全表排序
+        indexed = {sort}
+
+    best, best_length = None, 0
+    for name, columns in table_indexes(table):
+        length = 0
+        for column in columns:
+            if column not in indexed:
+                break
+            length += 1
+            if column not in equal:
+                break
+        if length > best_length:
+            best, best_length = name, length
+
+    suggest = None
+    if best is None and indexed:
+        suggest = equal + ranges[:1]
+        if not ranges and sort and sort not in suggest:
+            suggest.append(sort)
+        suggest = suggest or [sort]
+    return {'index': best, 'no_index': no_index, 'suggest': suggest}
+
+
+class IndexAdvisor:
+    """
+    记录每个 dao 收到的查询形状 检查是否能使用索引 用于开发和测试环境
+    db.advisor = IndexAdvisor() 之后 dao 生成查询时记录
+    """
+
+    def __init__(self, explain: bool = True):
+        """
+        :param explain: report 时对 mysql 和 postgresql 的样本执行 EXPLAIN
+        """
+        self.explain = explain
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    def record(self, dao, query: dict, sort: str = None, sql=None, params: dict = None):
+        """
+        记录一次查询
+        :param dao:
+        :param query: reformatter 之后的查询条件
+        :param sort: 排序字段
+        :param sql: 预编译的语句 用于 EXPLAIN
+        :param params:
+        :return:
+        """
+        key = (dao, query_conditions(query), sort)
+        with self._lock:
+            item = self._shapes.get(key)
+            if item is None:
+                self._shapes[key] = [1, sql, params]
+            else:
+                item[0] += 1
+
+    def report(self) -> list:
+        """
+        检查记录的查询
+        :return: [{'dao', 'table', 'conditions', 'sort', 'count', 'index', 'no_index', 'suggest', 'explain'}, ...]
+            按次数从多到少排序
+        """
+        with self._lock:
+            shapes = list(self._shapes.items())
+        result = []
+        for (dao, conditions, sort), (count, sql, params) in shapes:
+            item = {
+                'dao': dao.__name__,
+                'table': dao.__table__.name,
+                'conditions': ['{}{}'.format('' if operator == '=' else operator, column)
+                               for column, operator in conditions],
+                'sort': sort,
+                'count': count,
+                **advise(dao.__table__, conditions, sort),
+                'explain': None,
+            }
+            if self.explain and sql is not None:
+                item['explain'] = self._explain(dao.__db__, sql, params)
+            result.append(item)
+        result.sort(key=lambda item: -item['count'])
+        return result
+
+    def missing_indexes(self) -> list:
+        """
+        建议添加的索引 去重
+        :return: [(表名, (字段, ...)), ...]
+        """
+        indexes = []
+        for item in self.report():
+            if item['suggest']:
+                index = (item['table'], tuple(item['suggest']))
+                if index not in indexes:
+                    indexes.append(index)
+        return indexes
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+
+    def _explain(self, db, sql, params: dict):
+        """
+        执行 EXPLAIN 只支持 mysql 和 postgresql
+        :param db:
+        :param sql:
+        :param params:
+        :return: mysql 返回 [{'table', 'type', 'key', 'rows', 'Extra'}, ...] postgresql 返回执行计划的每一行
+        """
+        from easyapi.async_db_util import compile_sql
+        engine = getattr(db, '_sync_engine', None) or db._engine
+        dialect = engine.dialect.name
+        if dialect not in ('mysql', 'postgresql'):
+            return None
+        statement, params = compile_sql(sql, engine.dialect, params)
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('EXPLAIN ' + statement, params)
+                rows = cursor.fetchall()
+                names = [d[0] for d in cursor.description]
+            finally:
+                cursor.close()
+        except Exception as e:
+            logger.warning('explain failed: %s', e)
+            return None
+        finally:
+            conn.close()
+        if dialect == 'postgresql':
+            return [row[0] for row in rows]
+        return [{k: v for k, v in zip(names, row) if k in ('table', 'type', 'key', 'rows', 'Extra')} for row in rows]
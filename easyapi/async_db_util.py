@@ -0,0 +1,447 @@
+import abc
+import asyncio
+import sqlite3
+import time
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects import sqlite as sqlite_dialect
+from sqlalchemy.dialects.mysql import pymysql as mysql_dialect
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.compiler import Compiled
+from easyapi.context import EasyApiContext
+from easyapi.sql import Row
+from easyapi.instrument import begin_event, end_event, set_checkout_wait, current_operation
+from easyapi.db_util import AbcBaseDB, PoolConfig, PRE_PING_NEVER, get_mysql_engine, get_sqlite_engine
+
+
+def compile_sql(sql, dialect, *args, **kwargs):
+    """
+    把 sqlalchemy 语句编译成驱动可以直接执行的 sql 和参数
+    :param sql: sqlalchemy 语句 预编译的语句或者 sql 字符串
+    :param dialect:
+    :param args:
+    :param kwargs:
+    :return: (sql字符串, 参数)
+    """
+    if isinstance(sql, Compiled):
+        compiled = sql
+    elif isinstance(sql, ClauseElement):
+        compiled = sql.compile(dialect=dialect)
+    else:
+        params = args[0] if args else (kwargs or None)
+        return str(sql), params
+    params = compiled.construct_params(args[0] if args else (kwargs or None))
+    processors = compiled._bind_processors
+    for key, value in params.items():
+        if key in processors:
+            params[key] = processors[key](value)
+    if compiled.positional:
+        return str(compiled), tuple(params[key] for key in compiled.positiontup)
+    return str(compiled), params
+
+
+def make_rows(description, rows) -> list:
+    """
+    把驱动返回的 tuple 包装成 Row
+    :param description: cursor.description
+    :param rows:
+    :return:
+    """
+    keymap = {d[0]: i for i, d in enumerate(description)}
+    return [Row(keymap, tuple(row)) for row in rows]
+
+
+class AsyncResultProxy:
+    """
+    异步执行的结果 在连接归还之前已经全部读出
+    """
+
+    def __init__(self, rows: list = None, rowcount: int = -1, lastrowid=None):
+        self._rows = rows or []
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    @property
+    def inserted_primary_key(self):
+        return [self.lastrowid]
+
+    def fetchall(self):
+        return self._rows
+
+    def first(self):
+        if not self._rows:
+            return None
+        return self._rows[0]
+
+    def scalar(self):
+        row = self.first()
+        if row is None:
+            return None
+        return next(iter(row.values()))
+
+
+class AbcAsyncConnection(metaclass=abc.ABCMeta):
+    """
+    异步连接的基类 包装驱动的原始连接
+    """
+    instruments = ()
+
+    def __init__(self, raw, dialect):
+        self.raw = raw
+        self._dialect = dialect
+
+    async def execute(self, sql, *args, **kwargs):
+        """
+        执行sql
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        statement, params = compile_sql(sql, self._dialect, *args, **kwargs)
+        query_event = begin_event(self.instruments, statement) if self.instruments else None
+        try:
+            res = await self._execute(statement, params)
+        except self.dbapi_error as e:
+            if query_event is not None:
+                end_event(self.instruments, query_event, error=e)
+            # 转成 sqlalchemy 的异常 和同步db保持一致
+            raise DBAPIError.instance(statement, params, e, self.dbapi_error)
+        if query_event is not None:
+            end_event(self.instruments, query_event, rowcount=res.rowcount)
+        return res
+
+    async def stream(self, sql, params: dict = None, chunk_size: int = 1000, operation: tuple = None):
+        """
+        流式执行查询 使用服务端游标 监控记录的是读完全部结果的时间和行数
+        :param sql:
+        :param params:
+        :param chunk_size: 每次读取的行数
+        :param operation: 监控记录的 (dao类, 操作名)
+        :return: 异步生成器 每次产出一批行
+        """
+        statement, params = compile_sql(sql, self._dialect, params)
+        query_event = None
+        if self.instruments:
+            query_event = begin_event(self.instruments, statement, operation=operation)
+        rowcount = 0
+        try:
+            async for rows in self._stream(statement, params, chunk_size):
+                rowcount += len(rows)
+                yield rows
+        except self.dbapi_error as e:
+            if query_event is not None:
+                end_event(self.instruments, query_event, error=e)
+                query_event = None
+            raise DBAPIError.instance(statement, params, e, self.dbapi_error)
+        finally:
+            if query_event is not None:
+                end_event(self.instruments, query_event, rowcount=rowcount)
+
+    @property
+    @abc.abstractmethod
+    def dbapi_error(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def _execute(self, statement: str, params):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _stream(self, statement: str, params, chunk_size: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def begin(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+class AiomysqlConnection(AbcAsyncConnection):
+
+    @property
+    def dbapi_error(self):
+        import pymysql
+        return pymysql.err.Error
+
+    async def _execute(self, statement: str, params):
+        async with self.raw.cursor() as cursor:
+            await cursor.execute(statement, params)
+            rows = []
+            if cursor.description:
+                rows = make_rows(cursor.description, await cursor.fetchall())
+            return AsyncResultProxy(rows=rows, rowcount=cursor.rowcount, lastrowid=cursor.lastrowid)
+
+    async def _stream(self, statement: str, params, chunk_size: int):
+        import aiomysql
+        async with self.raw.cursor(aiomysql.SSCursor) as cursor:
+            await cursor.execute(statement, params)
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield make_rows(cursor.description, rows)
+
+    async def begin(self):
+        await self.raw.begin()
+
+    async def commit(self):
+        await self.raw.commit()
+
+    async def rollback(self):
+        await self.raw.rollback()
+
+
+class AiosqliteConnection(AbcAsyncConnection):
+    dbapi_error = sqlite3.Error
+
+    async def _execute(self, statement: str, params):
+        cursor = await self.raw.execute(statement, params or ())
+        try:
+            rows = []
+            if cursor.description:
+                rows = make_rows(cursor.description, await cursor.fetchall())
+            return AsyncResultProxy(rows=rows, rowcount=cursor.rowcount, lastrowid=cursor.lastrowid)
+        finally:
+            await cursor.close()
+
+    async def _stream(self, statement: str, params, chunk_size: int):
+        cursor = await self.raw.execute(statement, params or ())
+        try:
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield make_rows(cursor.description, rows)
+        finally:
+            await cursor.close()
+
+    async def begin(self):
+        await self.raw.execute('BEGIN')
+
+    async def commit(self):
+        await self.raw.execute('COMMIT')
+
+    async def rollback(self):
+        await self.raw.execute('ROLLBACK')
+
+
+class AbcAsyncBaseDB(AbcBaseDB):
+    """
+    异步数据库的基类 connect 和 execute 都是协程
+    """
+
+    @abc.abstractmethod
+    async def connect(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def close(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def acquire(self) -> AbcAsyncConnection:
+        """
+        从连接池取出一个连接
+        :return:
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def release(self, conn: AbcAsyncConnection):
+        """
+        归还连接
+        :param conn:
+        :return:
+        """
+        raise NotImplementedError
+
+    @property
+    def dialect(self):
+        return self._dialect
+
+    def _engines(self) -> list:
+        # 异步连接在 AbcAsyncConnection.execute 里记录 不监听 sqlalchemy 的事件
+        return []
+
+    async def _acquire(self) -> AbcAsyncConnection:
+        """
+        acquire 并记录等待时间
+        :return:
+        """
+        start = time.perf_counter()
+        conn = await self.acquire()
+        if self.instruments:
+            set_checkout_wait(time.perf_counter() - start)
+        conn.instruments = self.instruments
+        return conn
+
+    def __getitem__(self, name):
+        return self._table(name)
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._table(item)
+
+    async def execute(self, ctx: EasyApiContext, sql, *args, **kwargs):
+        """
+        执行sql 有事务时使用事务的连接
+        :param ctx:
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        conn = ctx.tx
+        if conn is not None:
+            return await conn.execute(sql, *args, **kwargs)
+        conn = await self._acquire()
+        try:
+            return await conn.execute(sql, *args, **kwargs)
+        finally:
+            await self.release(conn)
+
+    async def execute_batch(self, ctx: EasyApiContext, statements: list) -> list:
+        """
+        在同一个连接上依次执行多条查询
+        :param ctx:
+        :param statements: [(sql, 参数), ...]
+        :return: 每条查询的全部行
+        """
+        conn = ctx.tx
+        if conn is not None:
+            return [(await conn.execute(sql, params)).fetchall() for sql, params in statements]
+        conn = await self._acquire()
+        try:
+            return [(await conn.execute(sql, params)).fetchall() for sql, params in statements]
+        finally:
+            await self.release(conn)
+
+    def stream(self, ctx: EasyApiContext, sql, params: dict = None, chunk_size: int = 1000):
+        """
+        流式执行查询 有事务时使用事务的连接
+        :param ctx:
+        :param sql:
+        :param params:
+        :param chunk_size: 每次读取的行数
+        :return: 异步生成器 每次产出一批行
+        """
+        # 生成器在迭代时才执行 先记下当前的 dao 操作
+        return self._stream(ctx, sql, params, chunk_size, current_operation())
+
+    async def _stream(self, ctx: EasyApiContext, sql, params, chunk_size: int, operation: tuple):
+        conn = ctx.tx
+        if conn is not None:
+            async for rows in conn.stream(sql, params, chunk_size, operation):
+                yield rows
+            return
+        conn = await self._acquire()
+        try:
+            async for rows in conn.stream(sql, params, chunk_size, operation):
+                yield rows
+        finally:
+            await self.release(conn)
+
+
+class AsyncMysqlDB(AbcAsyncBaseDB):
+    """
+    用于异步操作 mysql 的db对象 基于 aiomysql
+    """
+
+    def __init__(self, user, password, host, port, database, echo=False, pool_size=100,
+                 pool_config: PoolConfig = None, schema_snapshot: str = None):
+        """
+        :param pool_config: 连接池配置 使用 size recycle warm_up 其中 warm_up 作为连接池的最小连接数
+        :param schema_snapshot: 表结构快照的文件路径
+        """
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.database = database
+        self._engine = None
+        self._sync_engine = None
+        self._metadata = None
+        self._tables = None
+        self._dialect = mysql_dialect.dialect()
+        self.echo = echo
+        self.pool_config = pool_config or PoolConfig(size=pool_size)
+        self.schema_snapshot = schema_snapshot
+
+    async def connect(self):
+        import aiomysql
+        self._sync_engine = get_mysql_engine(user=self.user, password=self.password, host=self.host, port=self.port,
+                                             database=self.database, echo=self.echo,
+                                             pool_config=PoolConfig(size=1, pre_ping=PRE_PING_NEVER))
+        # 表在第一次使用时用同步的 engine 反射
+        self._load_schema(self._sync_engine)
+        self._dialect.server_version_info = self._sync_engine.dialect.server_version_info
+        self._sync_engine.dispose()
+        self._engine = await aiomysql.create_pool(host=self.host, port=self.port, user=self.user,
+                                                  password=self.password, db=self.database,
+                                                  minsize=min(self.pool_config.warm_up, self.pool_config.size),
+                                                  maxsize=self.pool_config.size,
+                                                  pool_recycle=self.pool_config.recycle,
+                                                  charset='utf8mb4', autocommit=True, echo=self.echo)
+
+    async def close(self):
+        self.save_schema()
+        self._engine.close()
+        await self._engine.wait_closed()
+
+    async def acquire(self):
+        return AiomysqlConnection(await self._engine.acquire(), self._dialect)
+
+    async def release(self, conn: AbcAsyncConnection):
+        self._engine.release(conn.raw)
+
+
+class AsyncSqliteDB(AbcAsyncBaseDB):
+    """
+    用于异步操作 sqlite 的db对象 基于 aiosqlite
+    """
+
+    def __init__(self, database, echo=False, pool_size=5, schema_snapshot: str = None):
+        """
+        :param schema_snapshot: 表结构快照的文件路径
+        """
+        self.database = database
+        self._engine = None
+        self._sync_engine = None
+        self._metadata = None
+        self._tables = None
+        self._dialect = sqlite_dialect.dialect()
+        self.echo = echo
+        self.pool_size = pool_size
+        self.schema_snapshot = schema_snapshot
+
+    async def connect(self):
+        import aiosqlite
+        self._sync_engine = get_sqlite_engine(database=self.database, echo=self.echo)
+        # 表在第一次使用时用同步的 engine 反射
+        self._load_schema(self._sync_engine)
+        self._sync_engine.dispose()
+        self._engine = asyncio.Queue()
+        for _ in range(self.pool_size):
+            # isolation_level=None 自动提交 事务通过 BEGIN 显式开启
+            raw = await aiosqlite.connect(self.database, isolation_level=None)
+            self._engine.put_nowait(raw)
+
+    async def close(self):
+        self.save_schema()
+        while not self._engine.empty():
+            raw = self._engine.get_nowait()
+            await raw.close()
+
+    async def acquire(self):
+        return AiosqliteConnection(await self._engine.get(), self._dialect)
+
+    async def release(self, conn: AbcAsyncConnection):
+        self._engine.put_nowait(conn.raw)
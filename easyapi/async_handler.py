@@ -0,0 +1,197 @@
+import quart
+from quart import views
+from easyapi_tools.util import str2hump, DefaultUrlCondition, parse_url_fields, parse_url_args
+from easyapi_tools.errors import BusinessError
+
+
+class AsyncHandlerMeta(views.MethodViewType):
+
+    def __new__(cls, name, bases, attrs):
+        """
+
+        :param name:
+        :param bases:
+        :param attrs:
+        :return:
+        """
+        if "BaseHandler" in name:
+            return type.__new__(cls, name, bases, attrs)
+
+        attrs['__resource__'] = attrs.get('__resource__') or str2hump(name[:-7])
+        attrs['__url_condition__'] = attrs.get('__url_condition__') or DefaultUrlCondition
+        if not attrs.get('__controller__'):
+            raise NotImplementedError("Handler require a  controller.")
+
+        return type.__new__(cls, name, bases, attrs)
+
+
+class AsyncBaseHandler(views.MethodView, metaclass=AsyncHandlerMeta):
+    """
+    基于 quart 的异步handler __controller__ 需要是 AsyncBaseController
+    """
+    __stream_chunk_size__ = 1000
+    __json_encoder__ = None  # AbcJsonEncoder 例如 easyapi.OrjsonEncoder() 为 None 时使用 quart.jsonify
+
+    def _jsonify(self, **data):
+        """
+        编码返回的数据
+        :param data:
+        :return:
+        """
+        if self.__json_encoder__ is None:
+            return quart.jsonify(**data)
+        return quart.Response(self.__json_encoder__.dumps(data), mimetype='application/json')
+
+    def _dumps(self, data) -> bytes:
+        """
+        编码一个资源 用于流式返回
+        :param data:
+        :return:
+        """
+        if self.__json_encoder__ is None:
+            return quart.json.dumps(data).encode()
+        return self.__json_encoder__.dumps(data)
+
+    async def get(self, id: int, **kwargs):
+        """
+        获取单个资源
+        :param id:
+        :return:
+        """
+        ctx = kwargs.get('ctx')
+        try:
+            fields = parse_url_fields(self.__url_condition__, {'_fields': quart.request.args.get('_fields')},
+                                      table=self.__controller__.__dao__.__table__)
+            data = await self.__controller__.get(ctx=ctx, id=id, fields=fields)
+        except BusinessError as e:
+            return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+        if not data:
+            return self._jsonify(**{
+                'msg': '',
+                'code': 404,
+            }), 404
+        return self._jsonify(**{
+            'msg': '',
+            'code': 200,
+            self.__resource__: data
+        })
+
+    async def put(self, id, **kwargs):
+        """
+        修改的路由
+        :return:
+        """
+        ctx = kwargs.get('ctx')
+
+        body = await quart.request.get_json()
+        try:
+            count = await self.__controller__.update(ctx=ctx, id=id, data=body)
+        except BusinessError as e:
+            return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+        return self._jsonify(code=200, count=count, msg='')
+
+    async def delete(self, id, **kwargs):
+        """
+        删除的路由
+        :param id:
+        :return:
+        """
+        ctx = kwargs.get('ctx')
+        try:
+            count = await self.__controller__.delete(ctx=ctx, id=id)
+        except BusinessError as e:
+            return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+        return self._jsonify(code=200, count=count, msg='')
+
+    async def post(self, *args, **kwargs):
+        """
+        处理 查询和新增
+        :return:
+        """
+        ctx = kwargs.get('ctx')
+        body = await quart.request.get_json()
+        method = body.get("_method") or "POST"
+
+        if method == 'GET':
+            try:
+                query, pager, sorter, fields = parse_url_args(self.__url_condition__, body.get("_args"),
+                                                              table=self.__controller__.__dao__.__table__)
+                if body.get("_stream"):
+                    return await self._stream(ctx, body.get("_stream"), query, sorter, fields)
+                res, count = await self.__controller__.query(ctx=ctx, query=query, pager=pager, sorter=sorter,
+                                                             fields=fields)
+            except BusinessError as e:
+                return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+            return self._jsonify(**{
+                'msg': '',
+                'code': 200,
+                self.__resource__ + 's': res,
+                'total': count,
+                'next_cursor': getattr(pager, 'next_cursor', None),
+                'has_more': getattr(pager, 'has_more', None)
+            })
+        else:
+            if '_method' in body:
+                del body['_method']
+            try:
+                _id = await self.__controller__.insert(ctx=ctx, data=body)
+            except BusinessError as e:
+                return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+            return self._jsonify(code=200, id=_id, msg='')
+
+    async def _stream(self, ctx, mode: str, query: dict, sorter, fields: list):
+        """
+        流式返回查询结果 不分页
+        :param ctx:
+        :param mode: ndjson 每行一个资源 json 和普通查询一样的结构 逐个写出资源
+        :param query:
+        :param sorter:
+        :param fields:
+        :return:
+        """
+        if mode not in ('ndjson', 'json'):
+            raise BusinessError(code=400, http_code=400, err_info='unknown _stream: {}'.format(mode))
+        rows = self.__controller__.iter_query(ctx=ctx, query=query, sorter=sorter, fields=fields,
+                                              chunk_size=self.__stream_chunk_size__)
+        # 先取第一行 查询出错时还能返回错误码
+        try:
+            first = await rows.__anext__()
+        except StopAsyncIteration:
+            first = None
+        dumps = self._dumps
+
+        async def generate_ndjson():
+            if first is None:
+                return
+            yield dumps(first) + b'\n'
+            async for row in rows:
+                yield dumps(row) + b'\n'
+
+        async def generate_json():
+            yield b'{"msg":"","code":200,' + dumps(self.__resource__ + 's') + b':['
+            if first is not None:
+                yield dumps(first)
+                async for row in rows:
+                    yield b',' + dumps(row)
+            yield b']}'
+
+        if mode == 'ndjson':
+            return quart.Response(generate_ndjson(), mimetype='application/x-ndjson')
+        return quart.Response(generate_json(), mimetype='application/json')
+
+
+def register_async_api(app, view, endpoint: str, url: str, pk='id', pk_type='int'):
+    """
+    将一个异步handler类的路由注册到 quart 的 app 或者 blueprint 里
+    :param app: 注册的app
+    :param view: 试图类
+    :param endpoint: 挂载
+    :param url: 链接
+    :param pk: 主键
+    :param pk_type: 类型
+    :return:
+    """
+    view_func = view.as_view(endpoint)
+    app.add_url_rule(url, view_func=view_func, methods=['GET', 'POST'])
+    app.add_url_rule('%s/<%s:%s>' % (url, pk_type, pk), view_func=view_func,
+                     methods=['GET', 'PUT', 'DELETE'])
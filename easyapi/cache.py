@@ -0,0 +1,136 @@
+import abc
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class AbcCache(metaclass=abc.ABCMeta):
+    """
+    dao 缓存的基类 key 是字符串 值是一行数据的 dict
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str):
+        """
+        读取缓存
+        :param key:
+        :return: 不存在或者过期时返回 None
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key: str, value: dict):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, keys: list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self, prefix: str = None):
+        """
+        清空缓存
+        :param prefix: 只清空这个前缀的 key 为 None 时全部清空
+        :return:
+        """
+        raise NotImplementedError
+
+
+class LRU(AbcCache):
+    """
+    进程内的 LRU 缓存
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        """
+        :param maxsize: 最多缓存的条数
+        :param ttl: 过期秒数
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expire_at = item
+            if expire_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: dict):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, keys: list):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self, prefix: str = None):
+        with self._lock:
+            if prefix is None:
+                self._data.clear()
+                return
+            for key in [k for k in self._data.keys() if k.startswith(prefix)]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteCache(AbcCache):
+    """
+    基于本地 sqlite 文件的缓存 同一台机器上的多个 worker 共享
+    """
+
+    def __init__(self, path: str, ttl: float = 60):
+        """
+        :param path: 缓存文件路径
+        :param ttl: 过期秒数
+        """
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expire_at REAL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # fork 之后的子进程不能复用父进程的连接
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key: str):
+        row = self._connection().execute('SELECT value, expire_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value: dict):
+        self._connection().execute('INSERT OR REPLACE INTO cache (key, value, expire_at) VALUES (?, ?, ?)',
+                                   (key, pickle.dumps(value), time.time() + self.ttl))
+
+    def delete(self, keys: list):
+        self._connection().executemany('DELETE FROM cache WHERE key = ?', [(key,) for key in keys])
+
+    def clear(self, prefix: str = None):
+        if prefix is None:
+            self._connection().execute('DELETE FROM cache')
+        else:
+            self._connection().execute("DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
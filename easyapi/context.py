@@ -1,11 +1,19 @@
+import time
 import typing
-from easyapi.transcation import Transaction
+from easyapi.transcation import Transaction, after_commit
 
 
 class EasyApiContext:
-    def __init__(self, tx: Transaction=None):
+    def __init__(self, tx: Transaction=None, read_your_writes: float = 0):
+        """
+        :param tx:
+        :param read_your_writes: 写入后多少秒内的读走主库 0 不开启
+        """
         self._tx = tx
+        self.read_your_writes = read_your_writes
+        self._last_write_at = None
         self._data = {}
+        self._loaders = {}
         self.formatter = None
         self.reformatter = None
 
@@ -17,6 +25,32 @@ class EasyApiContext:
         """
         return self._tx
 
+    def mark_write(self):
+        """
+        记录写入时间
+        :return:
+        """
+        self._last_write_at = time.monotonic()
+
+    def read_primary(self) -> bool:
+        """
+        读是否需要走主库 事务内或者在 read_your_writes 的时间窗口内
+        :return:
+        """
+        if self._tx is not None:
+            return True
+        if not self.read_your_writes or self._last_write_at is None:
+            return False
+        return time.monotonic() - self._last_write_at < self.read_your_writes
+
+    def after_commit(self, callback: typing.Callable):
+        """
+        事务提交后执行 没有事务时立即执行
+        :param callback:
+        :return:
+        """
+        after_commit(self._tx, callback)
+
     def read(self, key:str):
         """
         读取数据
@@ -34,5 +68,24 @@ class EasyApiContext:
         """
         self._data[key] = value
 
+    def loader(self, key: tuple, factory: typing.Callable):
+        """
+        读取请求内共享的 loader 不存在时用 factory 创建
+        :param key: (所属的类, 名字)
+        :param factory:
+        :return:
+        """
+        loader = self._loaders.get(key)
+        if loader is None:
+            loader = self._loaders[key] = factory()
+        return loader
 
-
+    def clear_loaders(self, owner=None):
+        """
+        清空 loader 记住的结果
+        :param owner: 只清空这个类的 loader 为 None 时全部清空
+        :return:
+        """
+        for key in list(self._loaders.keys()):
+            if owner is None or key[0] is owner:
+                del self._loaders[key]
@@ -1,6 +1,7 @@
+import itertools
 from easyapi_tools.errors import BusinessError
 from easyapi import EasyApiContext
-from easyapi.sql import Pager, Sorter
+from easyapi.sql import Pager, Sorter, CursorError, FieldError, TOTAL_CONNECTION
 from sqlalchemy.exc import OperationalError, IntegrityError, DataError
 
 
@@ -15,29 +16,44 @@ class ControllerMetaClass(type):
 
 
 class BaseController(metaclass=ControllerMetaClass):
+    # 查询总数的方式 见 easyapi.sql.TOTAL_*
+    __total__ = TOTAL_CONNECTION
+
     @classmethod
     def formatter(cls, ctx: EasyApiContext, data: dict):
         """
-        限制资源返回
+        限制资源返回 data 是 dao.formatter 新生成的 dict 可以直接修改
         :param data:
         :return:
         """
-        return data.copy()
+        return data
+
+    @classmethod
+    def format_many(cls, ctx: EasyApiContext, rows: list) -> list:
+        """
+        限制一页资源的返回 每页调用一次 默认逐个调用 formatter
+        需要整页处理的逻辑 例如权限过滤 批量补充关联数据 可以重写这个方法
+        :param ctx:
+        :param rows:
+        :return:
+        """
+        return [cls.formatter(ctx=ctx, data=data) for data in rows]
 
     @classmethod
     def reformatter(cls, ctx: EasyApiContext, data: dict):
         """
-        限制资源查询方式
+        限制资源查询方式 默认不复制 需要修改时返回新的 dict 不要修改传入的 data
         :param data:
         :return:
         """
-        return data.copy()
+        return data
 
     @classmethod
-    def get(cls, id: int, ctx: EasyApiContext = None):
+    def get(cls, id: int, ctx: EasyApiContext = None, fields: list = None):
         """
         获取单个资源
         :param id:
+        :param fields: 返回的字段 为 None 时返回全部字段
         :param query: 附加的查询
         :return:
         """
@@ -50,7 +66,9 @@ class BaseController(metaclass=ControllerMetaClass):
 
         query = {"id": id, **query}
         try:
-            data = cls.__dao__.get(ctx=ctx, query=query)
+            data = cls.__dao__.get(ctx=ctx, query=query, fields=fields)
+        except FieldError as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
         except (OperationalError, IntegrityError, DataError) as e:
             raise BusinessError(code=500, http_code=500, err_info=str(e))
         if not data:
@@ -58,13 +76,14 @@ class BaseController(metaclass=ControllerMetaClass):
         return cls.formatter(ctx=ctx, data=data)
 
     @classmethod
-    def query(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None, sorter: Sorter = None) -> (
-            list, dict):
+    def query(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None, sorter: Sorter = None,
+              fields: list = None) -> (list, dict):
         """
         获取多个资源
         :param filter_dict:
         :param pager:
         :param sorter:
+        :param fields: 返回的字段 为 None 时返回全部字段
         :return:
         """
         if ctx is None:
@@ -77,11 +96,45 @@ class BaseController(metaclass=ControllerMetaClass):
             sorter = Sorter(sort_by='id', desc=True)
         query = cls.reformatter(ctx=ctx, data=query)
         try:
-            res = cls.__dao__.query(ctx=ctx, query=query, pager=pager, sorter=sorter)
-            total = cls.__dao__.count(ctx=ctx, query=query)
+            res, total = cls.__dao__.query_with_total(ctx=ctx, query=query, pager=pager, sorter=sorter,
+                                                      total=cls.__total__, fields=fields)
+        except (CursorError, FieldError) as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return cls.format_many(ctx=ctx, rows=res), total
+
+    @classmethod
+    def iter_query(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None,
+                   fields: list = None, chunk_size: int = 1000):
+        """
+        流式获取多个资源 不分页 不查询总数
+        :param ctx:
+        :param query:
+        :param sorter:
+        :param fields:
+        :param chunk_size: 每次从数据库读取的行数
+        :return: 生成器
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if query is None:
+            query = {}
+        if sorter is None:
+            sorter = Sorter(sort_by='id', desc=True)
+        query = cls.reformatter(ctx=ctx, data=query)
+        try:
+            rows = cls.__dao__.iter_query(ctx=ctx, query=query, sorter=sorter, chunk_size=chunk_size, fields=fields)
+            while True:
+                # 按 chunk_size 分批调用 format_many
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                yield from cls.format_many(ctx=ctx, rows=chunk)
+        except FieldError as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
         except (OperationalError, IntegrityError, DataError) as e:
             raise BusinessError(code=500, http_code=500, err_info=str(e))
-        return list(map(lambda  d : cls.formatter(ctx=ctx, data=d), res)), total
 
     @classmethod
     def insert(cls, ctx: EasyApiContext = None, data: dict = None):
@@ -105,6 +158,30 @@ class BaseController(metaclass=ControllerMetaClass):
             raise BusinessError(code=500, http_code=500, err_info=str(e))
         return res
 
+    @classmethod
+    def insert_many(cls, ctx: EasyApiContext = None, data: list = None, chunk_size: int = 1000):
+        """
+        批量插入资源 整批检验通过后再插入
+        :param ctx:
+        :param data:
+        :param chunk_size:
+        :return: 生成的id
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if data is None:
+            data = []
+        data = [cls.reformatter(ctx=ctx, data=d) for d in data]
+        if cls.__validator__:
+            errors = cls.__validator__.validate_many(data)
+            if errors:
+                raise BusinessError(code=500, http_code=200, err_info=errors)
+        try:
+            res = cls.__dao__.insert_many(ctx=ctx, rows=data, chunk_size=chunk_size)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
+
     @classmethod
     def update(cls, id: int, ctx: EasyApiContext = None, data: dict = None, ):
         """
@@ -152,3 +229,210 @@ class BaseController(metaclass=ControllerMetaClass):
         except (OperationalError, IntegrityError, DataError) as e:
             raise BusinessError(code=500, http_code=500, err_info=str(e))
         return res
+
+
+class AsyncBaseController(BaseController):
+    """
+    异步controller __dao__ 需要是 AsyncBaseDao
+    """
+
+    @classmethod
+    async def format_many(cls, ctx: EasyApiContext, rows: list) -> list:
+        """
+        限制一页资源的返回 每页调用一次 默认逐个调用 formatter
+        重写时可以在这里 await 批量查询关联数据
+        :param ctx:
+        :param rows:
+        :return:
+        """
+        return [cls.formatter(ctx=ctx, data=data) for data in rows]
+
+    @classmethod
+    async def get(cls, id: int, ctx: EasyApiContext = None, fields: list = None):
+        """
+        获取单个资源
+        :param id:
+        :param fields: 返回的字段 为 None 时返回全部字段
+        :param ctx:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+
+        query = ctx.read('query')
+        if query is None:
+            query = {}
+
+        query = {"id": id, **query}
+        try:
+            data = await cls.__dao__.get(ctx=ctx, query=query, fields=fields)
+        except FieldError as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        if not data:
+            return None
+        return cls.formatter(ctx=ctx, data=data)
+
+    @classmethod
+    async def query(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None,
+                    sorter: Sorter = None, fields: list = None) -> (list, dict):
+        """
+        获取多个资源
+        :param ctx:
+        :param query:
+        :param pager:
+        :param sorter:
+        :param fields: 返回的字段 为 None 时返回全部字段
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if query is None:
+            query = {}
+        if pager is None:
+            pager = Pager(page=1, per_page=20)
+        if sorter is None:
+            sorter = Sorter(sort_by='id', desc=True)
+        query = cls.reformatter(ctx=ctx, data=query)
+        try:
+            res, total = await cls.__dao__.query_with_total(ctx=ctx, query=query, pager=pager, sorter=sorter,
+                                                            total=cls.__total__, fields=fields)
+        except (CursorError, FieldError) as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return await cls.format_many(ctx=ctx, rows=res), total
+
+    @classmethod
+    async def iter_query(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None,
+                         fields: list = None, chunk_size: int = 1000):
+        """
+        流式获取多个资源 不分页 不查询总数
+        :param ctx:
+        :param query:
+        :param sorter:
+        :param fields:
+        :param chunk_size: 每次从数据库读取的行数
+        :return: 异步生成器
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if query is None:
+            query = {}
+        if sorter is None:
+            sorter = Sorter(sort_by='id', desc=True)
+        query = cls.reformatter(ctx=ctx, data=query)
+        try:
+            chunk = []
+            async for data in cls.__dao__.iter_query(ctx=ctx, query=query, sorter=sorter, chunk_size=chunk_size,
+                                                     fields=fields):
+                chunk.append(data)
+                if len(chunk) < chunk_size:
+                    continue
+                # 按 chunk_size 分批调用 format_many
+                for data in await cls.format_many(ctx=ctx, rows=chunk):
+                    yield data
+                chunk = []
+            if chunk:
+                for data in await cls.format_many(ctx=ctx, rows=chunk):
+                    yield data
+        except FieldError as e:
+            raise BusinessError(code=400, http_code=400, err_info=str(e))
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+
+    @classmethod
+    async def insert(cls, ctx: EasyApiContext = None, data: dict = None):
+        """
+        插入单个资源
+        :param ctx:
+        :param data:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if data is None:
+            data = {}
+        data = cls.reformatter(ctx=ctx, data=data)
+        if cls.__validator__:
+            err = cls.__validator__.validate(data)
+            if err:
+                raise BusinessError(code=500, http_code=200, err_info=err)
+        try:
+            res = await cls.__dao__.insert(ctx=ctx, data=data)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
+
+    @classmethod
+    async def insert_many(cls, ctx: EasyApiContext = None, data: list = None, chunk_size: int = 1000):
+        """
+        批量插入资源 整批检验通过后再插入
+        :param ctx:
+        :param data:
+        :param chunk_size:
+        :return: 生成的id
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if data is None:
+            data = []
+        data = [cls.reformatter(ctx=ctx, data=d) for d in data]
+        if cls.__validator__:
+            errors = cls.__validator__.validate_many(data)
+            if errors:
+                raise BusinessError(code=500, http_code=200, err_info=errors)
+        try:
+            res = await cls.__dao__.insert_many(ctx=ctx, rows=data, chunk_size=chunk_size)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
+
+    @classmethod
+    async def update(cls, id: int, ctx: EasyApiContext = None, data: dict = None, ):
+        """
+        修改单个资源
+        :param id:
+        :param ctx:
+        :param data:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        query = ctx.read('query')
+        if query is None:
+            query = {}
+        if data is None:
+            data = {}
+        if cls.__validator__:
+            err = cls.__validator__.validate(data)
+            if err:
+                raise BusinessError(code=500, http_code=200, err_info=err)
+        query = {"id": id, **query}
+        data = cls.reformatter(ctx=ctx, data=data)
+        try:
+            res = await cls.__dao__.update(ctx=ctx, where_dict=query, data=data)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
+
+    @classmethod
+    async def delete(cls, id: int, ctx: EasyApiContext = None):
+        """
+        删除单个资源
+        :param id:
+        :param ctx:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        query = ctx.read('query')
+        if query is None:
+            query = {}
+        query = {"id": id, **query}
+        try:
+            res = await cls.__dao__.delete(ctx=ctx, where_dict=query)
+        except (OperationalError, IntegrityError, DataError) as e:
+            raise BusinessError(code=500, http_code=500, err_info=str(e))
+        return res
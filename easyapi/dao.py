@@ -1,10 +1,19 @@
 import datetime
 import functools
-from sqlalchemy import Table
-from sqlalchemy.sql import select, func
-from easyapi_tools.util import str2hump, type_to_json
-from easyapi.sql import search_sql, Pager, Sorter
+import operator
+from sqlalchemy import Table, Integer
+from sqlalchemy.sql import select, func, bindparam, and_, or_, case
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from easyapi_tools.util import str2hump, type_to_json, row_serializer
+from easyapi.sql import search_sql, search_sql_params, query_shape, pager_limit_offset, Pager, Sorter, \
+    StatementCache, select_columns, SqliteUpsert, encode_cursor, decode_cursor, FullText, relevance_sql, RELEVANCE, \
+    TOTAL_COUNT, TOTAL_CONNECTION, TOTAL_WINDOW, TOTAL_HAS_MORE
 from easyapi.context import EasyApiContext
+from easyapi.loader import DataLoader, AsyncDataLoader
+from easyapi.cache import AbcCache
+from easyapi.instrument import operation, operation_scope
+from easyapi.transcation import get_unit_of_work
 
 
 class DaoMetaClass(type):
@@ -30,6 +39,19 @@ class DaoMetaClass(type):
 
         table = attrs['__db__'][attrs['__tablename__']]  # type: Table
         attrs['__table__'] = table
+        if '__statement_cache__' not in attrs:
+            attrs['__statement_cache__'] = StatementCache()
+        if '__serializer__' not in attrs:
+            # 按字段类型生成 只转换需要转换的字段
+            attrs['__serializer__'] = staticmethod(row_serializer(table))
+        fulltext = attrs.get('__fulltext__')
+        if fulltext is not None:
+            if not isinstance(fulltext, FullText):
+                fulltext = attrs['__fulltext__'] = FullText(columns=tuple(fulltext))
+            for column in fulltext.columns:
+                attrs['_match_' + column] = '_match_' + column
+        if attrs.get('__cache__') is not None and not isinstance(attrs['__cache__'], AbcCache):
+            raise TypeError("__cache__ should be an AbcCache.")
 
         for c in table.c:
             attrs[c.name] = c.name
@@ -47,150 +69,1460 @@ class DaoMetaClass(type):
 
 
 class BaseDao(metaclass=DaoMetaClass):
+    __cache__ = None  # 按id缓存 get 的结果 例如 LRU(maxsize=1024, ttl=60)
+    __fulltext__ = None  # 全文索引的字段 例如 ('name', 'note') 或者 FullText(...) 用于 _match_ 查询
+    __serializer__ = staticmethod(type_to_json)  # formatter 使用的转换函数 子类由元类按表生成
+
+    @classmethod
+    def reformatter(cls, ctx: EasyApiContext = None, data: dict = None):
+        """
+        将model数据转换成dao数据 默认不复制 需要修改时返回新的 dict 不要修改传入的 data
+        :param ctx:
+        :param data:
+        :return:
+        """
+        if data is None:
+            return dict()
+        return data
+
+    @classmethod
+    def formatter(cls, ctx: EasyApiContext = None, data: dict = None):
+        """
+        将dao数据转换成model数据 __serializer__ 生成新的 dict 之后的 formatter 可以直接修改
+        :param ctx:
+        :param data: 数据库的一行
+        :return:
+        """
+        if data is None:
+            return dict()
+        return cls.__serializer__(data)
+
+    @classmethod
+    def format_many(cls, ctx: EasyApiContext = None, rows: list = None) -> list:
+        """
+        格式化一页数据 每页调用一次 默认逐行调用 formatter
+        需要整页处理的逻辑 例如批量查询关联数据 可以重写这个方法
+        :param ctx:
+        :param rows: 数据库的行
+        :return:
+        """
+        return [cls.formatter(ctx=ctx, data=row) for row in rows]
+
+    @classmethod
+    def _compile(cls, key: tuple, build):
+        """
+        按查询的形状缓存预编译的语句
+        :param key: 查询的形状
+        :param build: 生成语句的函数
+        :return:
+        """
+        cache = cls.__statement_cache__
+        if cache is None:
+            return cls.__db__.compile(build())
+        compiled = cache.get(key)
+        if compiled is None:
+            compiled = cls.__db__.compile(build())
+            cache.set(key, compiled)
+        return compiled
+
+    @classmethod
+    def _order_by(cls, table: Table, sorter: Sorter = None, query: dict = None):
+        """
+        排序的字段
+        :param table:
+        :param sorter: sort_by 为 RELEVANCE 时按第一个 _match_ 条件的相关度排序
+        :param query:
+        :return: (排序语句, 排序的形状)
+        """
+        if not sorter:
+            return None, None
+        if sorter.sort_by == RELEVANCE:
+            score = relevance_sql(query, table, bind=True, fulltext=cls.__fulltext__)
+            if score is not None:
+                return (score.desc() if sorter.desc else score), (RELEVANCE, bool(sorter.desc))
+        column = getattr(table.c, sorter.sort_by, table.c.id)
+        if sorter.desc:
+            return column.desc(), (column.name, True)
+        return column, (column.name, False)
+
+    @classmethod
+    def _advise(cls, query: dict, sort: str, sql, params: dict):
+        """
+        db.advisor 不为 None 时记录查询的形状
+        :param query:
+        :param sort: 排序字段
+        :param sql:
+        :param params:
+        :return:
+        """
+        advisor = cls.__db__.advisor
+        if advisor is not None:
+            advisor.record(cls, query, sort, sql, params)
+
+    @classmethod
+    def _get_sql(cls, ctx: EasyApiContext, query: dict = None, sorter: Sorter = None, fields: list = None):
+        """
+        生成get查询的sql
+        :param ctx:
+        :param query:
+        :param sorter:
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :return: (预编译的语句, 参数)
+        """
+        if query is None:
+            query = {}
+        query = cls.reformatter(ctx=ctx, data=query)
+        table = cls.__db__[cls.__tablename__]
+        order_by, sorter_shape = cls._order_by(table, sorter, query)
+        columns = select_columns(table, fields)
+        fields_shape = tuple(c.name for c in columns) if fields else None
+
+        def build():
+            sql = select(columns)
+            if query:
+                sql = search_sql(sql, query, table, bind=True, fulltext=cls.__fulltext__)
+            sql = sql.order_by(table.c.id.desc())
+            if order_by is not None:
+                sql = sql.order_by(order_by)
+            return sql
+
+        sql = cls._compile(('get', query_shape(query), sorter_shape, fields_shape), build)
+        params = search_sql_params(query)
+        cls._advise(query, None, sql, params)
+        return sql, params
+
+    @classmethod
+    def _cursor_columns(cls, table: Table, sorter: Sorter = None):
+        """
+        游标分页使用的字段 排序字段加上 id 保证唯一
+        :param table:
+        :param sorter:
+        :return:
+        """
+        column = getattr(table.c, sorter.sort_by, table.c.id) if sorter else table.c.id
+        if column is table.c.id:
+            return [table.c.id]
+        return [column, table.c.id]
+
+    @classmethod
+    def _query_sql(cls, ctx: EasyApiContext, query: dict = None, pager: Pager = None, sorter: Sorter = None,
+                   with_total: bool = False, fields: list = None):
+        """
+        生成query查询的sql
+        :param ctx:
+        :param query:
+        :param pager: pager.cursor 不为 None 时按 (排序字段, id) 做游标分页
+        :param sorter:
+        :param with_total: 每行附带 COUNT(*) OVER() 的总数 列名为 _total
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :return: (预编译的语句, 参数)
+        """
+        if query is None:
+            query = {}
+        query = cls.reformatter(ctx=ctx, data=query)
+        table = cls.__db__[cls.__tablename__]
+        order_by, sorter_shape = cls._order_by(table, sorter, query)
+        limit, offset = pager_limit_offset(pager)
+        cursor = pager.cursor if pager is not None else None
+        cursor_values = []
+        if cursor is not None:
+            columns = cls._cursor_columns(table, sorter)
+            desc = sorter.desc if sorter else True
+            if cursor:
+                cursor_values = decode_cursor(cursor, columns)
+            sorter_shape = ('cursor', tuple(c.name for c in columns), bool(desc), bool(cursor_values))
+        # 游标分页需要查询排序字段
+        required = [c.name for c in cls._cursor_columns(table, sorter)] if cursor is not None else None
+        select_list = select_columns(table, fields, required=required)
+        fields_shape = tuple(c.name for c in select_list) if fields else None
+
+        def build():
+            if with_total:
+                sql = select(select_list + [func.count().over().label('_total')])
+            else:
+                sql = select(select_list)
+            if query:
+                sql = search_sql(sql, query, table, bind=True, fulltext=cls.__fulltext__)
+            if limit is not None:
+                sql = sql.limit(bindparam('_limit', type_=Integer))
+            if offset is not None:
+                sql = sql.offset(bindparam('_offset', type_=Integer))
+            if cursor is None:
+                if order_by is not None:
+                    sql = sql.order_by(order_by)
+                return sql
+            compare = operator.lt if desc else operator.gt
+            if cursor_values:
+                binds = [bindparam('_cursor%d' % i, type_=c.type) for i, c in enumerate(columns)]
+                if len(columns) == 1:
+                    sql = sql.where(compare(columns[0], binds[0]))
+                else:
+                    sql = sql.where(or_(compare(columns[0], binds[0]),
+                                        and_(columns[0] == binds[0], compare(columns[1], binds[1]))))
+            return sql.order_by(*[c.desc() if desc else c for c in columns])
+
+        sql = cls._compile(('query', query_shape(query), limit is not None, offset is not None, sorter_shape,
+                            with_total, fields_shape), build)
+        params = search_sql_params(query)
+        if limit is not None:
+            params['_limit'] = limit
+        if offset is not None:
+            params['_offset'] = offset
+        for i, value in enumerate(cursor_values):
+            params['_cursor%d' % i] = value
+        cls._advise(query, sorter_shape and (sorter_shape[1][0] if cursor is not None else sorter_shape[0]), sql,
+                    params)
+        return sql, params
+
+    @classmethod
+    def _next_cursor(cls, data: list, pager: Pager = None, sorter: Sorter = None):
+        """
+        根据本页最后一行生成下一页的游标 写入 pager.next_cursor
+        :param data: 未格式化的行
+        :param pager:
+        :param sorter:
+        :return:
+        """
+        if pager is None:
+            return
+        limit, _ = pager_limit_offset(pager)
+        if not data or limit is None or len(data) < limit:
+            pager.next_cursor = None
+            return
+        table = cls.__db__[cls.__tablename__]
+        last = data[-1]
+        pager.next_cursor = encode_cursor([last[c.name] for c in cls._cursor_columns(table, sorter)])
+
+    @classmethod
+    def _total_strategy(cls, total: str, pager: Pager = None) -> str:
+        """
+        实际使用的总数查询方式
+        :param total:
+        :param pager:
+        :return:
+        """
+        if total == TOTAL_WINDOW:
+            # 游标分页时窗口函数只能数到游标之后的行
+            if (pager is not None and pager.cursor is not None) or not cls.__db__.supports_window_function():
+                return TOTAL_CONNECTION
+        return total
+
+    @classmethod
+    def _split_total(cls, data: list, count, pager: Pager = None, total: str = TOTAL_CONNECTION):
+        """
+        从查询结果中拆出总数 并写入 pager.has_more
+        :param data: 未格式化的行
+        :param count: 单独查询的总数
+        :param pager:
+        :param total:
+        :return: (行, 总数)
+        """
+        limit, offset = pager_limit_offset(pager)
+        if total == TOTAL_WINDOW:
+            if data:
+                count = data[0]['_total']
+            data = [{k: v for k, v in row.items() if k != '_total'} for row in data]
+        if total == TOTAL_HAS_MORE:
+            has_more = limit is not None and len(data) > limit
+            if has_more:
+                data = data[:limit]
+        else:
+            has_more = limit is not None and len(data) == limit and (count is None or (offset or 0) + limit < count)
+        if pager is not None:
+            pager.has_more = has_more
+        return data, count
+
+    @classmethod
+    def _count_sql(cls, ctx: EasyApiContext, query: dict = None):
+        """
+        生成count的sql
+        :param ctx:
+        :param query:
+        :return: (预编译的语句, 参数)
+        """
+        if query is None:
+            query = {}
+        query = cls.reformatter(ctx=ctx, data=query)
+        table = cls.__db__[cls.__tablename__]
+
+        def build():
+            sql = select([func.count('*')], from_obj=table)
+            if query:
+                sql = search_sql(sql, query, table, bind=True, fulltext=cls.__fulltext__)
+            return sql
+
+        sql = cls._compile(('count', query_shape(query)), build)
+        params = search_sql_params(query)
+        cls._advise(query, None, sql, params)
+        return sql, params
+
+    @classmethod
+    def _cache_key(cls, id, scoped: bool) -> str:
+        return '{}:{}:{}'.format(cls.__tablename__, id, 'scoped' if scoped else 'all')
+
+    @classmethod
+    def _get_cache_key(cls, ctx: EasyApiContext, query: dict = None):
+        """
+        get 可以使用缓存时返回缓存的key
+        只缓存按id的查询 事务里不读也不写缓存
+        按 reformatter 之后的条件判断 reformatter 加了其他条件 例如按租户过滤 时不缓存
+        :param ctx:
+        :param query:
+        :return:
+        """
+        if cls.__cache__ is None or ctx.tx is not None or not query:
+            return None
+        query = cls.reformatter(ctx=ctx, data=query)
+        if query.keys() == {'id'}:
+            scoped = False
+        elif query.keys() == {'id', 'deleted_at'} and query['deleted_at'] is None:
+            scoped = True
+        else:
+            return None
+        if isinstance(query['id'], (list, tuple, dict)) or query['id'] is None:
+            return None
+        return cls._cache_key(query['id'], scoped)
+
+    @classmethod
+    def _invalidate(cls, ctx: EasyApiContext, where_dict: dict = None, ids: list = None):
+        """
+        修改后让缓存失效 事务里推迟到提交后
+        在语句执行之后调用 避免并发的读取在写入之前把旧数据放回缓存
+        :param ctx:
+        :param where_dict: 修改的条件 有 id 时只让这个id失效
+        :param ids: 修改的id 为 None 时按 where_dict 判断
+        :return:
+        """
+        cache = cls.__cache__
+        if cache is None:
+            return
+        if ids is None and where_dict and where_dict.get('id') is not None:
+            ids = [where_dict['id']]
+        if ids is None:
+            ctx.after_commit(lambda: cache.clear(cls.__tablename__ + ':'))
+        else:
+            keys = [cls._cache_key(_id, scoped) for _id in ids for scoped in (False, True)]
+            ctx.after_commit(lambda: cache.delete(keys))
+
+    @classmethod
+    def _upsert_ids(cls, rows: list, conflict_keys: list):
+        if conflict_keys == ['id'] and all(row.get('id') is not None for row in rows):
+            return [row['id'] for row in rows]
+        return None
+
+    @classmethod
+    def _insert_sql(cls, ctx: EasyApiContext, data: dict):
+        """
+        生成插入的sql
+        :param ctx:
+        :param data:
+        :return:
+        """
+        table = cls.__db__[cls.__tablename__]
+        data = cls.reformatter(ctx=ctx, data=data)
+        return table.insert().values(**data)
+
+    @classmethod
+    def _chunk_rows(cls, rows: list, chunk_size: int = 1000):
+        """
+        把多行数据按 chunk_size 切块 字段不同的行不放在同一块里
+        :param rows:
+        :param chunk_size:
+        :return:
+        """
+        chunks = []
+        chunk = []
+        size = chunk_size
+        for row in rows:
+            if chunk and (len(chunk) >= size or row.keys() != chunk[0].keys()):
+                chunks.append(chunk)
+                chunk = []
+            if not chunk and cls.__db__.dialect.name == 'sqlite':
+                # sqlite 单条语句最多 999 个参数
+                size = max(1, min(chunk_size, 999 // max(1, len(row))))
+            chunk.append(row)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    @classmethod
+    def _insert_many_sqls(cls, ctx: EasyApiContext, rows: list, chunk_size: int = 1000):
+        """
+        把多行数据切成多条 multi-values 的插入语句
+        :param ctx:
+        :param rows:
+        :param chunk_size: 每条语句最多插入的行数
+        :return: [(sql, 这条语句插入的行), ...]
+        """
+        table = cls.__db__[cls.__tablename__]
+        rows = [cls.reformatter(ctx=ctx, data=row) for row in rows]
+        statements = []
+        for chunk in cls._chunk_rows(rows, chunk_size):
+            sql = table.insert().values(chunk)
+            if cls.__db__.dialect.name == 'postgresql':
+                sql = sql.returning(table.c.id)
+            statements.append((sql, chunk))
+        return statements
+
+    @classmethod
+    def _upsert_sqls(cls, ctx: EasyApiContext, rows: list, conflict_keys: list, update_cols: list = None,
+                     chunk_size: int = 1000):
+        """
+        生成插入或更新的语句
+        mysql: INSERT ... ON DUPLICATE KEY UPDATE 冲突由表上任意唯一索引判断
+        postgresql / sqlite: INSERT ... ON CONFLICT (conflict_keys) DO UPDATE
+        :param ctx:
+        :param rows:
+        :param conflict_keys: 判断冲突的字段 需要有唯一索引
+        :param update_cols: 冲突时更新的字段 默认是除 conflict_keys 以外插入的字段
+        :param chunk_size:
+        :return: [sql, ...]
+        """
+        table = cls.__db__[cls.__tablename__]
+        dialect = cls.__db__.dialect.name
+        rows = [cls.reformatter(ctx=ctx, data=row) for row in rows]
+        statements = []
+        for chunk in cls._chunk_rows(rows, chunk_size):
+            cols = update_cols
+            if cols is None:
+                cols = [k for k in chunk[0].keys() if k not in conflict_keys]
+            if dialect == 'mysql':
+                sql = mysql_insert(table).values(chunk)
+                if cols:
+                    sql = sql.on_duplicate_key_update(**{c: sql.inserted[c] for c in cols})
+                else:
+                    sql = sql.on_duplicate_key_update(**{conflict_keys[0]: table.c[conflict_keys[0]]})
+            elif dialect == 'postgresql':
+                sql = postgresql_insert(table).values(chunk)
+                if cols:
+                    sql = sql.on_conflict_do_update(index_elements=conflict_keys,
+                                                    set_={c: sql.excluded[c] for c in cols})
+                else:
+                    sql = sql.on_conflict_do_nothing(index_elements=conflict_keys)
+            elif dialect == 'sqlite':
+                sql = SqliteUpsert(table, conflict_keys, cols).values(chunk)
+            else:
+                raise NotImplementedError("upsert is not supported on {}".format(dialect))
+            statements.append(sql)
+        return statements
+
+    @classmethod
+    def _update_many_sqls(cls, ctx: EasyApiContext, rows: list, key: str = 'id', where_dict: dict = None,
+                          chunk_size: int = 500):
+        """
+        每行的值不同的批量修改 一块生成一条语句
+        UPDATE ... SET col = CASE key WHEN .. THEN .. ELSE col END WHERE key IN (...)
+        :param ctx:
+        :param rows: 每行需要带 key 字段
+        :param key:
+        :param where_dict: 附加的条件
+        :param chunk_size:
+        :return: [sql, ...]
+        """
+        if where_dict is None:
+            where_dict = {}
+        where_dict = cls.reformatter(ctx, where_dict)
+        table = cls.__db__[cls.__tablename__]
+        rows = [cls.reformatter(ctx, row) for row in rows]
+        statements = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            keys = [row[key] for row in chunk]
+            values = {}
+            for row in chunk:
+                for col in row.keys():
+                    if col != key and col not in values:
+                        values[col] = case([(r[key], r[col]) for r in chunk if col in r],
+                                           value=table.c[key], else_=table.c[col])
+            sql = table.update().where(table.c[key].in_(keys))
+            for k, v in where_dict.items():
+                if hasattr(table.c, k):
+                    sql = sql.where(getattr(table.c, k) == v)
+            statements.append(sql.values(**values))
+        return statements
+
+    @classmethod
+    def _inserted_ids(cls, res, chunk: list):
+        """
+        multi-values 插入生成的id 拿不到时返回 None
+        :param res:
+        :param chunk: 插入的行
+        :return:
+        """
+        dialect = cls.__db__.dialect
+        if dialect.name == 'postgresql':
+            return [row[0] for row in res.fetchall()]
+        if 'id' in chunk[0]:
+            return [row['id'] for row in chunk]
+        if dialect.name == 'sqlite' and res.lastrowid:
+            # sqlite 同时只有一个写入 一条语句生成的 id 是连续的
+            return list(range(res.lastrowid - len(chunk) + 1, res.lastrowid + 1))
+        return None
+
+    @classmethod
+    def _update_sql(cls, ctx: EasyApiContext, where_dict: dict = None, data: dict = None):
+        """
+        生成修改的sql
+        :param ctx:
+        :param where_dict:
+        :param data:
+        :return:
+        """
+        if where_dict is None:
+            where_dict = {}
+        where_dict = cls.reformatter(ctx, where_dict)
+        table = cls.__db__[cls.__tablename__]
+        data = cls.reformatter(ctx, data)
+        sql = table.update()
+        if where_dict is not None:
+            for key, value in where_dict.items():
+                if hasattr(table.c, key):
+                    sql = sql.where(getattr(table.c, key) == value)
+        return sql.values(**data)
+
+    @classmethod
+    def _delete_sql(cls, ctx: EasyApiContext, where_dict: dict = None):
+        """
+        生成删除的sql
+        :param ctx:
+        :param where_dict:
+        :return:
+        """
+        if where_dict is None:
+            where_dict = {}
+        where_dict = cls.reformatter(ctx, where_dict)
+        table = cls.__db__[cls.__tablename__]
+        sql = table.delete()
+        for key, value in where_dict.items():
+            if hasattr(table.c, key):
+                sql = sql.where(getattr(table.c, key) == value)
+        return sql
+
+    @classmethod
+    @operation('get')
+    def get(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None, fields: list = None):
+        """
+        通用get查询
+        :param ctx:
+        :param query:
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        cache_key = cls._get_cache_key(ctx, query) if not fields else None
+        if cache_key is not None:
+            data = cls.__cache__.get(cache_key)
+            if data is not None:
+                return cls.formatter(ctx, data)
+        sql, params = cls._get_sql(ctx=ctx, query=query, sorter=sorter, fields=fields)
+        res = cls.__db__.execute(ctx, sql, params)
+        data = res.first()
+        if not data:
+            return None
+        if cache_key is not None:
+            cls.__cache__.set(cache_key, dict(data))
+        return cls.formatter(ctx, data)
+
+    @classmethod
+    @operation('get_many')
+    def get_many(cls, ctx: EasyApiContext = None, ids: list = None):
+        """
+        按id批量查询 一条 IN 语句
+        :param ctx:
+        :param ids:
+        :return: 和 ids 顺序相同 不存在的为 None
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not ids:
+            return []
+        data = cls.query(ctx=ctx, query={'_in_id': list(dict.fromkeys(ids))})
+        id_dict = {d['id']: d for d in data}
+        return [id_dict.get(_id) for _id in ids]
+
+    @classmethod
+    def _loader(cls, ctx: EasyApiContext):
+        return ctx.loader((cls, 'id'), lambda: DataLoader(lambda ids: cls.get_many(ctx=ctx, ids=ids)))
+
+    @classmethod
+    @operation('load')
+    def load(cls, ctx: EasyApiContext, id):
+        """
+        请求内按id读取 结果在 ctx 内记忆 配合 load_many 避免 N+1 查询
+        :param ctx:
+        :param id:
+        :return:
+        """
+        return cls._loader(ctx).load(id)
+
+    @classmethod
+    @operation('load_many')
+    def load_many(cls, ctx: EasyApiContext, ids: list):
+        """
+        请求内按id批量读取 没有读过的id合并成一次查询
+        :param ctx:
+        :param ids:
+        :return: 和 ids 顺序相同 不存在的为 None
+        """
+        return cls._loader(ctx).load_many(ids)
+
+    @classmethod
+    @operation('query')
+    def query(cls, ctx: EasyApiContext = None, query: Pager = None, pager: Pager = None, sorter: Sorter = None,
+              fields: list = None):
+        """
+        通用query查询
+        :param ctx:
+        :param query:
+        :param pager:
+        :param sorter:
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        sql, params = cls._query_sql(ctx=ctx, query=query, pager=pager, sorter=sorter, fields=fields)
+        res = cls.__db__.execute(ctx, sql, params)
+        data = res.fetchall()
+        cls._next_cursor(data, pager=pager, sorter=sorter)
+        return cls.format_many(ctx=ctx, rows=data)
+
+    @classmethod
+    def iter_query(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None,
+                   chunk_size: int = 1000, fields: list = None):
+        """
+        流式查询 使用服务端游标每次读取 chunk_size 行 不分页
+        :param ctx:
+        :param query:
+        :param sorter:
+        :param chunk_size:
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :return: 生成器 逐行产出格式化后的数据
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        sql, params = cls._query_sql(ctx=ctx, query=query, sorter=sorter, fields=fields)
+        with operation_scope(cls, 'iter_query'):
+            res = cls.__db__.stream(ctx, sql, params)
+        try:
+            while True:
+                rows = res.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from cls.format_many(ctx=ctx, rows=rows)
+        finally:
+            res.close()
+
+    @classmethod
+    @operation('query_with_total')
+    def query_with_total(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None,
+                         sorter: Sorter = None, total: str = TOTAL_CONNECTION, fields: list = None):
+        """
+        查询一页数据和总数
+        :param ctx:
+        :param query:
+        :param pager:
+        :param sorter:
+        :param total: 总数的查询方式 见 easyapi.sql.TOTAL_*
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :return: (数据, 总数) has_more 方式总数为 None 结果写在 pager.has_more
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if total == TOTAL_COUNT:
+            data = cls.query(ctx=ctx, query=query, pager=pager, sorter=sorter, fields=fields)
+            count = cls.count(ctx=ctx, query=query)
+            cls._split_total(data, count, pager=pager, total=total)
+            return data, count
+        total = cls._total_strategy(total, pager=pager)
+        sql, params = cls._query_sql(ctx=ctx, query=query, pager=pager, sorter=sorter,
+                                     with_total=total == TOTAL_WINDOW, fields=fields)
+        count = None
+        if total == TOTAL_CONNECTION:
+            count_sql, count_params = cls._count_sql(ctx=ctx, query=query)
+            data, count_rows = cls.__db__.execute_batch(ctx, [(sql, params), (count_sql, count_params)])
+            count = count_rows[0][0]
+        else:
+            if total == TOTAL_HAS_MORE and '_limit' in params:
+                params['_limit'] += 1
+            data = cls.__db__.execute(ctx, sql, params).fetchall()
+        data, count = cls._split_total(data, count, pager=pager, total=total)
+        if total == TOTAL_WINDOW and count is None:
+            # 超出最后一页时窗口函数拿不到总数
+            count_sql, count_params = cls._count_sql(ctx=ctx, query=query)
+            count = cls.__db__.execute(ctx, count_sql, count_params).scalar()
+        cls._next_cursor(data, pager=pager, sorter=sorter)
+        return cls.format_many(ctx=ctx, rows=data), count
+
+    @classmethod
+    @operation('insert')
+    def insert(cls, ctx: EasyApiContext = None, data: dict = None):
+        """
+        通用插入
+        :param ctx:
+        :param data:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if data is None:
+            return None
+        unit_of_work = get_unit_of_work(ctx.tx)
+        if unit_of_work is not None:
+            # 缓冲的插入在 flush 之前拿不到 id
+            unit_of_work.insert(cls, [cls.reformatter(ctx=ctx, data=data)])
+            return None
+        sql = cls._insert_sql(ctx=ctx, data=data)
+        res = cls.__db__.execute(ctx=ctx, sql=sql)
+        return res.inserted_primary_key[0]
+
+    @classmethod
+    @operation('insert_many')
+    def insert_many(cls, ctx: EasyApiContext = None, rows: list = None, chunk_size: int = 1000):
+        """
+        批量插入 每 chunk_size 行一条语句
+        不在事务里时每条语句单独提交
+        :param ctx:
+        :param rows:
+        :param chunk_size:
+        :return: 生成的id 数据库拿不到时返回 None
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not rows:
+            return []
+        unit_of_work = get_unit_of_work(ctx.tx)
+        if unit_of_work is not None:
+            unit_of_work.insert(cls, [cls.reformatter(ctx=ctx, data=row) for row in rows])
+            return None
+        ids = []
+        for sql, chunk in cls._insert_many_sqls(ctx=ctx, rows=rows, chunk_size=chunk_size):
+            res = cls.__db__.execute(ctx, sql)
+            chunk_ids = cls._inserted_ids(res, chunk)
+            ids = None if ids is None or chunk_ids is None else ids + chunk_ids
+        return ids
+
+    @classmethod
+    @operation('upsert')
+    def upsert(cls, ctx: EasyApiContext = None, data: dict = None, conflict_keys: list = None,
+               update_cols: list = None):
+        """
+        插入 冲突时更新
+        :param ctx:
+        :param data:
+        :param conflict_keys: 判断冲突的字段 默认 id
+        :param update_cols: 冲突时更新的字段 默认是除 conflict_keys 以外插入的字段
+        :return: 影响的行数
+        """
+        if data is None:
+            return 0
+        return cls.upsert_many(ctx=ctx, rows=[data], conflict_keys=conflict_keys, update_cols=update_cols)
+
+    @classmethod
+    @operation('upsert_many')
+    def upsert_many(cls, ctx: EasyApiContext = None, rows: list = None, conflict_keys: list = None,
+                    update_cols: list = None, chunk_size: int = 1000):
+        """
+        批量插入 冲突时更新
+        :param ctx:
+        :param rows:
+        :param conflict_keys: 判断冲突的字段 默认 id
+        :param update_cols: 冲突时更新的字段 默认是除 conflict_keys 以外插入的字段
+        :param chunk_size:
+        :return: 影响的行数
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not rows:
+            return 0
+        if not conflict_keys:
+            conflict_keys = ['id']
+        ctx.clear_loaders(cls)
+        count = 0
+        try:
+            for sql in cls._upsert_sqls(ctx=ctx, rows=rows, conflict_keys=conflict_keys, update_cols=update_cols,
+                                        chunk_size=chunk_size):
+                res = cls.__db__.execute(ctx, sql)
+                count += res.rowcount
+        finally:
+            cls._invalidate(ctx, ids=cls._upsert_ids(rows, conflict_keys))
+        return count
+
+    @classmethod
+    @operation('update_many')
+    def update_many(cls, ctx: EasyApiContext = None, rows: list = None, key: str = 'id', where_dict: dict = None,
+                    chunk_size: int = 500):
+        """
+        每行的值不同的批量修改 每 chunk_size 行一条 CASE 语句
+        :param ctx:
+        :param rows: 每行需要带 key 字段
+        :param key:
+        :param where_dict: 附加的条件
+        :param chunk_size:
+        :return: 影响的行数
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not rows:
+            return 0
+        ctx.clear_loaders(cls)
+        count = 0
+        try:
+            for sql in cls._update_many_sqls(ctx=ctx, rows=rows, key=key, where_dict=where_dict,
+                                             chunk_size=chunk_size):
+                res = cls.__db__.execute(ctx, sql)
+                count += res.rowcount
+        finally:
+            cls._invalidate(ctx, ids=[row[key] for row in rows] if key == 'id' else None)
+        return count
+
+    @classmethod
+    @operation('count')
+    def count(cls, ctx: EasyApiContext = None, query: dict = None):
+        """
+        插入
+        :param ctx:
+        :param query:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        sql, params = cls._count_sql(ctx=ctx, query=query)
+        res = cls.__db__.execute(ctx, sql, params)
+        return res.scalar()
+
+    @classmethod
+    @operation('execute')
+    def execute(cls, ctx: EasyApiContext = None, sql='SELECT 1', *args, **kwargs):
+        """
+        直接执行sql
+        :param ctx:
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        res = cls.__db__.execute(ctx=ctx, sql=sql, *args, **kwargs)
+        return res
+
+    @classmethod
+    @operation('update')
+    def update(cls, ctx: EasyApiContext = None, where_dict: dict = None, data: dict = None, *args, **kwargs):
+        """
+        通用修改
+        :param ctx:
+        :param where_dict:
+        :param data:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        ctx.clear_loaders(cls)
+        try:
+            unit_of_work = get_unit_of_work(ctx.tx)
+            if unit_of_work is not None:
+                # 缓冲的修改在 flush 之前不知道影响的行数
+                unit_of_work.update(cls, cls.reformatter(ctx, where_dict or {}), cls.reformatter(ctx, data))
+                return None
+            sql = cls._update_sql(ctx=ctx, where_dict=where_dict, data=data)
+            res = cls.__db__.execute(ctx=ctx, sql=sql)
+            return res.rowcount
+        finally:
+            cls._invalidate(ctx, where_dict=where_dict)
+
+    @classmethod
+    @operation('delete')
+    def delete(cls, ctx: EasyApiContext = None, where_dict: dict = None, *args, **kwargs):
+        """
+        通用删除
+        :param ctx:
+        :param where_dict:
+        :param data:
+        :return:
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        ctx.clear_loaders(cls)
+        try:
+            unit_of_work = get_unit_of_work(ctx.tx)
+            if unit_of_work is not None:
+                unit_of_work.delete(cls, cls.reformatter(ctx, where_dict or {}))
+                return None
+            sql = cls._delete_sql(ctx=ctx, where_dict=where_dict)
+            res = cls.__db__.execute(ctx=ctx, sql=sql)
+            return res.rowcount
+        finally:
+            cls._invalidate(ctx, where_dict=where_dict)
+
+
+class BusinessBaseDao(BaseDao):
+
+    @classmethod
+    def formatter(cls, ctx: EasyApiContext = None, data: dict = None):
+        """
+        将dao数据转换成model数据
+        :param data:
+        :return:
+        """
+        return super().formatter(ctx=ctx, data=data)
+
+    @classmethod
+    def reformatter(cls, ctx: EasyApiContext = None, data: dict = None):
+        """
+        将model数据转换成dao数据
+        :param data:
+            unscoped: 是否处理软删除
+        :return:
+        """
+        return super().reformatter(ctx=ctx, data=data)
+
+    @classmethod
+    @operation('update')
+    def update(cls, ctx: EasyApiContext = None, data: dict = None, where_dict: dict = None, unscoped=False,
+               modify_by: str = ''):
+        """
+        业务修改
+        :param ctx:
+        :param where_dict: 修改数据的条件
+        :param unscoped: 是否可以查询到被软删除的
+        :param data: 修改的数据
+        :param modify_by: 修改用户
+        :return:
+        """
+        if where_dict is None:
+            where_dict = {}
+        data = {**data, 'updated_at': datetime.datetime.now()}
+        if modify_by:
+            data['updated_by'] = modify_by
+        if not unscoped:
+            where_dict = {**where_dict, 'deleted_at': None}
+        return super().update(ctx=ctx, where_dict=where_dict, data=data)
+
+    @classmethod
+    @operation('delete')
+    def delete(cls, ctx: EasyApiContext = None, where_dict: dict = None, unscoped=False, modify_by: str = ''):
+        """
+        业务删除
+        :param ctx:
+        :param where_dict:
+        :param unscoped: 是否可以查询到被软删除的
+        :param modify_by:
+        :return:
+        """
+        if where_dict is None:
+            where_dict = {}
+        data = dict()
+        data['deleted_at'] = datetime.datetime.now()
+        if modify_by:
+            data['updated_by'] = modify_by
+        if not unscoped:
+            where_dict = {**where_dict, 'deleted_at': None}
+        return super().update(ctx=ctx, where_dict=where_dict, data=data)
+
+    @classmethod
+    @operation('insert')
+    def insert(cls, ctx: EasyApiContext = None, data: dict = None, modify_by=''):
+        """
+        业务插入
+        :param ctx:
+        :param data:
+        :param modify_by:
+        :return:
+        """
+        if data is None:
+            data = {}
+        data = {**data, 'created_at': datetime.datetime.now()}
+        if modify_by:
+            data['created_by'] = modify_by
+        return super().insert(ctx=ctx, data=data)
+
+    @classmethod
+    @operation('insert_many')
+    def insert_many(cls, ctx: EasyApiContext = None, rows: list = None, chunk_size: int = 1000, modify_by=''):
+        """
+        业务批量插入 整批使用同一个创建时间
+        :param ctx:
+        :param rows:
+        :param chunk_size:
+        :param modify_by:
+        :return:
+        """
+        if not rows:
+            return []
+        business = {'created_at': datetime.datetime.now()}
+        if modify_by:
+            business['created_by'] = modify_by
+        rows = [{**row, **business} for row in rows]
+        return super().insert_many(ctx=ctx, rows=rows, chunk_size=chunk_size)
+
+    @classmethod
+    @operation('upsert_many')
+    def upsert_many(cls, ctx: EasyApiContext = None, rows: list = None, conflict_keys: list = None,
+                    update_cols: list = None, chunk_size: int = 1000, modify_by=''):
+        """
+        业务批量插入或更新 新行写入创建时间 冲突时只更新修改时间
+        :param ctx:
+        :param rows:
+        :param conflict_keys:
+        :param update_cols:
+        :param chunk_size:
+        :param modify_by:
+        :return:
+        """
+        if not rows:
+            return 0
+        if not conflict_keys:
+            conflict_keys = ['id']
+        now = datetime.datetime.now()
+        business = {'created_at': now, 'updated_at': now}
+        if modify_by:
+            business['created_by'] = modify_by
+            business['updated_by'] = modify_by
+        rows = [{**row, **business} for row in rows]
+        if update_cols is None:
+            update_cols = [k for k in rows[0].keys() if k not in conflict_keys]
+        update_cols = [c for c in update_cols if c not in ('created_at', 'created_by')]
+        for c in business.keys():
+            if c not in ('created_at', 'created_by') and c not in update_cols:
+                update_cols.append(c)
+        return super().upsert_many(ctx=ctx, rows=rows, conflict_keys=conflict_keys, update_cols=update_cols,
+                                 chunk_size=chunk_size)
+
+    @classmethod
+    @operation('update_many')
+    def update_many(cls, ctx: EasyApiContext = None, rows: list = None, key: str = 'id', where_dict: dict = None,
+                    chunk_size: int = 500, unscoped=False, modify_by: str = ''):
+        """
+        业务批量修改
+        :param ctx:
+        :param rows:
+        :param key:
+        :param where_dict:
+        :param chunk_size:
+        :param unscoped: 是否可以修改被软删除的
+        :param modify_by:
+        :return:
+        """
+        if where_dict is None:
+            where_dict = {}
+        if not unscoped:
+            where_dict = {**where_dict, 'deleted_at': None}
+        business = {'updated_at': datetime.datetime.now()}
+        if modify_by:
+            business['updated_by'] = modify_by
+        rows = [{**row, **business} for row in rows or []]
+        return super().update_many(ctx=ctx, rows=rows, key=key, where_dict=where_dict, chunk_size=chunk_size)
+
+    @classmethod
+    @operation('get')
+    def get(cls, ctx: EasyApiContext = None, query=None, sorter: Sorter = None, unscoped=False,
+            fields: list = None):
+        """
+        业务查询get
+        :param ctx:
+        :param query:
+        :param unscoped: 是否可以查询到被软删除的
+        :param fields: 查询的字段
+        :return:
+        """
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return super().get(ctx=ctx, query=query, sorter=sorter, fields=fields)
+
+    @classmethod
+    @operation('query')
+    def query(cls, ctx: EasyApiContext = None, query: Pager = None, pager: Pager = None, sorter: Sorter = None,
+              unscoped=False, fields: list = None):
+        """
+        业务查询query
+        :param ctx:
+        :param query:
+        :param pager:
+        :param sorter:
+        :param unscoped:
+        :param fields:
+        :return:
+        """
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return super().query(ctx=ctx, query=query, pager=pager, sorter=sorter, fields=fields)
+
+    @classmethod
+    def iter_query(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None,
+                   chunk_size: int = 1000, fields: list = None, unscoped=False):
+        """
+        业务流式查询
+        :param ctx:
+        :param query:
+        :param sorter:
+        :param chunk_size:
+        :param fields:
+        :param unscoped:
+        :return:
+        """
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return super().iter_query(ctx=ctx, query=query, sorter=sorter, chunk_size=chunk_size, fields=fields)
+
     @classmethod
-    def reformatter(cls, ctx: EasyApiContext = None, data: dict = None):
+    @operation('query_with_total')
+    def query_with_total(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None,
+                         sorter: Sorter = None, total: str = TOTAL_CONNECTION, unscoped=False,
+                         fields: list = None):
         """
-        将model数据转换成dao数据
+        业务查询一页数据和总数
         :param ctx:
-        :param data:
+        :param query:
+        :param pager:
+        :param sorter:
+        :param total:
+        :param unscoped:
+        :param fields:
         :return:
         """
-        if data is None:
-            return dict()
-        return data.copy()
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return super().query_with_total(ctx=ctx, query=query, pager=pager, sorter=sorter, total=total,
+                                        fields=fields)
 
     @classmethod
-    def formatter(cls, ctx: EasyApiContext = None, data: dict = None):
+    @operation('count')
+    def count(cls, ctx: EasyApiContext = None, query: dict = None, unscoped=False):
         """
-        将dao数据转换成model数据
+        业务计数
         :param ctx:
-        :param data:
+        :param query:
+        :param unscoped: 是否可以查询到被软删除的
         :return:
         """
-        if data is None:
-            return dict()
-        return type_to_json(data)
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return super().count(ctx=ctx, query=query)
+
+
+class AsyncBaseDao(BaseDao):
+    """
+        异步dao 需要配合 AsyncMysqlDB / AsyncSqliteDB 使用
+    """
+
+    @classmethod
+    async def format_many(cls, ctx: EasyApiContext = None, rows: list = None) -> list:
+        """
+        格式化一页数据 每页调用一次 默认逐行调用 formatter
+        重写时可以在这里 await 批量查询关联数据
+        :param ctx:
+        :param rows: 数据库的行
+        :return:
+        """
+        return [cls.formatter(ctx=ctx, data=row) for row in rows]
 
     @classmethod
-    def get(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None):
+    @operation('get')
+    async def get(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None, fields: list = None):
         """
         通用get查询
         :param ctx:
         :param query:
-        :param args:
-        :param kwargs:
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :param sorter:
         :return:
         """
         if ctx is None:
             ctx = EasyApiContext()
-        if query is None:
-            query = {}
-        query = cls.reformatter(ctx=ctx, data=query)
-        table = cls.__db__[cls.__tablename__]
-        sql = select([table])
-        if query:
-            sql = search_sql(sql, query, table)
-        sql = sql.order_by(table.c.id.desc())
-        if sorter:
-            order_by = sorter.sort_by
-            desc = sorter.desc
-            if desc:
-                sql = sql.order_by(getattr(table.c, order_by, table.c.id).desc())
-            else:
-                sql = sql.order_by(getattr(table.c, order_by, table.c.id))
-        res = cls.__db__.execute(ctx=ctx, sql=sql)
+        cache_key = cls._get_cache_key(ctx, query) if not fields else None
+        if cache_key is not None:
+            data = cls.__cache__.get(cache_key)
+            if data is not None:
+                return cls.formatter(ctx, data)
+        sql, params = cls._get_sql(ctx=ctx, query=query, sorter=sorter, fields=fields)
+        res = await cls.__db__.execute(ctx, sql, params)
         data = res.first()
         if not data:
             return None
+        if cache_key is not None:
+            cls.__cache__.set(cache_key, dict(data))
         return cls.formatter(ctx, data)
 
     @classmethod
-    def query(cls, ctx: EasyApiContext = None, query: Pager = None, pager: Pager = None, sorter: Sorter = None):
+    @operation('get_many')
+    async def get_many(cls, ctx: EasyApiContext = None, ids: list = None):
+        """
+        按id批量查询 一条 IN 语句
+        :param ctx:
+        :param ids:
+        :return: 和 ids 顺序相同 不存在的为 None
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not ids:
+            return []
+        data = await cls.query(ctx=ctx, query={'_in_id': list(dict.fromkeys(ids))})
+        id_dict = {d['id']: d for d in data}
+        return [id_dict.get(_id) for _id in ids]
+
+    @classmethod
+    def _loader(cls, ctx: EasyApiContext):
+        return ctx.loader((cls, 'id'), lambda: AsyncDataLoader(lambda ids: cls.get_many(ctx=ctx, ids=ids)))
+
+    @classmethod
+    @operation('load')
+    async def load(cls, ctx: EasyApiContext, id):
+        """
+        请求内按id读取 同一轮事件循环里的 load 合并成一次查询 结果在 ctx 内记忆
+        :param ctx:
+        :param id:
+        :return:
+        """
+        return await cls._loader(ctx).load(id)
+
+    @classmethod
+    @operation('load_many')
+    async def load_many(cls, ctx: EasyApiContext, ids: list):
+        """
+        请求内按id批量读取
+        :param ctx:
+        :param ids:
+        :return: 和 ids 顺序相同 不存在的为 None
+        """
+        return await cls._loader(ctx).load_many(ids)
+
+    @classmethod
+    @operation('query')
+    async def query(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None, sorter: Sorter = None,
+                    fields: list = None):
         """
         通用query查询
         :param ctx:
         :param query:
         :param pager:
         :param sorter:
-        :param args:
-        :param kwargs:
+        :param fields: 查询的字段 为 None 时查询全部字段
         :return:
         """
         if ctx is None:
             ctx = EasyApiContext()
-        if query is None:
-            query = {}
-        query = cls.reformatter(ctx=ctx, data=query)
-        table = cls.__db__[cls.__tablename__]
-        sql = select([table])
-        if query:
-            sql = search_sql(sql, query, table)
-        if pager is not None:
-            per_page = pager.per_page
-            page = pager.page
-            if per_page:
-                sql = sql.limit(per_page)
-            if page:
-                if per_page is None:
-                    sql = sql.offset((page - 1) * 30).limit(30)
-                else:
-                    sql = sql.offset((page - 1) * per_page)
-        if sorter:
-            order_by = sorter.sort_by
-            desc = sorter.desc
-            if desc:
-                sql = sql.order_by(getattr(table.c, order_by, table.c.id).desc())
-            else:
-                sql = sql.order_by(getattr(table.c, order_by, table.c.id))
-        res = cls.__db__.execute(ctx=ctx, sql=sql)
+        sql, params = cls._query_sql(ctx=ctx, query=query, pager=pager, sorter=sorter, fields=fields)
+        res = await cls.__db__.execute(ctx, sql, params)
         data = res.fetchall()
-        return list(map(lambda  d : cls.formatter(ctx=ctx, data=d), data))
+        cls._next_cursor(data, pager=pager, sorter=sorter)
+        return await cls.format_many(ctx=ctx, rows=data)
 
     @classmethod
-    def insert(cls, ctx: EasyApiContext = None, data: dict = None):
+    async def iter_query(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None,
+                         chunk_size: int = 1000, fields: list = None):
+        """
+        流式查询 使用服务端游标每次读取 chunk_size 行 不分页
+        :param ctx:
+        :param query:
+        :param sorter:
+        :param chunk_size:
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :return: 异步生成器 逐行产出格式化后的数据
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        sql, params = cls._query_sql(ctx=ctx, query=query, sorter=sorter, fields=fields)
+        with operation_scope(cls, 'iter_query'):
+            stream = cls.__db__.stream(ctx, sql, params, chunk_size)
+        async for rows in stream:
+            for row in await cls.format_many(ctx=ctx, rows=rows):
+                yield row
+
+    @classmethod
+    @operation('query_with_total')
+    async def query_with_total(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None,
+                               sorter: Sorter = None, total: str = TOTAL_CONNECTION, fields: list = None):
+        """
+        查询一页数据和总数
+        :param ctx:
+        :param query:
+        :param pager:
+        :param sorter:
+        :param total: 总数的查询方式 见 easyapi.sql.TOTAL_*
+        :param fields: 查询的字段 为 None 时查询全部字段
+        :return: (数据, 总数) has_more 方式总数为 None 结果写在 pager.has_more
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if total == TOTAL_COUNT:
+            data = await cls.query(ctx=ctx, query=query, pager=pager, sorter=sorter, fields=fields)
+            count = await cls.count(ctx=ctx, query=query)
+            cls._split_total(data, count, pager=pager, total=total)
+            return data, count
+        total = cls._total_strategy(total, pager=pager)
+        sql, params = cls._query_sql(ctx=ctx, query=query, pager=pager, sorter=sorter,
+                                     with_total=total == TOTAL_WINDOW, fields=fields)
+        count = None
+        if total == TOTAL_CONNECTION:
+            count_sql, count_params = cls._count_sql(ctx=ctx, query=query)
+            data, count_rows = await cls.__db__.execute_batch(ctx, [(sql, params), (count_sql, count_params)])
+            count = next(iter(count_rows[0].values()))
+        else:
+            if total == TOTAL_HAS_MORE and '_limit' in params:
+                params['_limit'] += 1
+            data = (await cls.__db__.execute(ctx, sql, params)).fetchall()
+        data, count = cls._split_total(data, count, pager=pager, total=total)
+        if total == TOTAL_WINDOW and count is None:
+            # 超出最后一页时窗口函数拿不到总数
+            count_sql, count_params = cls._count_sql(ctx=ctx, query=query)
+            count = (await cls.__db__.execute(ctx, count_sql, count_params)).scalar()
+        cls._next_cursor(data, pager=pager, sorter=sorter)
+        return await cls.format_many(ctx=ctx, rows=data), count
+
+    @classmethod
+    @operation('insert')
+    async def insert(cls, ctx: EasyApiContext = None, data: dict = None):
         """
         通用插入
         :param ctx:
         :param data:
-        :param args:
-        :param kwargs:
         :return:
         """
         if ctx is None:
             ctx = EasyApiContext()
         if data is None:
             return None
-        table = cls.__db__[cls.__tablename__]
-        data = cls.reformatter(ctx=ctx, data=data)
-        sql = table.insert().values(**data)
-        res = cls.__db__.execute(ctx=ctx, sql=sql)
+        sql = cls._insert_sql(ctx=ctx, data=data)
+        res = await cls.__db__.execute(ctx=ctx, sql=sql)
         return res.inserted_primary_key[0]
 
     @classmethod
-    def count(cls, ctx: EasyApiContext = None, query: dict = None):
+    @operation('insert_many')
+    async def insert_many(cls, ctx: EasyApiContext = None, rows: list = None, chunk_size: int = 1000):
         """
-        插入
+        批量插入 每 chunk_size 行一条语句
+        不在事务里时每条语句单独提交
+        :param ctx:
+        :param rows:
+        :param chunk_size:
+        :return: 生成的id 数据库拿不到时返回 None
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not rows:
+            return []
+        ids = []
+        for sql, chunk in cls._insert_many_sqls(ctx=ctx, rows=rows, chunk_size=chunk_size):
+            res = await cls.__db__.execute(ctx, sql)
+            chunk_ids = cls._inserted_ids(res, chunk)
+            ids = None if ids is None or chunk_ids is None else ids + chunk_ids
+        return ids
+
+    @classmethod
+    @operation('upsert')
+    async def upsert(cls, ctx: EasyApiContext = None, data: dict = None, conflict_keys: list = None,
+                     update_cols: list = None):
+        """
+        插入 冲突时更新
+        :param ctx:
+        :param data:
+        :param conflict_keys: 判断冲突的字段 默认 id
+        :param update_cols: 冲突时更新的字段 默认是除 conflict_keys 以外插入的字段
+        :return: 影响的行数
+        """
+        if data is None:
+            return 0
+        return await cls.upsert_many(ctx=ctx, rows=[data], conflict_keys=conflict_keys, update_cols=update_cols)
+
+    @classmethod
+    @operation('upsert_many')
+    async def upsert_many(cls, ctx: EasyApiContext = None, rows: list = None, conflict_keys: list = None,
+                          update_cols: list = None, chunk_size: int = 1000):
+        """
+        批量插入 冲突时更新
+        :param ctx:
+        :param rows:
+        :param conflict_keys: 判断冲突的字段 默认 id
+        :param update_cols: 冲突时更新的字段 默认是除 conflict_keys 以外插入的字段
+        :param chunk_size:
+        :return: 影响的行数
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not rows:
+            return 0
+        if not conflict_keys:
+            conflict_keys = ['id']
+        ctx.clear_loaders(cls)
+        count = 0
+        try:
+            for sql in cls._upsert_sqls(ctx=ctx, rows=rows, conflict_keys=conflict_keys, update_cols=update_cols,
+                                        chunk_size=chunk_size):
+                res = await cls.__db__.execute(ctx, sql)
+                count += res.rowcount
+        finally:
+            cls._invalidate(ctx, ids=cls._upsert_ids(rows, conflict_keys))
+        return count
+
+    @classmethod
+    @operation('update_many')
+    async def update_many(cls, ctx: EasyApiContext = None, rows: list = None, key: str = 'id', where_dict: dict = None,
+                          chunk_size: int = 500):
+        """
+        每行的值不同的批量修改 每 chunk_size 行一条 CASE 语句
+        :param ctx:
+        :param rows: 每行需要带 key 字段
+        :param key:
+        :param where_dict: 附加的条件
+        :param chunk_size:
+        :return: 影响的行数
+        """
+        if ctx is None:
+            ctx = EasyApiContext()
+        if not rows:
+            return 0
+        ctx.clear_loaders(cls)
+        count = 0
+        try:
+            for sql in cls._update_many_sqls(ctx=ctx, rows=rows, key=key, where_dict=where_dict,
+                                             chunk_size=chunk_size):
+                res = await cls.__db__.execute(ctx, sql)
+                count += res.rowcount
+        finally:
+            cls._invalidate(ctx, ids=[row[key] for row in rows] if key == 'id' else None)
+        return count
+
+    @classmethod
+    @operation('count')
+    async def count(cls, ctx: EasyApiContext = None, query: dict = None):
+        """
+        计数
         :param ctx:
         :param query:
-        :param args:
-        :param kwargs:
         :return:
         """
         if ctx is None:
             ctx = EasyApiContext()
-        if query is None:
-            query = {}
-        query = cls.reformatter(ctx=ctx, data=query)
-        table = cls.__db__[cls.__tablename__]
-        sql = select([func.count('*')], from_obj=table)
-        if query:
-            sql = search_sql(sql, query, table)
-
-        res = cls.__db__.execute(ctx=ctx, sql=sql)
+        sql, params = cls._count_sql(ctx=ctx, query=query)
+        res = await cls.__db__.execute(ctx, sql, params)
         return res.scalar()
 
     @classmethod
-    def execute(cls, ctx: EasyApiContext = None, sql='SELECT 1', *args, **kwargs):
+    @operation('execute')
+    async def execute(cls, ctx: EasyApiContext = None, sql='SELECT 1', *args, **kwargs):
         """
         直接执行sql
         :param ctx:
@@ -201,83 +1533,55 @@ class BaseDao(metaclass=DaoMetaClass):
         """
         if ctx is None:
             ctx = EasyApiContext()
-        res = cls.__db__.execute(ctx=ctx, sql=sql, *args, **kwargs)
+        res = await cls.__db__.execute(ctx=ctx, sql=sql, *args, **kwargs)
         return res
 
     @classmethod
-    def update(cls, ctx: EasyApiContext = None, where_dict: dict = None, data: dict = None, *args, **kwargs):
+    @operation('update')
+    async def update(cls, ctx: EasyApiContext = None, where_dict: dict = None, data: dict = None, *args, **kwargs):
         """
         通用修改
         :param ctx:
         :param where_dict:
         :param data:
-        :param args:
-        :param kwargs:
         :return:
         """
         if ctx is None:
             ctx = EasyApiContext()
-        if where_dict is None:
-            where_dict = {}
-        where_dict = cls.reformatter(ctx, where_dict)
-        table = cls.__db__[cls.__tablename__]
-        data = cls.reformatter(ctx, data)
-        sql = table.update()
-        if where_dict is not None:
-            for key, value in where_dict.items():
-                if hasattr(table.c, key):
-                    sql = sql.where(getattr(table.c, key) == value)
-        sql = sql.values(**data)
-        res = cls.__db__.execute(ctx=ctx, sql=sql)
+        ctx.clear_loaders(cls)
+        sql = cls._update_sql(ctx=ctx, where_dict=where_dict, data=data)
+        try:
+            res = await cls.__db__.execute(ctx=ctx, sql=sql)
+        finally:
+            cls._invalidate(ctx, where_dict=where_dict)
         return res.rowcount
 
     @classmethod
-    def delete(cls, ctx: EasyApiContext = None, where_dict: dict = None, *args, **kwargs):
+    @operation('delete')
+    async def delete(cls, ctx: EasyApiContext = None, where_dict: dict = None, *args, **kwargs):
         """
         通用删除
         :param ctx:
         :param where_dict:
-        :param data:
         :return:
         """
         if ctx is None:
             ctx = EasyApiContext()
-        if where_dict is None:
-            where_dict = {}
-        where_dict = cls.reformatter(ctx, where_dict)
-        table = cls.__db__[cls.__tablename__]
-        sql = table.delete()
-        for key, value in where_dict.items():
-            if hasattr(table.c, key):
-                sql = sql.where(getattr(table.c, key) == value)
-        res = cls.__db__.execute(ctx=ctx, sql=sql)
+        ctx.clear_loaders(cls)
+        sql = cls._delete_sql(ctx=ctx, where_dict=where_dict)
+        try:
+            res = await cls.__db__.execute(ctx=ctx, sql=sql)
+        finally:
+            cls._invalidate(ctx, where_dict=where_dict)
         return res.rowcount
 
 
-class BusinessBaseDao(BaseDao):
-
-    @classmethod
-    def formatter(cls, ctx: EasyApiContext = None, data: dict = None):
-        """
-        将dao数据转换成model数据
-        :param data:
-        :return:
-        """
-        return super().formatter(ctx=ctx, data=data)
-
-    @classmethod
-    def reformatter(cls, ctx: EasyApiContext = None, data: dict = None):
-        """
-        将model数据转换成dao数据
-        :param data:
-            unscoped: 是否处理软删除
-        :return:
-        """
-        return super().reformatter(ctx=ctx, data=data)
+class AsyncBusinessBaseDao(AsyncBaseDao):
 
     @classmethod
-    def update(cls, ctx: EasyApiContext = None, data: dict = None, where_dict: dict = None, unscoped=False,
-               modify_by: str = ''):
+    @operation('update')
+    async def update(cls, ctx: EasyApiContext = None, data: dict = None, where_dict: dict = None, unscoped=False,
+                     modify_by: str = ''):
         """
         业务修改
         :param ctx:
@@ -289,15 +1593,16 @@ class BusinessBaseDao(BaseDao):
         """
         if where_dict is None:
             where_dict = {}
-        data['updated_at'] = datetime.datetime.now()
+        data = {**data, 'updated_at': datetime.datetime.now()}
         if modify_by:
             data['updated_by'] = modify_by
         if not unscoped:
-            where_dict['deleted_at'] = None
-        return super().update(ctx=ctx, where_dict=where_dict, data=data)
+            where_dict = {**where_dict, 'deleted_at': None}
+        return await super().update(ctx=ctx, where_dict=where_dict, data=data)
 
     @classmethod
-    def delete(cls, ctx: EasyApiContext = None, where_dict: dict = None, unscoped=False, modify_by: str = ''):
+    @operation('delete')
+    async def delete(cls, ctx: EasyApiContext = None, where_dict: dict = None, unscoped=False, modify_by: str = ''):
         """
         业务删除
         :param ctx:
@@ -313,11 +1618,12 @@ class BusinessBaseDao(BaseDao):
         if modify_by:
             data['updated_by'] = modify_by
         if not unscoped:
-            where_dict['deleted_at'] = None
-        return super().update(ctx=ctx, where_dict=where_dict, data=data)
+            where_dict = {**where_dict, 'deleted_at': None}
+        return await super().update(ctx=ctx, where_dict=where_dict, data=data)
 
     @classmethod
-    def insert(cls, ctx: EasyApiContext = None, data: dict = None, modify_by=''):
+    @operation('insert')
+    async def insert(cls, ctx: EasyApiContext = None, data: dict = None, modify_by=''):
         """
         业务插入
         :param ctx:
@@ -327,29 +1633,111 @@ class BusinessBaseDao(BaseDao):
         """
         if data is None:
             data = {}
-        data['created_at'] = datetime.datetime.now()
+        data = {**data, 'created_at': datetime.datetime.now()}
         if modify_by:
             data['created_by'] = modify_by
-        return super().insert(ctx=ctx, data=data)
+        return await super().insert(ctx=ctx, data=data)
 
     @classmethod
-    def get(cls, ctx: EasyApiContext = None, query=None, sorter: Sorter = None, unscoped=False):
+    @operation('insert_many')
+    async def insert_many(cls, ctx: EasyApiContext = None, rows: list = None, chunk_size: int = 1000,
+                          modify_by=''):
+        """
+        业务批量插入 整批使用同一个创建时间
+        :param ctx:
+        :param rows:
+        :param chunk_size:
+        :param modify_by:
+        :return:
+        """
+        if not rows:
+            return []
+        business = {'created_at': datetime.datetime.now()}
+        if modify_by:
+            business['created_by'] = modify_by
+        rows = [{**row, **business} for row in rows]
+        return await super().insert_many(ctx=ctx, rows=rows, chunk_size=chunk_size)
+
+    @classmethod
+    @operation('upsert_many')
+    async def upsert_many(cls, ctx: EasyApiContext = None, rows: list = None, conflict_keys: list = None,
+                          update_cols: list = None, chunk_size: int = 1000, modify_by=''):
+        """
+        业务批量插入或更新 新行写入创建时间 冲突时只更新修改时间
+        :param ctx:
+        :param rows:
+        :param conflict_keys:
+        :param update_cols:
+        :param chunk_size:
+        :param modify_by:
+        :return:
+        """
+        if not rows:
+            return 0
+        if not conflict_keys:
+            conflict_keys = ['id']
+        now = datetime.datetime.now()
+        business = {'created_at': now, 'updated_at': now}
+        if modify_by:
+            business['created_by'] = modify_by
+            business['updated_by'] = modify_by
+        rows = [{**row, **business} for row in rows]
+        if update_cols is None:
+            update_cols = [k for k in rows[0].keys() if k not in conflict_keys]
+        update_cols = [c for c in update_cols if c not in ('created_at', 'created_by')]
+        for c in business.keys():
+            if c not in ('created_at', 'created_by') and c not in update_cols:
+                update_cols.append(c)
+        return await super().upsert_many(ctx=ctx, rows=rows, conflict_keys=conflict_keys, update_cols=update_cols,
+                                         chunk_size=chunk_size)
+
+    @classmethod
+    @operation('update_many')
+    async def update_many(cls, ctx: EasyApiContext = None, rows: list = None, key: str = 'id', where_dict: dict = None,
+                          chunk_size: int = 500, unscoped=False, modify_by: str = ''):
+        """
+        业务批量修改
+        :param ctx:
+        :param rows:
+        :param key:
+        :param where_dict:
+        :param chunk_size:
+        :param unscoped: 是否可以修改被软删除的
+        :param modify_by:
+        :return:
+        """
+        if where_dict is None:
+            where_dict = {}
+        if not unscoped:
+            where_dict = {**where_dict, 'deleted_at': None}
+        business = {'updated_at': datetime.datetime.now()}
+        if modify_by:
+            business['updated_by'] = modify_by
+        rows = [{**row, **business} for row in rows or []]
+        return await super().update_many(ctx=ctx, rows=rows, key=key, where_dict=where_dict, chunk_size=chunk_size)
+
+    @classmethod
+    @operation('get')
+    async def get(cls, ctx: EasyApiContext = None, query=None, sorter: Sorter = None, unscoped=False,
+                  fields: list = None):
         """
         业务查询get
         :param ctx:
         :param query:
         :param unscoped: 是否可以查询到被软删除的
+        :param fields: 查询的字段
         :return:
         """
         if query is None:
             query = {}
         if not unscoped:
-            query['deleted_at'] = None
-        return super().get(ctx=ctx, query=query)
+            query = {**query, 'deleted_at': None}
+        return await super().get(ctx=ctx, query=query, sorter=sorter, fields=fields)
 
     @classmethod
-    def query(cls, ctx: EasyApiContext = None, query: Pager = None, pager: Pager = None, sorter: Sorter = None,
-              unscoped=False):
+    @operation('query')
+    async def query(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None, sorter: Sorter = None,
+                    unscoped=False, fields: list = None):
         """
         业务查询query
         :param ctx:
@@ -357,10 +1745,69 @@ class BusinessBaseDao(BaseDao):
         :param pager:
         :param sorter:
         :param unscoped:
+        :param fields:
+        :return:
+        """
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return await super().query(ctx=ctx, query=query, pager=pager, sorter=sorter, fields=fields)
+
+    @classmethod
+    def iter_query(cls, ctx: EasyApiContext = None, query: dict = None, sorter: Sorter = None,
+                   chunk_size: int = 1000, fields: list = None, unscoped=False):
+        """
+        业务流式查询
+        :param ctx:
+        :param query:
+        :param sorter:
+        :param chunk_size:
+        :param fields:
+        :param unscoped:
+        :return: 异步生成器
+        """
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return super().iter_query(ctx=ctx, query=query, sorter=sorter, chunk_size=chunk_size, fields=fields)
+
+    @classmethod
+    @operation('query_with_total')
+    async def query_with_total(cls, ctx: EasyApiContext = None, query: dict = None, pager: Pager = None,
+                               sorter: Sorter = None, total: str = TOTAL_CONNECTION, unscoped=False,
+                               fields: list = None):
+        """
+        业务查询一页数据和总数
+        :param ctx:
+        :param query:
+        :param pager:
+        :param sorter:
+        :param total:
+        :param unscoped:
+        :param fields:
+        :return:
+        """
+        if query is None:
+            query = {}
+        if not unscoped:
+            query = {**query, 'deleted_at': None}
+        return await super().query_with_total(ctx=ctx, query=query, pager=pager, sorter=sorter, total=total,
+                                              fields=fields)
+
+    @classmethod
+    @operation('count')
+    async def count(cls, ctx: EasyApiContext = None, query: dict = None, unscoped=False):
+        """
+        业务计数
+        :param ctx:
+        :param query:
+        :param unscoped: 是否可以查询到被软删除的
         :return:
         """
         if query is None:
             query = {}
         if not unscoped:
-            query['deleted_at'] = None
-        return super().query(ctx=ctx, query=query, pager=pager, sorter=sorter)
+            query = {**query, 'deleted_at': None}
+        return await super().count(ctx=ctx, query=query)
@@ -1,19 +1,195 @@
 import abc
-from sqlalchemy import create_engine, MetaData, Table
-from sqlalchemy.pool import QueuePool
+import atexit
+import bisect
+import contextvars
+import logging
+import os
+import pickle
+import queue
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from dataclasses import dataclass
+import sqlalchemy
+from sqlalchemy import create_engine, event, MetaData, Table
+from sqlalchemy.exc import OperationalError, DisconnectionError, TimeoutError, NoSuchTableError
+from sqlalchemy.engine.result import FullyBufferedResultProxy
+from sqlalchemy.pool import QueuePool, StaticPool, NullPool
+from sqlalchemy.sql.compiler import Compiled
+from sqlalchemy.sql.expression import Select
 from easyapi.context import EasyApiContext
-from easyapi.transcation import Transaction
-
-
-def get_mysql_engine(user, password, host, port, database, pool_size=100, echo=False):
-    print('mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset=utf8mb4'.format(
-        user=user,
-        password=password,
-        host=host,  # your host
-        port=port,
-        database=database,
-    ))
-    engine = create_engine(
+from easyapi.transcation import Transaction, flush, get_retry_stats
+from easyapi.instrument import AbcInstrument, begin_event, end_event, set_checkout_wait
+
+logger = logging.getLogger(__name__)
+
+
+# 取连接时的检查方式
+PRE_PING_ALWAYS = 'always'  # 每次取连接都 ping 一次
+PRE_PING_IDLE = 'idle'  # 连接空闲超过 pre_ping_idle 秒才 ping
+PRE_PING_NEVER = 'never'  # 不 ping 依赖 recycle
+
+
+@dataclass
+class PoolConfig:
+    """
+    连接池配置
+    """
+    size: int = 100
+    max_overflow: int = 10
+    recycle: int = 60  # 连接最长使用秒数 -1 不回收
+    pre_ping: str = PRE_PING_ALWAYS
+    pre_ping_idle: int = 30
+    timeout: int = 30  # 取连接最多等待秒数
+    warm_up: int = 0  # connect 时预先建立的连接数
+
+
+class PoolStats:
+    """
+    连接池的统计 取连接的次数 等待时间的分布 溢出和超时的次数
+    """
+    WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.checkouts = 0
+        self.connects = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.invalidated = 0
+        self.wait_total = 0.0
+        self.wait_histogram = [0] * (len(self.WAIT_BUCKETS) + 1)
+        self._lock = threading.Lock()
+        event.listen(engine, 'connect', self._on_connect)
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'invalidate', self._on_invalidate)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+            pool = self.engine.pool
+            if isinstance(pool, QueuePool) and pool.overflow() > 0:
+                self.overflows += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidated += 1
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.wait_total += seconds
+            self.wait_histogram[bisect.bisect_left(self.WAIT_BUCKETS, seconds)] += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        """
+        当前的统计
+        :return:
+        """
+        pool = self.engine.pool
+        with self._lock:
+            data = {
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'overflows': self.overflows,
+                'timeouts': self.timeouts,
+                'invalidated': self.invalidated,
+                'wait_total': self.wait_total,
+                'wait_histogram': dict(zip(['<={}'.format(b) for b in self.WAIT_BUCKETS] + ['>{}'.format(
+                    self.WAIT_BUCKETS[-1])], self.wait_histogram)),
+            }
+        if isinstance(pool, QueuePool):
+            data.update(size=pool.size(), checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+        return data
+
+
+_pool_stats = weakref.WeakKeyDictionary()
+# 已经监听 sql 执行的 engine
+_instrumented_engines = weakref.WeakSet()
+
+
+def get_pool_stats(engine) -> PoolStats:
+    return _pool_stats.get(engine)
+
+
+def _pool_kwargs(pool_config: PoolConfig) -> dict:
+    return {
+        'pool_size': pool_config.size,
+        'max_overflow': pool_config.max_overflow,
+        'pool_recycle': pool_config.recycle,
+        'pool_timeout': pool_config.timeout,
+        'pool_pre_ping': pool_config.pre_ping == PRE_PING_ALWAYS,
+    }
+
+
+def _ping_idle(engine, idle: int):
+    """
+    连接空闲超过 idle 秒时取连接前 ping 一次 失败时连接池换一个新连接
+    :param engine:
+    :param idle:
+    :return:
+    """
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        connection_record.info['checkin_at'] = time.monotonic()
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        checkin_at = connection_record.info.get('checkin_at')
+        if checkin_at is None or time.monotonic() - checkin_at < idle:
+            return
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            raise DisconnectionError()
+        finally:
+            cursor.close()
+
+
+def create_pooled_engine(url: str, pool_config: PoolConfig = None, echo=False, **kwargs):
+    """
+    按连接池配置创建 engine 并记录连接池统计
+    :param url:
+    :param pool_config: 为 None 时使用默认配置
+    :param echo:
+    :param kwargs:
+    :return:
+    """
+    pool_config = pool_config or PoolConfig()
+    engine = create_engine(url, echo=echo, **_pool_kwargs(pool_config), **kwargs)
+    if pool_config.pre_ping == PRE_PING_IDLE:
+        _ping_idle(engine, pool_config.pre_ping_idle)
+    _pool_stats[engine] = PoolStats(engine)
+    logger.info('create engine %r', engine.url)
+    return engine
+
+
+def warm_up(engine, count: int):
+    """
+    预先建立 count 个连接放回连接池
+    :param engine:
+    :param count:
+    :return:
+    """
+    connections = [engine.connect() for _ in range(count)]
+    for conn in connections:
+        conn.close()
+
+
+def get_mysql_engine(user, password, host, port, database, pool_size=100, echo=False, pool_config: PoolConfig = None):
+    return create_pooled_engine(
         'mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset=utf8mb4'.format(
             user=user,
             password=password,
@@ -21,23 +197,14 @@ def get_mysql_engine(user, password, host, port, database, pool_size=100, echo=F
             port=port,
             database=database,
         ),
-        pool_size=pool_size,
-        pool_recycle=60,
-        pool_pre_ping=True,
+        pool_config=pool_config or PoolConfig(size=pool_size),
         echo=echo
     )
-    return engine
 
 
-def get_postgre_engine(user, password, host, port, database, pool_size=100, echo=False):
-    print('postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}'.format(
-        user=user,
-        password=password,
-        host=host,  # your host
-        port=port,
-        database=database,
-    ))
-    engine = create_engine(
+def get_postgre_engine(user, password, host, port, database, pool_size=100, echo=False,
+                       pool_config: PoolConfig = None):
+    return create_pooled_engine(
         'postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}'.format(
             user=user,
             password=password,
@@ -45,33 +212,331 @@ def get_postgre_engine(user, password, host, port, database, pool_size=100, echo
             port=port,
             database=database,
         ),
-        pool_size=pool_size,
-        pool_recycle=60,
-        pool_pre_ping=True,
+        pool_config=pool_config or PoolConfig(size=pool_size),
         echo=echo
     )
-    return engine
 
 
-def get_sqlite_engine(database, pool_size=100, echo=False):
-    print('sqlite:///{}'.format(
-       database
-    ))
-    engine = create_engine(
-    'sqlite:///{}'.format(
-        database
-        ),
-        echo=echo
-    )
+# sqlite 连接的默认 pragma
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # 读和写可以并发
+    'synchronous': 'NORMAL',  # WAL 下不会损坏数据 掉电可能丢失最后提交的事务
+    'busy_timeout': 5000,  # 等待写锁的毫秒数
+    'cache_size': -16000,  # 每个连接 16MB 页缓存
+    'temp_store': 'MEMORY',
+}
+
+
+def _sqlite_pragmas(engine, pragmas: dict):
+    """
+    新连接执行 pragma 并由 sqlalchemy 管理事务
+    pysqlite 默认在写语句前隐式 BEGIN 和 savepoint 冲突 这里关掉 事务开始时显式 BEGIN IMMEDIATE
+    BEGIN IMMEDIATE 开始时就拿写锁 避免读后写的事务在 WAL 下因为快照过期而失败
+    :param engine:
+    :param pragmas:
+    :return:
+    """
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {} = {}'.format(name, value))
+        finally:
+            cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        # 只读事务不拿写锁
+        conn.execute('BEGIN' if conn._execution_options.get('sqlite_read_only') else 'BEGIN IMMEDIATE')
+
+
+def get_sqlite_engine(database, pool_size=100, echo=False, pool_config: PoolConfig = None, pragmas: dict = None,
+                      null_pool: bool = False):
+    """
+    文件数据库使用连接池 每个线程取自己的连接 内存数据库只有一个连接
+    :param database:
+    :param pool_size:
+    :param echo:
+    :param pool_config:
+    :param pragmas: 覆盖 SQLITE_PRAGMAS 的 pragma
+    :param null_pool: 文件数据库不使用连接池 每次取连接时新建 归还时关闭
+    :return:
+    """
+    url = 'sqlite:///{}'.format(database)
+    connect_args = {'check_same_thread': False}
+    if database in ('', ':memory:') or null_pool:
+        poolclass = NullPool if null_pool and database not in ('', ':memory:') else StaticPool
+        engine = create_engine(url, echo=echo, poolclass=poolclass, connect_args=connect_args)
+        _pool_stats[engine] = PoolStats(engine)
+        logger.info('create engine %r', engine.url)
+    else:
+        # sqlite 没有网络连接 不需要 ping 和回收
+        pool_config = pool_config or PoolConfig(size=pool_size, recycle=-1, pre_ping=PRE_PING_NEVER)
+        engine = create_pooled_engine(url, pool_config=pool_config, echo=echo, poolclass=QueuePool,
+                                      connect_args=connect_args)
+    _sqlite_pragmas(engine, {**SQLITE_PRAGMAS, **(pragmas or {})})
     return engine
 
 
+class SqliteWriter:
+    """
+    sqlite 同时只能有一个写事务 没有事务的写语句交给一个线程排队执行
+    同时在排队的语句合并到一个事务里提交 每条语句一个 savepoint 出错只回滚这一条
+    语句在提交者的 contextvars 里执行 监控仍然记到原来的 dao 操作上
+    """
+
+    def __init__(self, engine, batch_size: int = 100):
+        """
+        :param engine:
+        :param batch_size: 一个事务最多合并的语句数
+        """
+        self.batch_size = batch_size
+        self._engine = engine
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='easyapi-sqlite-writer', daemon=True)
+        self._thread.start()
+
+    def execute(self, sql, *args, **kwargs):
+        """
+        排队执行 等待提交后返回
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return: ResultProxy 返回行的语句已经读出全部的行
+        """
+        future = Future()
+        self._queue.put((contextvars.copy_context(), sql, args, kwargs, future))
+        return future.result()
+
+    def close(self):
+        """
+        执行完已经排队的语句后停止
+        :return:
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn = self._engine.connect()
+        try:
+            stop = False
+            while not stop:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                self._write(conn, batch)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _execute(conn, sql, args, kwargs):
+        result = conn.execute(sql, *args, **kwargs)
+        if result.returns_rows:
+            # 游标属于写线程的连接 先读出全部的行
+            result = FullyBufferedResultProxy(result.context)
+        return result
+
+    def _write(self, conn, batch: list):
+        if len(batch) == 1:
+            context, sql, args, kwargs, future = batch[0]
+            try:
+                future.set_result(context.run(self._execute, conn, sql, args, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return
+        try:
+            transaction = conn.begin()
+        except Exception as e:
+            for item in batch:
+                item[-1].set_exception(e)
+            return
+        results = []
+        try:
+            for context, sql, args, kwargs, future in batch:
+                savepoint = conn.begin_nested()
+                try:
+                    result = context.run(self._execute, conn, sql, args, kwargs)
+                except Exception as e:
+                    savepoint.rollback()
+                    results.append((future, None, e))
+                else:
+                    savepoint.commit()
+                    results.append((future, result, None))
+            transaction.commit()
+        except Exception as e:
+            if transaction.is_active:
+                transaction.rollback()
+            # 提交失败时整批都失败
+            for item in batch:
+                item[-1].set_exception(e)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+def supports_window_function(dialect) -> bool:
+    """
+    数据库是否支持窗口函数 例如 COUNT(*) OVER()
+    :param dialect:
+    :return:
+    """
+    if dialect.name == 'postgresql':
+        return True
+    if dialect.name == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 25)
+    if dialect.name == 'mysql':
+        version = dialect.server_version_info
+        if not version:
+            return False
+        if 'MariaDB' in version:
+            return version >= (10, 2)
+        return version >= (8, 0)
+    return False
+
+
+# 判断表结构是否变化的查询 结果不同时快照失效
+SCHEMA_VERSION_SQL = {
+    'mysql': """
+        SELECT CONCAT(COUNT(*), '-', IFNULL(SUM(CRC32(CONCAT_WS(',', TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION,
+            COLUMN_TYPE, IS_NULLABLE, IFNULL(COLUMN_DEFAULT, ''), COLUMN_KEY, EXTRA))), 0), '-',
+            (SELECT IFNULL(SUM(CRC32(CONCAT_WS(',', TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, NON_UNIQUE))), 0)
+             FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE()))
+        FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE()
+    """,
+    'postgresql': """
+        SELECT md5(
+            coalesce((SELECT string_agg(concat_ws(',', table_name, column_name, ordinal_position, data_type,
+                                                  is_nullable, column_default), ';' ORDER BY table_name, ordinal_position)
+                      FROM information_schema.columns WHERE table_schema = current_schema()), '') ||
+            coalesce((SELECT string_agg(indexdef, ';' ORDER BY indexname)
+                      FROM pg_indexes WHERE schemaname = current_schema()), ''))
+    """,
+    'sqlite': 'PRAGMA schema_version',
+}
+
+
+def get_schema_version(engine) -> str:
+    """
+    数据库当前的表结构版本
+    :param engine:
+    :return: 不支持的数据库返回 None
+    """
+    sql = SCHEMA_VERSION_SQL.get(engine.dialect.name)
+    if sql is None:
+        return None
+    return str(engine.execute(sql).scalar())
+
+
+def load_schema_snapshot(path: str, version: str):
+    """
+    读取表结构快照
+    :param path:
+    :param version: 当前的表结构版本
+    :return: 版本一致时返回 MetaData 否则返回 None
+    """
+    if version is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception as e:
+        logger.warning('ignore schema snapshot %s: %s', path, e)
+        return None
+    if snapshot.get('version') != version or snapshot.get('sqlalchemy') != sqlalchemy.__version__:
+        return None
+    return snapshot['metadata']
+
+
+def save_schema_snapshot(path: str, version: str, metadata: MetaData):
+    """
+    写入表结构快照 先写临时文件再替换 多个进程同时写也不会读到半个文件
+    :param path:
+    :param version:
+    :param metadata:
+    :return:
+    """
+    if version is None:
+        return
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'version': version, 'sqlalchemy': sqlalchemy.__version__, 'metadata': metadata}, f)
+    os.replace(tmp_path, path)
+
+
+def is_read_sql(sql) -> bool:
+    """
+    是否是可以在只读副本上执行的查询 sql 字符串和 FOR UPDATE 都算写
+    :param sql:
+    :return:
+    """
+    if isinstance(sql, Compiled):
+        sql = sql.statement
+    return isinstance(sql, Select) and sql._for_update_arg is None
+
+
+# 只读副本的选择方式
+ROUTING_WEIGHTED = 'weighted'  # 按权重随机
+ROUTING_LEAST_CONNECTIONS = 'least_connections'  # 正在使用的连接数 / 权重 最小的
+
+
+class ReplicaSet:
+    """
+    一组只读副本
+    """
+
+    def __init__(self, engines: list, weights: list = None, routing: str = ROUTING_WEIGHTED):
+        if routing not in (ROUTING_WEIGHTED, ROUTING_LEAST_CONNECTIONS):
+            raise ValueError('unknown routing: {}'.format(routing))
+        self.engines = engines
+        self.weights = weights or [1] * len(engines)
+        self.routing = routing
+
+    def choose(self):
+        """
+        选择一个副本
+        :return: engine
+        """
+        if self.routing == ROUTING_LEAST_CONNECTIONS:
+            index = min(range(len(self.engines)), key=lambda i: self._checkedout(i) / self.weights[i])
+            return self.engines[index]
+        return random.choices(self.engines, weights=self.weights)[0]
+
+    def _checkedout(self, index: int) -> int:
+        pool = self.engines[index].pool
+        if isinstance(pool, QueuePool):
+            return pool.checkedout()
+        return 0
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
 
 
 class AbcBaseDB(metaclass=abc.ABCMeta):
     """
     数据库的基类
     """
+    _replicas = None
+    schema_snapshot = None
+    instruments = ()
+    # easyapi.IndexAdvisor 记录 dao 的查询形状
+    advisor = None
 
     @abc.abstractmethod
     def connect(self):
@@ -91,13 +556,301 @@ class AbcBaseDB(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError
 
+    @property
+    def dialect(self):
+        return self._engine.dialect
+
+    def compile(self, sql):
+        """
+        按数据库的方言预编译sql 编译结果可以带参数重复执行
+        :param sql:
+        :return:
+        """
+        return sql.compile(dialect=self.dialect)
+
+    def supports_window_function(self) -> bool:
+        return supports_window_function(self.dialect)
+
+    def add_instrument(self, instrument: AbcInstrument):
+        """
+        注册 sql 执行的监控 例如 QueryStats SlowQueryLog
+        :param instrument:
+        :return:
+        """
+        self.instruments = self.instruments + (instrument,)
+        for engine in self._engines():
+            self._listen(engine)
+
+    def _engines(self) -> list:
+        """
+        主库和只读副本的 engine 还没有 connect 时为空
+        :return:
+        """
+        engines = [self._engine] if getattr(self, '_engine', None) is not None else []
+        if self._replicas is not None:
+            engines += self._replicas.engines
+        return engines
+
+    def _listen(self, engine):
+        """
+        在 engine 上监听 sql 的执行 注册了 instrument 之后才监听 没有监控时不影响执行
+        :param engine:
+        :return:
+        """
+        if not self.instruments or engine in _instrumented_engines:
+            return
+        _instrumented_engines.add(engine)
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if self.instruments and context is not None:
+                context._easyapi_event = begin_event(self.instruments, statement, executemany)
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            query_event = getattr(context, '_easyapi_event', None)
+            if query_event is not None:
+                context._easyapi_event = None
+                end_event(self.instruments, query_event, rowcount=cursor.rowcount)
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(exception_context):
+            context = exception_context.execution_context
+            query_event = getattr(context, '_easyapi_event', None)
+            if query_event is not None:
+                context._easyapi_event = None
+                end_event(self.instruments, query_event, error=exception_context.original_exception)
+
+    def execute_batch(self, ctx: EasyApiContext, statements: list) -> list:
+        """
+        在同一个连接上依次执行多条查询
+        :param ctx:
+        :param statements: [(sql, 参数), ...]
+        :return: 每条查询的全部行
+        """
+        conn = ctx.tx
+        if conn is not None:
+            flush(conn)
+            return [conn.execute(sql, params).fetchall() for sql, params in statements]
+        # 第一条查询读完后不能关闭连接
+        with self._connect(ctx, *[sql for sql, params in statements], close_with_result=False) as conn:
+            return [conn.execute(sql, params).fetchall() for sql, params in statements]
+
+    def stream(self, ctx: EasyApiContext, sql, *args, **kwargs):
+        """
+        流式执行查询 使用服务端游标 结果用 fetchmany 分批读取 读完或者 close 后归还连接
+        mysql 在结果读完之前 同一个连接不能执行别的语句
+        :param ctx:
+        :param sql:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        conn = ctx.tx
+        if conn is None:
+            conn = self._connect(ctx, sql)
+        else:
+            flush(conn)
+        return conn.execution_options(stream_results=True).execute(sql, *args, **kwargs)
+
+    def _route(self, ctx: EasyApiContext, *sqls):
+        """
+        选择执行sql的 engine 写走主库 读走只读副本
+        :param ctx:
+        :param sqls:
+        :return:
+        """
+        if not all(is_read_sql(sql) for sql in sqls):
+            ctx.mark_write()
+            return self._engine
+        if self._replicas is None or ctx.read_primary():
+            return self._engine
+        return self._replicas.choose()
+
+    def _connect(self, ctx: EasyApiContext, *sqls, close_with_result: bool = True):
+        """
+        按 _route 取一个连接 副本连不上时退回主库
+        :param ctx:
+        :param sqls:
+        :param close_with_result: 结果读完后归还连接
+        :return:
+        """
+        engine = self._route(ctx, *sqls)
+        if engine is self._engine:
+            return self._checkout(engine, close_with_result=close_with_result)
+        try:
+            return self._checkout(engine, close_with_result=close_with_result)
+        except OperationalError:
+            return self._checkout(self._engine, close_with_result=close_with_result)
+
+    def _begin(self, read_only: bool = False):
+        """
+        为事务取一个连接并开始事务 只读事务优先使用只读副本 副本连不上时退回主库
+        :param read_only:
+        :return: (连接, 事务)
+        """
+        engine = self._engine
+        if read_only and self._replicas is not None:
+            engine = self._replicas.choose()
+        try:
+            conn = self._checkout(engine)
+        except OperationalError:
+            if engine is self._engine:
+                raise
+            conn = self._checkout(self._engine)
+        try:
+            return self._begin_transaction(conn, read_only)
+        except Exception as e:
+            conn.close()
+            raise e
+
+    def _begin_transaction(self, conn, read_only: bool):
+        """
+        开始事务 只读事务用 SET TRANSACTION READ ONLY 声明
+        mysql 对下一个事务生效 postgresql 是事务里的第一条语句
+        :param conn:
+        :param read_only:
+        :return: (连接, 事务)
+        """
+        transaction = conn.begin()
+        if read_only:
+            conn.execute('SET TRANSACTION READ ONLY')
+        return conn, transaction
+
+    def _checkout(self, engine=None, **kwargs):
+        """
+        从连接池取一个连接 记录等待时间和超时
+        :param engine: 默认主库
+        :param kwargs:
+        :return:
+        """
+        engine = engine or self._engine
+        stats = get_pool_stats(engine)
+        start = time.perf_counter()
+        try:
+            conn = engine.connect(**kwargs)
+        except TimeoutError:
+            if stats is not None:
+                stats.record_timeout()
+            raise
+        wait = time.perf_counter() - start
+        if stats is not None:
+            stats.record_wait(wait)
+        if self.instruments:
+            set_checkout_wait(wait)
+        return conn
+
+    def pool_stats(self) -> dict:
+        """
+        主库和只读副本连接池的统计
+        :return: {'primary': {...}, 'replica0': {...}, ...}
+        """
+        engines = [('primary', self._engine)]
+        if self._replicas is not None:
+            engines += [('replica{}'.format(i), e) for i, e in enumerate(self._replicas.engines)]
+        stats = {}
+        for name, engine in engines:
+            engine_stats = get_pool_stats(engine)
+            if engine_stats is not None:
+                stats[name] = engine_stats.snapshot()
+        return stats
+
+    def retry_stats(self) -> dict:
+        """
+        retry_tx 的重试统计
+        :return:
+        """
+        return get_retry_stats(self).snapshot()
+
+    def _connect_replicas(self, get_engine, replicas: list, routing: str):
+        """
+        创建只读副本的 engine 没有配置的连接信息使用主库的
+        :param get_engine: get_mysql_engine 或 get_postgre_engine
+        :param replicas: [{'host': ..., 'port': ..., 'weight': 1, 'pool_config': PoolConfig()}, ...]
+        :param routing:
+        :return:
+        """
+        if not replicas:
+            return None
+        engines, weights = [], []
+        for replica in replicas:
+            engine = get_engine(user=replica.get('user', self.user), password=replica.get('password', self.password),
+                                host=replica.get('host', self.host), port=replica.get('port', self.port),
+                                database=replica.get('database', self.database), echo=self.echo,
+                                pool_config=replica.get('pool_config', self.pool_config))
+            self._listen(engine)
+            warm_up(engine, (replica.get('pool_config') or self.pool_config).warm_up)
+            engines.append(engine)
+            weights.append(replica.get('weight', 1))
+        return ReplicaSet(engines, weights=weights, routing=routing)
+
+    def _load_schema(self, engine=None):
+        """
+        准备表结构 不在这里反射 表在第一次使用时单独反射
+        配置了 schema_snapshot 并且表结构版本没变时 直接使用快照里的表
+        :param engine: 反射使用的 engine 默认主库
+        :return:
+        """
+        self._reflect_engine = engine or self._engine
+        self._reflect_lock = threading.Lock()
+        # 先连接一次 检查连接信息并读取数据库版本
+        self._reflect_engine.connect().close()
+        self._metadata = MetaData(self._reflect_engine)
+        self._schema_version = None
+        self._schema_dirty = False
+        if self.schema_snapshot:
+            self._schema_version = get_schema_version(self._reflect_engine)
+            metadata = load_schema_snapshot(self.schema_snapshot, self._schema_version)
+            if metadata is not None:
+                metadata.bind = self._reflect_engine
+                self._metadata = metadata
+            atexit.register(self.save_schema)
+        self._tables = self._metadata.tables
+
+    def save_schema(self) -> bool:
+        """
+        反射了新的表时写入表结构快照 反射只做标记 在这里一次写入
+        dao 都定义完之后调用 close 和进程退出时也会调用
+        :return: 是否写入了快照
+        """
+        if not self.schema_snapshot or not getattr(self, '_schema_dirty', False):
+            return False
+        with self._reflect_lock:
+            if not self._schema_dirty:
+                return False
+            self._schema_dirty = False
+            save_schema_snapshot(self.schema_snapshot, self._schema_version, self._metadata)
+        return True
+
+    def _table(self, name: str) -> Table:
+        """
+        读取表 没有反射过时反射这一张表
+        :param name:
+        :return:
+        """
+        table = self._tables.get(name)
+        if table is not None:
+            return table
+        with self._reflect_lock:
+            table = self._tables.get(name)
+            if table is not None:
+                return table
+            try:
+                table = Table(name, self._metadata, autoload=True, autoload_with=self._reflect_engine)
+            except NoSuchTableError:
+                raise KeyError(name)
+            self._schema_dirty = True
+        return table
+
     @abc.abstractmethod
     def __getitem__(self, name):
-        return self._tables[name]
+        return self._table(name)
 
     @abc.abstractmethod
     def __getattr__(self, item):
-        return self._tables[item]
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._table(item)
 
 
 class MysqlDB(AbcBaseDB):
@@ -105,30 +858,45 @@ class MysqlDB(AbcBaseDB):
     用于操作 mysql 的db对象
     """
 
-    def __init__(self, user, password, host, port, database, echo=False):
+    def __init__(self, user, password, host, port, database, echo=False, replicas: list = None,
+                 routing: str = ROUTING_WEIGHTED, pool_config: PoolConfig = None, schema_snapshot: str = None):
+        """
+        :param replicas: 只读副本 [{'host': ..., 'port': ..., 'weight': 1}, ...] 没有的连接信息使用主库的
+        :param routing: 副本的选择方式 ROUTING_WEIGHTED 或 ROUTING_LEAST_CONNECTIONS
+        :param pool_config: 连接池配置
+        :param schema_snapshot: 表结构快照的文件路径 表结构没变时启动不需要反射
+        """
         self.user = user
         self.password = password
         self.host = host
         self.port = port
         self.database = database
         self._engine = None
+        self._thread_engine = None
         self._sync_engine = None
         self._metadata = None
         self._tables = None
         self.echo = echo
+        self.replicas = replicas
+        self.routing = routing
+        self.pool_config = pool_config or PoolConfig()
+        self.schema_snapshot = schema_snapshot
 
     def connect(self):
         self._engine = get_mysql_engine(user=self.user, password=self.password, host=self.host, port=self.port,
-                                        database=self.database, echo=self.echo)
-        self._metadata = MetaData(self._engine)
-        self._metadata.reflect(bind=self._engine)
-        self._tables = self._metadata.tables
+                                        database=self.database, echo=self.echo, pool_config=self.pool_config)
+        self._listen(self._engine)
+        warm_up(self._engine, self.pool_config.warm_up)
+        self._load_schema()
+        self._replicas = self._connect_replicas(get_mysql_engine, self.replicas, self.routing)
 
     def __getitem__(self, name):
-        return self._tables[name]
+        return self._table(name)
 
     def __getattr__(self, item):
-        return self._tables[item]
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._table(item)
 
     def execute(self, ctx: EasyApiContext, sql, *args, **kwargs):
         """
@@ -141,9 +909,10 @@ class MysqlDB(AbcBaseDB):
         """
         conn = ctx.tx
         if conn is None:
-            with self._engine.connect(close_with_result=True) as conn:
+            with self._connect(ctx, sql) as conn:
                 return conn.execute(sql, *args, **kwargs)
         else:
+            flush(conn)
             return conn.execute(sql, *args, **kwargs)
 
 
@@ -152,30 +921,45 @@ class PostgreDB(AbcBaseDB):
     用于操作 postgredb 的db对象
     """
 
-    def __init__(self, user, password, host, port, database, echo=False):
+    def __init__(self, user, password, host, port, database, echo=False, replicas: list = None,
+                 routing: str = ROUTING_WEIGHTED, pool_config: PoolConfig = None, schema_snapshot: str = None):
+        """
+        :param replicas: 只读副本 [{'host': ..., 'port': ..., 'weight': 1}, ...] 没有的连接信息使用主库的
+        :param routing: 副本的选择方式 ROUTING_WEIGHTED 或 ROUTING_LEAST_CONNECTIONS
+        :param pool_config: 连接池配置
+        :param schema_snapshot: 表结构快照的文件路径 表结构没变时启动不需要反射
+        """
         self.user = user
         self.password = password
         self.host = host
         self.port = port
         self.database = database
         self._engine = None
+        self._thread_engine = None
         self._sync_engine = None
         self._metadata = None
         self._tables = None
         self.echo = echo
+        self.replicas = replicas
+        self.routing = routing
+        self.pool_config = pool_config or PoolConfig()
+        self.schema_snapshot = schema_snapshot
 
     def connect(self):
         self._engine = get_postgre_engine(user=self.user, password=self.password, host=self.host, port=self.port,
-                                          database=self.database, echo=self.echo)
-        self._metadata = MetaData(self._engine)
-        self._metadata.reflect(bind=self._engine)
-        self._tables = self._metadata.tables
+                                          database=self.database, echo=self.echo, pool_config=self.pool_config)
+        self._listen(self._engine)
+        warm_up(self._engine, self.pool_config.warm_up)
+        self._load_schema()
+        self._replicas = self._connect_replicas(get_postgre_engine, self.replicas, self.routing)
 
     def __getitem__(self, name):
-        return self._tables[name]
+        return self._table(name)
 
     def __getattr__(self, item):
-        return self._tables[item]
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._table(item)
 
     def execute(self, ctx: EasyApiContext, sql, *args, **kwargs):
         """
@@ -188,37 +972,112 @@ class PostgreDB(AbcBaseDB):
         """
         conn = ctx.tx
         if conn is None:
-            with self._engine.connect(close_with_result=True) as conn:
+            with self._connect(ctx, sql) as conn:
                 return conn.execute(sql, *args, **kwargs)
         else:
+            flush(conn)
             return conn.execute(sql, *args, **kwargs)
 
 
 class SqliteDB(AbcBaseDB):
     """
-    用于操作 postgredb 的db对象
+    用于操作 sqlite 的db对象
+    WAL 模式 事务外的语句使用线程自己的连接 事务单独从连接池取连接 读可以并发
+    线程的连接不经过连接池 长期存在的线程不会占满事务使用的连接池
     """
 
-    def __init__(self, database, echo=False):
+    def __init__(self, database, echo=False, schema_snapshot: str = None, pool_config: PoolConfig = None,
+                 pragmas: dict = None, write_queue: bool = False, write_batch_size: int = 100):
+        """
+        :param schema_snapshot: 表结构快照的文件路径
+        :param pool_config: 连接池配置 默认 16 个连接 不 ping 不回收
+        :param pragmas: 覆盖 SQLITE_PRAGMAS 的 pragma
+        :param write_queue: 事务外的写语句交给一个线程排队执行 并发的写合并到一个事务里提交
+        :param write_batch_size: 一个事务最多合并的写语句数
+        """
         self.database = database
         self._engine = None
+        self._thread_engine = None
         self._sync_engine = None
         self._metadata = None
         self._tables = None
-        self._connection = None
+        self._writer = None
+        self._local = threading.local()
+        # 注册监控后加一 线程的连接需要重新创建才会触发执行事件
+        self._generation = 0
         self.echo = echo
+        self.schema_snapshot = schema_snapshot
+        self.pool_config = pool_config or PoolConfig(size=16, max_overflow=16, recycle=-1, pre_ping=PRE_PING_NEVER)
+        self.pragmas = pragmas
+        self.write_queue = write_queue
+        self.write_batch_size = write_batch_size
 
     def connect(self):
-        self._engine = get_sqlite_engine(database=self.database, echo=self.echo)
-        self._metadata = MetaData(self._engine)
-        self._metadata.reflect(bind=self._engine)
-        self._tables = self._metadata.tables
-        self._connection = self._engine.connect()
+        self._engine = get_sqlite_engine(database=self.database, echo=self.echo, pool_config=self.pool_config,
+                                         pragmas=self.pragmas)
+        self._listen(self._engine)
+        if self.database in ('', ':memory:'):
+            self._thread_engine = self._engine
+        else:
+            self._thread_engine = get_sqlite_engine(database=self.database, echo=self.echo, pragmas=self.pragmas,
+                                                    null_pool=True)
+            self._listen(self._thread_engine)
+        self._load_schema()
+        if self.write_queue and self.database not in ('', ':memory:'):
+            self._writer = SqliteWriter(self._engine, batch_size=self.write_batch_size)
+
+    def close(self):
+        """
+        停止写线程 关闭连接池 其他线程正在使用的连接在线程结束时归还
+        :return:
+        """
+        self.save_schema()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local = threading.local()
+        for engine in self._engines():
+            engine.dispose()
+
+    def add_instrument(self, instrument: AbcInstrument):
+        first = not self.instruments
+        super().add_instrument(instrument)
+        if first:
+            # 连接创建时决定是否触发执行事件 开始监听后换新的连接
+            self._generation += 1
+
+    def _engines(self) -> list:
+        engines = super()._engines()
+        if self._thread_engine is not None and self._thread_engine is not self._engine:
+            engines.append(self._thread_engine)
+        return engines
+
     def __getitem__(self, name):
-        return self._tables[name]
+        return self._table(name)
 
     def __getattr__(self, item):
-        return self._tables[item]
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._table(item)
+
+    def _thread_connection(self):
+        """
+        当前线程的连接 第一次使用时新建 线程结束时关闭
+        :return:
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        key = (os.getpid(), self._generation)
+        if conn is None or local.key != key:
+            if conn is not None and local.key[0] == key[0]:
+                conn.close()
+            # fork 之后的子进程不能复用父进程的连接
+            conn = local.conn = self._checkout(self._thread_engine)
+            local.key = key
+        return conn
 
     def execute(self, ctx: EasyApiContext, sql, *args, **kwargs):
         """
@@ -229,5 +1088,34 @@ class SqliteDB(AbcBaseDB):
         :param kwargs:
         :return:
         """
-        return self._connection.execute(sql, *args, **kwargs)
+        conn = ctx.tx if ctx is not None else None
+        if conn is not None:
+            flush(conn)
+            return conn.execute(sql, *args, **kwargs)
+        if self._writer is not None and not is_read_sql(sql):
+            return self._writer.execute(sql, *args, **kwargs)
+        return self._thread_connection().execute(sql, *args, **kwargs)
+
+    def _begin_transaction(self, conn, read_only: bool):
+        """
+        sqlite 没有只读事务 只读时用 BEGIN 代替 BEGIN IMMEDIATE 和写事务并发执行
+        :param conn:
+        :param read_only:
+        :return: (连接, 事务)
+        """
+        if read_only:
+            conn = conn.execution_options(sqlite_read_only=True)
+        return conn, conn.begin()
+
+    def execute_batch(self, ctx: EasyApiContext, statements: list) -> list:
+        conn = ctx.tx if ctx is not None else None
+        if conn is not None:
+            flush(conn)
+        else:
+            conn = self._thread_connection()
+        return [conn.execute(sql, params).fetchall() for sql, params in statements]
+
+    def stream(self, ctx: EasyApiContext, sql, *args, **kwargs):
+        # sqlite 的游标本来就是逐行读取
+        return self.execute(ctx, sql, *args, **kwargs)
 
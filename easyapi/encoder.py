@@ -0,0 +1,49 @@
+import abc
+import json
+from easyapi_tools.util import value_to_json
+
+
+def _default(value):
+    new_value = value_to_json(value)
+    if new_value is value:
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+    return new_value
+
+
+class AbcJsonEncoder(metaclass=abc.ABCMeta):
+    """
+    handler 返回数据使用的 json 编码器
+    """
+
+    @abc.abstractmethod
+    def dumps(self, data) -> bytes:
+        """
+        编码成 utf-8 的 json
+        :param data:
+        :return:
+        """
+        raise NotImplementedError
+
+
+class StdJsonEncoder(AbcJsonEncoder):
+    """
+    标准库 json
+    """
+
+    def dumps(self, data) -> bytes:
+        return json.dumps(data, default=_default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+class OrjsonEncoder(AbcJsonEncoder):
+    """
+    基于 orjson 直接输出 bytes 需要安装 orjson
+    """
+
+    def __init__(self):
+        import orjson
+        self._dumps = orjson.dumps
+        # 日期时间交给 _default 保持和 type_to_json 一样的格式
+        self._option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, data) -> bytes:
+        return self._dumps(data, default=_default, option=self._option)
@@ -1,6 +1,6 @@
 import flask
 from flask import views
-from easyapi_tools.util import str2hump, DefaultUrlCondition
+from easyapi_tools.util import str2hump, DefaultUrlCondition, parse_url_fields, parse_url_args
 from easyapi_tools.errors import BusinessError
 from easyapi.context import EasyApiContext
 
@@ -27,6 +27,28 @@ class FlaskHandlerMeta(views.MethodViewType):
 
 
 class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
+    __stream_chunk_size__ = 1000
+    __json_encoder__ = None  # AbcJsonEncoder 例如 easyapi.OrjsonEncoder() 为 None 时使用 flask.jsonify
+
+    def _jsonify(self, **data):
+        """
+        编码返回的数据
+        :param data:
+        :return:
+        """
+        if self.__json_encoder__ is None:
+            return flask.jsonify(**data)
+        return flask.Response(self.__json_encoder__.dumps(data), mimetype='application/json')
+
+    def _dumps(self, data) -> bytes:
+        """
+        编码一个资源 用于流式返回
+        :param data:
+        :return:
+        """
+        if self.__json_encoder__ is None:
+            return flask.json.dumps(data).encode()
+        return self.__json_encoder__.dumps(data)
 
     def get(self, id: int, **kwargs):
         """
@@ -36,15 +58,17 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
         """
         ctx = kwargs.get('ctx')
         try:
-            data = self.__controller__.get(ctx=ctx, id=id)
+            fields = parse_url_fields(self.__url_condition__, {'_fields': flask.request.args.get('_fields')},
+                                      table=self.__controller__.__dao__.__table__)
+            data = self.__controller__.get(ctx=ctx, id=id, fields=fields)
         except BusinessError as e:
-            return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
+            return self._jsonify(code=e.code, msg=e.err_info), e.http_code
         if not data:
-            return flask.jsonify(**{
+            return self._jsonify(**{
                 'msg': '',
                 'code': 404,
             }), 404
-        return flask.jsonify(**{
+        return self._jsonify(**{
             'msg': '',
             'code': 200,
             self.__resource__: data
@@ -61,8 +85,8 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
         try:
             count = self.__controller__.update(ctx=ctx, id=id, data=body)
         except BusinessError as e:
-            return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
-        return flask.jsonify(code=200, count=count, msg='')
+            return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+        return self._jsonify(code=200, count=count, msg='')
 
     def delete(self, id, **kwargs):
         """
@@ -74,8 +98,8 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
         try:
             count = self.__controller__.delete(ctx=ctx, id=id)
         except BusinessError as e:
-            return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
-        return flask.jsonify(code=200, count=count, msg='')
+            return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+        return self._jsonify(code=200, count=count, msg='')
 
     def post(self, *args, **kwargs):
         """
@@ -87,17 +111,23 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
         method = body.get("_method") or "POST"
 
         if method == 'GET':
-            query, pager, sorter = self.__url_condition__.parser(body.get("_args"))
             try:
-                res, count = self.__controller__.query(ctx=ctx, query=query, pager=pager, sorter=sorter)
+                query, pager, sorter, fields = parse_url_args(self.__url_condition__, body.get("_args"),
+                                                              table=self.__controller__.__dao__.__table__)
+                if body.get("_stream"):
+                    return self._stream(ctx, body.get("_stream"), query, sorter, fields)
+                res, count = self.__controller__.query(ctx=ctx, query=query, pager=pager, sorter=sorter,
+                                                       fields=fields)
 
             except BusinessError as e:
-                return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
-            return flask.jsonify(**{
+                return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+            return self._jsonify(**{
                 'msg': '',
                 'code': 200,
                 self.__resource__ + 's': res,
-                'total': count
+                'total': count,
+                'next_cursor': getattr(pager, 'next_cursor', None),
+                'has_more': getattr(pager, 'has_more', None)
             })
         else:
             if '_method' in body:
@@ -105,8 +135,45 @@ class FlaskBaseHandler(views.MethodView, metaclass=FlaskHandlerMeta):
             try:
                 _id = self.__controller__.insert(ctx=ctx, data=body)
             except BusinessError as e:
-                return flask.jsonify(code=e.code, msg=e.err_info), e.http_code
-            return flask.jsonify(code=200, id=_id, msg='')
+                return self._jsonify(code=e.code, msg=e.err_info), e.http_code
+            return self._jsonify(code=200, id=_id, msg='')
+
+    def _stream(self, ctx, mode: str, query: dict, sorter, fields: list):
+        """
+        流式返回查询结果 不分页
+        :param ctx:
+        :param mode: ndjson 每行一个资源 json 和普通查询一样的结构 逐个写出资源
+        :param query:
+        :param sorter:
+        :param fields:
+        :return:
+        """
+        if mode not in ('ndjson', 'json'):
+            raise BusinessError(code=400, http_code=400, err_info='unknown _stream: {}'.format(mode))
+        rows = self.__controller__.iter_query(ctx=ctx, query=query, sorter=sorter, fields=fields,
+                                              chunk_size=self.__stream_chunk_size__)
+        # 先取第一行 查询出错时还能返回错误码
+        first = next(rows, None)
+        dumps = self._dumps
+
+        def generate_ndjson():
+            if first is None:
+                return
+            yield dumps(first) + b'\n'
+            for row in rows:
+                yield dumps(row) + b'\n'
+
+        def generate_json():
+            yield b'{"msg":"","code":200,' + dumps(self.__resource__ + 's') + b':['
+            if first is not None:
+                yield dumps(first)
+                for row in rows:
+                    yield b',' + dumps(row)
+            yield b']}'
+
+        if mode == 'ndjson':
+            return flask.Response(flask.stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+        return flask.Response(flask.stream_with_context(generate_json()), mimetype='application/json')
 
 
 def register_api(app, view, endpoint: str, url: str, pk='id', pk_type='int'):
@@ -0,0 +1,284 @@
+import abc
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# 当前执行的 dao 操作 (dao类, 操作名)
+_operation = contextvars.ContextVar('easyapi_operation', default=(None, None))
+# 最近一次取连接的等待时间 由第一条语句取走
+_checkout_wait = contextvars.ContextVar('easyapi_checkout_wait', default=0.0)
+
+
+@dataclass
+class QueryEvent:
+    """
+    一次 sql 执行
+    wait 是取连接的等待时间 事务里除第一条语句外都是 0
+    elapsed 是执行时间 不包括 wait
+    rowcount 是驱动返回的 rowcount 有的驱动查询时为 -1
+    """
+    dao: type = None
+    operation: str = None
+    statement: str = ''
+    fingerprint: str = ''
+    executemany: bool = False
+    rowcount: int = -1
+    wait: float = 0.0
+    elapsed: float = 0.0
+    error: Exception = None
+    start: float = 0.0
+
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|(?<![:\w]):\w+")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SPACE = re.compile(r"\s+")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_LISTS = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    """
+    sql 的指纹 去掉字面量 IN 和多行 VALUES 的长度
+    :param statement:
+    :return:
+    """
+    sql = _STRING.sub('?', statement)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _SPACE.sub(' ', sql).strip()
+    sql = _LIST.sub('(?+)', sql)
+    return _LISTS.sub('(?+), ...', sql)
+
+
+def current_operation() -> (type, str):
+    """
+    当前执行的 dao 操作
+    :return: (dao类, 操作名) 不在 dao 里执行时为 (None, None)
+    """
+    return _operation.get()
+
+
+def operation(name: str):
+    """
+    标记 dao 的方法 方法里执行的 sql 记到这个操作上
+    同一个 dao 嵌套调用时记到最外层的操作上
+    :param name: 操作名
+    :return:
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(cls, *args, **kwargs):
+                if _operation.get()[0] is cls:
+                    return await func(cls, *args, **kwargs)
+                token = _operation.set((cls, name))
+                try:
+                    return await func(cls, *args, **kwargs)
+                finally:
+                    _operation.reset(token)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            if _operation.get()[0] is cls:
+                return func(cls, *args, **kwargs)
+            token = _operation.set((cls, name))
+            try:
+                return func(cls, *args, **kwargs)
+            finally:
+                _operation.reset(token)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def operation_scope(dao: type, name: str):
+    """
+    和 operation 一样 用于生成器里只包住执行 sql 的那一句
+    :param dao:
+    :param name:
+    :return:
+    """
+    if _operation.get()[0] is dao:
+        yield
+        return
+    token = _operation.set((dao, name))
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+def set_checkout_wait(seconds: float):
+    _checkout_wait.set(seconds)
+
+
+def begin_event(instruments: tuple, statement: str, executemany: bool = False,
+                operation: tuple = None) -> QueryEvent:
+    """
+    开始记录一次执行 调用 before
+    :param instruments:
+    :param statement: 发给驱动的 sql
+    :param executemany:
+    :param operation: (dao类, 操作名) 默认 current_operation()
+    :return:
+    """
+    dao, name = operation or _operation.get()
+    wait = _checkout_wait.get()
+    if wait:
+        _checkout_wait.set(0.0)
+    event = QueryEvent(dao=dao, operation=name, statement=statement, fingerprint=fingerprint(statement),
+                       executemany=executemany, wait=wait)
+    for instrument in instruments:
+        instrument.before(event)
+    event.start = time.perf_counter()
+    return event
+
+
+def end_event(instruments: tuple, event: QueryEvent, rowcount: int = -1, error: Exception = None):
+    """
+    结束记录 调用 after instrument 的异常只记日志
+    :param instruments:
+    :param event:
+    :param rowcount:
+    :param error:
+    :return:
+    """
+    event.elapsed = time.perf_counter() - event.start
+    event.rowcount = rowcount
+    event.error = error
+    for instrument in instruments:
+        try:
+            instrument.after(event)
+        except Exception:
+            logger.exception('instrument %r failed', instrument)
+
+
+class AbcInstrument(metaclass=abc.ABCMeta):
+    """
+    sql 执行的监控 通过 db.add_instrument 注册
+    before 和 after 在执行 sql 的线程或协程里同步调用 需要足够快
+    """
+
+    def before(self, event: QueryEvent):
+        """
+        执行前
+        :param event:
+        :return:
+        """
+
+    @abc.abstractmethod
+    def after(self, event: QueryEvent):
+        """
+        执行后 出错时 event.error 是异常
+        :param event:
+        :return:
+        """
+        raise NotImplementedError
+
+
+class QueryStats(AbcInstrument):
+    """
+    按 sql 指纹统计次数 错误数 行数和耗时的分布
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, maxsize: int = 1000):
+        """
+        :param maxsize: 最多统计的指纹数 超过后新的指纹记到 other 里
+        """
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def after(self, event: QueryEvent):
+        key = event.fingerprint
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                if len(self._data) >= self.maxsize:
+                    key = 'other'
+                    item = self._data.get(key)
+                if item is None:
+                    item = self._data[key] = {
+                        'dao': event.dao.__name__ if event.dao is not None else None,
+                        'operation': event.operation,
+                        'count': 0,
+                        'errors': 0,
+                        'rows': 0,
+                        'wait_total': 0.0,
+                        'total': 0.0,
+                        'max': 0.0,
+                        'histogram': [0] * (len(self.BUCKETS) + 1),
+                    }
+            item['count'] += 1
+            if event.error is not None:
+                item['errors'] += 1
+            if event.rowcount > 0:
+                item['rows'] += event.rowcount
+            item['wait_total'] += event.wait
+            item['total'] += event.elapsed
+            if event.elapsed > item['max']:
+                item['max'] = event.elapsed
+            item['histogram'][bisect.bisect_left(self.BUCKETS, event.elapsed)] += 1
+
+    def snapshot(self) -> dict:
+        """
+        当前的统计
+        :return: {指纹: {...}}
+        """
+        labels = ['<={}'.format(b) for b in self.BUCKETS] + ['>{}'.format(self.BUCKETS[-1])]
+        with self._lock:
+            return {key: {**item, 'histogram': dict(zip(labels, item['histogram']))}
+                    for key, item in self._data.items()}
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SlowQueryLog(AbcInstrument):
+    """
+    执行时间超过阈值的 sql 记 warning 日志
+    """
+
+    def __init__(self, threshold: float = 1.0, thresholds: dict = None, log: logging.Logger = None):
+        """
+        :param threshold: 默认阈值 秒
+        :param thresholds: 单独的阈值 key 是操作名 例如 'query' 或者 'UserDao.query'
+        :param log: 默认 easyapi.instrument 的 logger
+        """
+        self.threshold = threshold
+        self.thresholds = thresholds or {}
+        self.log = log or logger
+
+    def _threshold(self, event: QueryEvent) -> float:
+        if not self.thresholds:
+            return self.threshold
+        if event.dao is not None:
+            threshold = self.thresholds.get('{}.{}'.format(event.dao.__name__, event.operation))
+            if threshold is not None:
+                return threshold
+        return self.thresholds.get(event.operation, self.threshold)
+
+    def after(self, event: QueryEvent):
+        if event.elapsed < self._threshold(event):
+            return
+        self.log.warning('slow query %.3fs wait %.3fs dao=%s operation=%s rows=%s: %s', event.elapsed, event.wait,
+                         event.dao.__name__ if event.dao is not None else None, event.operation, event.rowcount,
+                         event.statement)
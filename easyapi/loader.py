@@ -0,0 +1,100 @@
+import asyncio
+
+
+class DataLoader:
+    """
+    请求内的批量加载器 记住已经加载过的 key
+    """
+
+    def __init__(self, batch_load_fn):
+        """
+        :param batch_load_fn: 传入 key 列表 返回同样顺序的结果列表
+        """
+        self._batch_load_fn = batch_load_fn
+        self._cache = {}
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+    def load_many(self, keys: list) -> list:
+        """
+        没有加载过的 key 合并成一次查询
+        :param keys:
+        :return: 和 keys 顺序相同的结果
+        """
+        missing = [k for k in dict.fromkeys(keys) if k not in self._cache]
+        if missing:
+            for key, value in zip(missing, self._batch_load_fn(missing)):
+                self._cache[key] = value
+        return [self._cache[k] for k in keys]
+
+    def prime(self, key, value):
+        self._cache.setdefault(key, value)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class AsyncDataLoader:
+    """
+    请求内的异步批量加载器 同一轮事件循环里的 load 合并成一次查询
+    """
+
+    def __init__(self, batch_load_fn):
+        """
+        :param batch_load_fn: 协程 传入 key 列表 返回同样顺序的结果列表
+        """
+        self._batch_load_fn = batch_load_fn
+        self._cache = {}
+        # 排队的 (key, future) clear 之后排队的 future 也要完成
+        self._queue = []
+        # 事件循环只保留 task 的弱引用 这里保留到 task 结束
+        self._tasks = set()
+
+    def load(self, key) -> asyncio.Future:
+        future = self._cache.get(key)
+        if future is not None:
+            return future
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._cache[key] = future
+        self._queue.append((key, future))
+        if len(self._queue) == 1:
+            loop.call_soon(self._start_dispatch, loop)
+        return future
+
+    async def load_many(self, keys: list) -> list:
+        return list(await asyncio.gather(*[self.load(k) for k in keys]))
+
+    def prime(self, key, value):
+        if key not in self._cache:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(value)
+            self._cache[key] = future
+
+    def clear(self):
+        self._cache.clear()
+
+    def _start_dispatch(self, loop):
+        task = loop.create_task(self._dispatch())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self):
+        queue, self._queue = self._queue, []
+        # clear 之后同一个 key 可能排队两次 只查询一次
+        keys = list(dict.fromkeys(key for key, _ in queue))
+        try:
+            values = await self._batch_load_fn(keys)
+        except Exception as e:
+            for key, future in queue:
+                # 失败的 key 不记忆 下次重新加载
+                if self._cache.get(key) is future:
+                    del self._cache[key]
+                if not future.done():
+                    future.set_exception(e)
+            return
+        results = dict(zip(keys, values))
+        for key, future in queue:
+            if not future.done():
+                future.set_result(results.get(key))
@@ -1,4 +1,17 @@
-from sqlalchemy import Table
+import base64
+import datetime
+import decimal
+import functools
+import json
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from sqlalchemy import Table, String, Float, TypeDecorator
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import bindparam
+from sqlalchemy.sql.elements import BindParameter, ColumnElement
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.sql.sqltypes import NullType
 from dataclasses import dataclass
 
 OPERATOR_FUNC_DICT = {
@@ -7,45 +20,521 @@ OPERATOR_FUNC_DICT = {
     '_gte_': (lambda cls, k, v: getattr(cls, k) >= v),
     '_lt_': (lambda cls, k, v: getattr(cls, k) < v),
     '_lte_': (lambda cls, k, v: getattr(cls, k) <= v),
-    '_like_': (lambda cls, k, v: getattr(cls, k).like(v + '%')),
-    '_search_': (lambda cls, k, v: getattr(cls, k).like('%'+ v + '%')),
+    '_like_': (lambda cls, k, v: getattr(cls, k).like(v)),
+    '_search_': (lambda cls, k, v: getattr(cls, k).like(v)),
     '_in_': (lambda cls, k, v: getattr(cls, k).in_(v)),
+    '_match_': (lambda cls, k, v: match(getattr(cls, k), v)),
 }
 
+# 操作符对值的预处理 预编译的语句只绑定处理后的值
+OPERATOR_VALUE_DICT = {
+    '_like_': (lambda v: v + '%'),
+    '_search_': (lambda v: '%' + v + '%'),
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_query_key(key: str) -> (str, str):
+    """
+    解析查询的key
+    :param key: 例如 _gte_id
+    :return: (操作符, 字段名) 不认识的操作符返回 (None, None)
+    """
+    if not key.startswith('_'):
+        return '=', key
+    for query_key in OPERATOR_FUNC_DICT.keys():
+        if key.startswith(query_key):
+            return query_key, key[len(query_key):]
+    return None, None
+
+
+def _iter_conditions(query: dict):
+    """
+    按固定顺序展开查询条件
+    :param query:
+    :return: (key, 操作符, 字段名, 值)
+    """
+    for key in sorted(query.keys()):
+        operator, column = parse_query_key(key)
+        if operator is None:
+            continue
+        value = query[key]
+        if type(value) is not list or operator == '_in_':
+            # 兼容处理 _in_ 的值本身就是列表
+            values = [value]
+        else:
+            values = value
+        for v in values:
+            yield key, operator, column, v
+
+
+def _format_value(operator: str, value):
+    if value is None or operator not in OPERATOR_VALUE_DICT:
+        return value
+    return OPERATOR_VALUE_DICT[operator](value)
+
+
 # 从字段转 sql
-def search_sql(sql, query: dict, table: Table):
+def search_sql(sql, query: dict, table: Table, bind: bool = False, fulltext: 'FullText' = None):
     """字段转 sql
         Args:
             sql ([type]):sql 语句
             query (dict): 查询条件字典
             table (Table): 表
+            bind (bool): 值使用绑定参数 配合 search_sql_params 使用
+            fulltext (FullText): dao 的全文索引字段 _match_ 条件需要
         Returns:
             [type]: [description]
     """
-    for key in query.keys():
-        if type(query[k]) is not list:
-            # 兼容处理
-            values = [query[key]]
+    index = 0
+    for key, operator, column, v in _iter_conditions(query):
+        if not bind or v is None:
+            v = _format_value(operator, v)
+        elif operator == '_in_':
+            v, index = [bindparam('_q%d' % i) for i in range(index, index + len(v))], index + len(v)
         else:
-            values = query[key]
-        
-        if key.startwith('_'): 
-            for query_key in OPERATOR_FUNC_DICT.keys():
-                if key.startswith(query_key):
-                    for v in values:
-                        sql = sql.where(OPERATOR_FUNC_DICT[query_key](table.c, key[len(query_key):], v))
+            v, index = bindparam('_q%d' % index), index + 1
+        if operator == '_match_':
+            sql = sql.where(match(getattr(table.c, column), v, fulltext))
         else:
-            sql = sql.where(OPERATOR_FUNC_DICT['='](table.c,key,v))
+            sql = sql.where(OPERATOR_FUNC_DICT[operator](table.c, column, v))
     return sql
 
 
+def search_sql_params(query: dict) -> dict:
+    """
+    search_sql(bind=True) 生成的语句对应的参数
+    :param query:
+    :return:
+    """
+    params = {}
+    for key, operator, column, v in _iter_conditions(query):
+        if v is None:
+            continue
+        if operator == '_in_':
+            for item in v:
+                params['_q%d' % len(params)] = item
+        else:
+            params['_q%d' % len(params)] = _format_value(operator, v)
+    return params
+
+
+def query_shape(query: dict) -> tuple:
+    """
+    查询条件的形状 形状相同的查询可以复用同一个预编译的语句
+    :param query:
+    :return:
+    """
+    shape = []
+    for key, operator, column, v in _iter_conditions(query):
+        if v is None:
+            shape.append((key, None))
+        elif operator == '_in_':
+            shape.append((key, len(v)))
+        else:
+            shape.append((key, 1))
+    return tuple(shape)
+
+
+class FieldError(ValueError):
+    """
+    不存在的字段
+    """
+
+
+def parse_fields(fields) -> list:
+    """
+    解析 _fields 参数
+    :param fields: 字段列表或者逗号分隔的字符串
+    :return: 为空时返回 None 表示全部字段
+    """
+    if not fields:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    fields = [f.strip() for f in fields if f and f.strip()]
+    return fields or None
+
+
+def check_fields(table: Table, fields: list = None):
+    """
+    检查字段是否都在表里
+    :param table:
+    :param fields:
+    :return:
+    """
+    unknown = [f for f in fields or [] if f not in table.c]
+    if unknown:
+        raise FieldError('unknown fields: {}'.format(', '.join(unknown)))
+
+
+def select_columns(table: Table, fields: list = None, required: list = None) -> list:
+    """
+    查询的字段 总是带上 id 和 required
+    :param table:
+    :param fields: 为 None 时查询全部字段
+    :param required: 必须查询的字段 例如游标分页的排序字段
+    :return:
+    """
+    if not fields:
+        return [table]
+    check_fields(table, fields)
+    names = (['id'] if 'id' in table.c else []) + list(required or []) + list(fields)
+    return [table.c[name] for name in dict.fromkeys(names)]
+
+
+class Row(Mapping):
+    """
+    只读的一行数据 值存在 tuple 里 同一个结果的行共用字段名到下标的映射
+    可以按字段名或者下标读取
+    """
+    __slots__ = ('_keymap', '_values')
+
+    def __init__(self, keymap: dict, values: tuple):
+        self._keymap = keymap
+        self._values = values
+
+    def __getitem__(self, key):
+        if type(key) is int:
+            return self._values[key]
+        return self._values[self._keymap[key]]
+
+    def __iter__(self):
+        return iter(self._keymap)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._keymap
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        index = self._keymap.get(key)
+        if index is None:
+            return default
+        return self._values[index]
+
+    def keys(self):
+        return self._keymap.keys()
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._keymap, self._values)
+
+
+class StatementCache:
+    """
+    预编译语句的 LRU 缓存
+    """
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteUpsert(Insert):
+    """
+    sqlite 的 INSERT ... ON CONFLICT DO UPDATE (需要 sqlite 3.24+)
+    sqlalchemy 1.2 还没有 sqlite 的 upsert
+    """
+
+    def __init__(self, table: Table, conflict_keys: list, update_cols: list, **kwargs):
+        super().__init__(table, **kwargs)
+        self.conflict_keys = list(conflict_keys)
+        self.update_cols = list(update_cols)
+
+
+@compiles(SqliteUpsert, 'sqlite')
+def _compile_sqlite_upsert(insert, compiler, **kwargs):
+    quote = compiler.preparer.quote
+    sql = compiler.visit_insert(insert, **kwargs)
+    sql += ' ON CONFLICT ({})'.format(', '.join(quote(k) for k in insert.conflict_keys))
+    if not insert.update_cols:
+        return sql + ' DO NOTHING'
+    return sql + ' DO UPDATE SET ' + ', '.join(
+        '{0} = excluded.{0}'.format(quote(c)) for c in insert.update_cols)
+
+
+@dataclass
+class FullText:
+    """
+    dao 的全文索引字段 __fulltext__ = FullText(columns=('name', 'note'))
+    mysql 每个字段需要单独的 FULLTEXT 索引
+    postgresql 使用 to_tsvector(config, 字段) 可以建同样表达式的 GIN 索引
+    sqlite 使用 FTS5 表 rowid 对应原表的 id
+    """
+    columns: tuple = ()
+    config: str = 'simple'  # postgresql 的分词配置
+    fts_table: str = None  # sqlite 的 FTS5 表 默认 <表名>_fts
+
+
+# 按相关度排序 Sorter(sort_by=RELEVANCE) 需要有 _match_ 条件
+RELEVANCE = '_relevance'
+
+
+class FullTextQuery(TypeDecorator):
+    """
+    全文检索的关键词 sqlite 把每个词转成 FTS5 的短语 避免用户输入被当成 FTS5 语法
+    """
+    impl = String
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != 'sqlite':
+            return value
+        return ' '.join('"{}"'.format(word.replace('"', '""')) for word in value.split()) or '""'
+
+
+def _fulltext(column, fulltext: FullText) -> FullText:
+    if fulltext is None or column.name not in fulltext.columns:
+        raise FieldError('{} is not a fulltext field'.format(column.name))
+    return fulltext
+
+
+def _fulltext_bind(value):
+    if isinstance(value, BindParameter):
+        return bindparam(value.key, type_=FullTextQuery())
+    return bindparam(None, value, type_=FullTextQuery())
+
+
+class Match(ColumnElement):
+    """
+    全文检索条件 按数据库生成不同的 sql
+    mysql 的 MATCH 返回相关度 不能用 Boolean 否则会生成 = 1
+    """
+    type = NullType()
+
+    def __init__(self, column, value, fulltext: FullText = None):
+        self.column = column
+        self.fulltext = _fulltext(column, fulltext)
+        self.value = _fulltext_bind(value)
+
+
+class MatchScore(ColumnElement):
+    """
+    全文检索的相关度 越大越相关
+    """
+    type = Float()
+
+    def __init__(self, column, value, fulltext: FullText = None):
+        self.column = column
+        self.fulltext = _fulltext(column, fulltext)
+        self.value = _fulltext_bind(value)
+
+
+def match(column, value, fulltext: FullText = None):
+    """
+    _match_ 操作符
+    :param column:
+    :param value: 关键词
+    :param fulltext: dao 的全文索引字段 没有声明这个字段时抛出 FieldError
+    :return:
+    """
+    if value is None:
+        return column.is_(None)
+    return Match(column, value, fulltext)
+
+
+@compiles(Match)
+def _compile_match(element, compiler, **kwargs):
+    # 没有全文检索的数据库退化为 LIKE
+    return compiler.process(element.column.contains(element.value), **kwargs)
+
+
+@compiles(MatchScore)
+def _compile_match_score(element, compiler, **kwargs):
+    return '0'
+
+
+@compiles(Match, 'mysql')
+@compiles(MatchScore, 'mysql')
+def _compile_mysql_match(element, compiler, **kwargs):
+    return 'MATCH ({}) AGAINST ({} IN NATURAL LANGUAGE MODE)'.format(
+        compiler.process(element.column, **kwargs), compiler.process(element.value, **kwargs))
+
+
+def _postgresql_tsquery(element, compiler, **kwargs) -> (str, str):
+    config = compiler.render_literal_value(element.fulltext.config, String())
+    return ('to_tsvector({}, {})'.format(config, compiler.process(element.column, **kwargs)),
+            'plainto_tsquery({}, {})'.format(config, compiler.process(element.value, **kwargs)))
+
+
+@compiles(Match, 'postgresql')
+def _compile_postgresql_match(element, compiler, **kwargs):
+    return '{} @@ {}'.format(*_postgresql_tsquery(element, compiler, **kwargs))
+
+
+@compiles(MatchScore, 'postgresql')
+def _compile_postgresql_match_score(element, compiler, **kwargs):
+    return 'ts_rank({}, {})'.format(*_postgresql_tsquery(element, compiler, **kwargs))
+
+
+def _sqlite_fts(element, compiler, **kwargs):
+    quote = compiler.preparer.quote
+    table = element.column.table
+    fts_table = quote(element.fulltext.fts_table or table.name + '_fts')
+    return fts_table, '{}.{} MATCH {}'.format(fts_table, quote(element.column.name),
+                                              compiler.process(element.value, **kwargs))
+
+
+@compiles(Match, 'sqlite')
+def _compile_sqlite_match(element, compiler, **kwargs):
+    fts_table, condition = _sqlite_fts(element, compiler, **kwargs)
+    return '{} IN (SELECT rowid FROM {} WHERE {})'.format(
+        compiler.process(element.column.table.c.id, **kwargs), fts_table, condition)
+
+
+@compiles(MatchScore, 'sqlite')
+def _compile_sqlite_match_score(element, compiler, **kwargs):
+    # FTS5 的 rank 越小越相关
+    fts_table, condition = _sqlite_fts(element, compiler, **kwargs)
+    return 'COALESCE(-(SELECT rank FROM {0} WHERE {1} AND {0}.rowid = {2}), 0)'.format(
+        fts_table, condition, compiler.process(element.column.table.c.id, **kwargs))
+
+
+def relevance_sql(query: dict, table: Table, bind: bool = False, fulltext: FullText = None):
+    """
+    第一个 _match_ 条件的相关度 用于排序
+    :param query:
+    :param table:
+    :param bind: 和 search_sql 的 bind 一致 复用同一个参数
+    :param fulltext: dao 的全文索引字段
+    :return: 没有 _match_ 条件时返回 None
+    """
+    index = 0
+    for key, operator, column, v in _iter_conditions(query or {}):
+        if v is None:
+            continue
+        if operator == '_match_':
+            return MatchScore(getattr(table.c, column), bindparam('_q%d' % index) if bind else v, fulltext)
+        index += len(v) if operator == '_in_' else 1
+    return None
+
+
 @dataclass
 class Pager:
     """
     分页
+    cursor 不为 None 时使用游标分页 忽略 page 空字符串表示第一页
+    next_cursor 查询后写入 下一页的游标
+    has_more 查询总数后写入 是否还有下一页
     """
     page: int = None
     per_page: int = None
+    cursor: str = None
+    next_cursor: str = None
+    has_more: bool = None
+
+
+# 查询总数的方式
+TOTAL_COUNT = 'count'  # 分别调用 dao.query 和 dao.count
+TOTAL_CONNECTION = 'connection'  # 两条语句在同一个连接上执行
+TOTAL_WINDOW = 'window'  # COUNT(*) OVER() 一条语句 不支持窗口函数时退化为 connection
+TOTAL_HAS_MORE = 'has_more'  # 多查一行判断是否有下一页 不查询总数
+
+
+def pager_limit_offset(pager: Pager) -> (int, int):
+    """
+    分页对应的 limit 和 offset
+    :param pager:
+    :return:
+    """
+    limit, offset = None, None
+    if pager is None:
+        return limit, offset
+    per_page = pager.per_page
+    page = pager.page
+    if pager.cursor is not None:
+        return per_page or 30, None
+    if per_page:
+        limit = per_page
+    if page:
+        if per_page is None:
+            limit, offset = 30, (page - 1) * 30
+        else:
+            offset = (page - 1) * per_page
+    return limit, offset
+
+
+class CursorError(ValueError):
+    """
+    无法解析的分页游标
+    """
+
+
+def _cursor_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def encode_cursor(values: list) -> str:
+    """
+    把最后一行的排序字段编码成不透明的游标
+    :param values: [排序字段的值, id]
+    :return:
+    """
+    data = json.dumps([_cursor_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str, columns: list) -> list:
+    """
+    解析游标 按字段的类型还原值
+    :param cursor:
+    :param columns: 游标对应的字段
+    :return:
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, TypeError, AttributeError):
+        raise CursorError('invalid cursor: {}'.format(cursor))
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise CursorError('invalid cursor: {}'.format(cursor))
+    result = []
+    for column, value in zip(columns, values):
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            python_type = None
+        try:
+            if value is None or python_type is None:
+                result.append(value)
+            elif python_type in (datetime.datetime, datetime.date, datetime.time):
+                result.append(python_type.fromisoformat(value))
+            else:
+                result.append(python_type(value))
+        except (ValueError, TypeError, decimal.InvalidOperation):
+            raise CursorError('invalid cursor: {}'.format(cursor))
+    return result
 
 
 @dataclass
@@ -1,32 +1,393 @@
+import asyncio
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from sqlalchemy.exc import ResourceClosedError
+from easyapi.unit_of_work import UnitOfWork
+
+logger = logging.getLogger(__name__)
+
+# 事务连接 -> 提交后执行的回调
+_after_commit = weakref.WeakKeyDictionary()
+# 事务连接 -> 缓冲的写入
+_units_of_work = weakref.WeakKeyDictionary()
+
+
+def after_commit(tx, callback):
+    """
+    事务提交后执行 callback 回滚时丢弃
+    不在 Transaction 管理的事务里时立即执行
+    :param tx: 事务的连接
+    :param callback:
+    :return:
+    """
+    callbacks = _after_commit.get(tx) if tx is not None else None
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+def _run_after_commit(tx):
+    for callback in _after_commit.pop(tx, []):
+        callback()
+
+
+def get_unit_of_work(tx):
+    """
+    事务缓冲写入的 UnitOfWork
+    :param tx: 事务的连接
+    :return: 没有开启 unit_of_work 时返回 None
+    """
+    if tx is None:
+        return None
+    return _units_of_work.get(tx)
+
+
+def flush(tx):
+    """
+    执行事务里缓冲的写入 在同一个事务里执行别的语句之前调用 保证读到自己的写入
+    :param tx: 事务的连接
+    :return: 执行的语句数
+    """
+    unit_of_work = get_unit_of_work(tx)
+    if unit_of_work is None:
+        return 0
+    return unit_of_work.flush()
+
+
+class LazyConnection:
+    """
+    延迟开始的事务连接 第一次使用时才从连接池取连接并开始事务
+    其他属性和方法转发到真正的连接
+    """
+
+    def __init__(self, begin):
+        """
+        :param begin: 取连接并开始事务 返回连接
+        """
+        self._begin = begin
+        self._conn = None
+        self._closed = False
+
+    @property
+    def acquired(self) -> bool:
+        return self._conn is not None
+
+    def _get(self):
+        if self._conn is None:
+            if self._closed:
+                raise ResourceClosedError('This transaction is closed')
+            self._conn = self._begin()
+        return self._conn
+
+    def _close(self):
+        self._closed = True
+
+    def __getattr__(self, item):
+        return getattr(self._get(), item)
+
+
 class Transaction():
 
-    def __init__(self, db):
+    def __init__(self, db, unit_of_work: bool = False, lazy: bool = False, read_only: bool = False):
+        """
+        :param db:
+        :param unit_of_work: 是否缓冲 dao 的插入 修改和删除 提交或者 flush 时合并执行
+        :param lazy: 第一条语句执行时才取连接 没有执行语句时不占用连接
+        :param read_only: 只读事务 有只读副本时在副本上执行
+        """
         self._db = db
         self._transaction = None
         self._connect = None
+        self._conn = None
+        self._unit_of_work = unit_of_work
+        self._lazy = lazy
+        self._read_only = read_only
+
+    def _begin(self):
+        self._conn, self._transaction = self._db._begin(read_only=self._read_only)
+        return self._conn
 
     def __enter__(self):
-        self._connect = self._db._engine.connect()
-        self._transaction = self._connect.begin()
+        self._transaction = None
+        self._conn = None
+        self._connect = LazyConnection(self._begin) if self._lazy else self._begin()
+        _after_commit[self._connect] = []
+        if self._unit_of_work:
+            _units_of_work[self._connect] = UnitOfWork(self._connect)
         return self._connect
 
+    def flush(self):
+        """
+        执行缓冲的写入
+        :return: 执行的语句数
+        """
+        return flush(self._connect)
+
+    def _close(self):
+        if self._lazy:
+            self._connect._close()
+        if self._conn is not None:
+            self._conn.close()
+
     def __exit__(self, exc_type, exc, tb):
         if exc_type is None and exc is None and tb is None:
             try:
-                self._transaction.commit()
+                flush(self._connect)
+                if self._transaction is not None:
+                    self._transaction.commit()
             except Exception as e:
-                self._transaction.rollback()
+                if self._transaction is not None:
+                    self._transaction.rollback()
+                _after_commit.pop(self._connect, None)
                 raise e
             finally:
-                self._connect.close()
+                _units_of_work.pop(self._connect, None)
+                self._close()
+            _run_after_commit(self._connect)
         else:
+            _after_commit.pop(self._connect, None)
+            _units_of_work.pop(self._connect, None)
             try:
-                self._transaction.rollback()
+                if self._transaction is not None:
+                    self._transaction.rollback()
             except Exception as e:
                 raise e
             finally:
-                self._connect.close()
+                self._close()
+
+
+def get_tx(db, unit_of_work: bool = False, lazy: bool = False, read_only: bool = False):
+    return Transaction(db, unit_of_work=unit_of_work, lazy=lazy, read_only=read_only)
+
+
+class AsyncTransaction():
+
+    def __init__(self, db):
+        self._db = db
+        self._connect = None
+
+    async def __aenter__(self):
+        self._connect = await self._db._acquire()
+        try:
+            await self._connect.begin()
+        except Exception as e:
+            await self._db.release(self._connect)
+            raise e
+        _after_commit[self._connect] = []
+        return self._connect
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None and exc is None and tb is None:
+            try:
+                await self._connect.commit()
+            except Exception as e:
+                await self._connect.rollback()
+                _after_commit.pop(self._connect, None)
+                raise e
+            finally:
+                await self._db.release(self._connect)
+            _run_after_commit(self._connect)
+        else:
+            _after_commit.pop(self._connect, None)
+            try:
+                await self._connect.rollback()
+            except Exception as e:
+                raise e
+            finally:
+                await self._db.release(self._connect)
+
+
+def get_async_tx(db):
+    return AsyncTransaction(db)
+
+
+# mysql 的错误码
+MYSQL_RETRY_CODES = {1213: 'deadlock', 1205: 'lock_wait'}
+# postgresql 的 SQLSTATE
+POSTGRES_RETRY_CODES = {'40P01': 'deadlock', '40001': 'serialization', '55P03': 'lock_wait'}
+# sqlite 的错误信息
+SQLITE_RETRY_MESSAGES = {'database is locked': 'busy', 'database table is locked': 'busy'}
+
+
+def retry_reason(e: Exception):
+    """
+    判断事务出错后能不能整个重新执行
+    :param e: sqlalchemy 的异常或者驱动的异常
+    :return: deadlock lock_wait serialization busy 不能重试时返回 None
+    """
+    orig = getattr(e, 'orig', None) or e
+    code = getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)
+    if code is not None:
+        return POSTGRES_RETRY_CODES.get(code)
+    args = getattr(orig, 'args', ())
+    if args and isinstance(args[0], int):
+        return MYSQL_RETRY_CODES.get(args[0])
+    if args and isinstance(args[0], str):
+        return SQLITE_RETRY_MESSAGES.get(args[0])
+    return None
+
+
+@dataclass
+class RetryPolicy:
+    """
+    事务重试的配置
+    第 n 次重试前等待 0 到 min(max_delay, base_delay * multiplier ** (n - 1)) 之间的随机秒数
+    """
+    attempts: int = 3  # 最多执行的次数 包括第一次
+    base_delay: float = 0.05
+    max_delay: float = 2.0
+    multiplier: float = 2.0
+
+    def delay(self, retry: int) -> float:
+        """
+        :param retry: 第几次重试 从 1 开始
+        :return: 等待的秒数
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** (retry - 1)))
+
+
+class RetryStats:
+    """
+    事务重试的统计 执行的事务数 按原因的重试次数 重试后成功和放弃的次数 等待的总时间
+    """
+
+    def __init__(self):
+        self.transactions = 0
+        self.retries = {}
+        self.recovered = 0
+        self.exhausted = 0
+        self.backoff_total = 0.0
+        self._lock = threading.Lock()
+
+    def record_transaction(self, retries: int):
+        with self._lock:
+            self.transactions += 1
+            if retries:
+                self.recovered += 1
+
+    def record_retry(self, reason: str, delay: float):
+        with self._lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+            self.backoff_total += delay
+
+    def record_exhausted(self):
+        with self._lock:
+            self.transactions += 1
+            self.exhausted += 1
+
+    def snapshot(self) -> dict:
+        """
+        当前的统计
+        :return:
+        """
+        with self._lock:
+            return {
+                'transactions': self.transactions,
+                'retries': dict(self.retries),
+                'recovered': self.recovered,
+                'exhausted': self.exhausted,
+                'backoff_total': self.backoff_total,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.transactions = 0
+            self.retries = {}
+            self.recovered = 0
+            self.exhausted = 0
+            self.backoff_total = 0.0
+
+
+# db -> 重试统计
+_retry_stats = weakref.WeakKeyDictionary()
+_retry_stats_lock = threading.Lock()
+
+
+def get_retry_stats(db) -> RetryStats:
+    with _retry_stats_lock:
+        stats = _retry_stats.get(db)
+        if stats is None:
+            stats = _retry_stats[db] = RetryStats()
+        return stats
+
+
+def _should_retry(e: Exception, attempt: int, policy: RetryPolicy, stats: RetryStats):
+    """
+    :return: 需要重试时返回等待的秒数 否则返回 None
+    """
+    reason = retry_reason(e)
+    if reason is None:
+        return None
+    if attempt >= policy.attempts:
+        stats.record_exhausted()
+        logger.warning('transaction %s after %s attempts, giving up', reason, attempt)
+        return None
+    delay = policy.delay(attempt)
+    stats.record_retry(reason, delay)
+    logger.info('transaction %s, retry %s in %.3fs', reason, attempt, delay)
+    return delay
+
+
+def retry_tx(db, policy: RetryPolicy = None, unit_of_work: bool = False):
+    """
+    在事务里执行被装饰的函数 死锁 锁等待超时 序列化失败时回滚后等待一段时间整个重新执行
+    函数的第一个参数是事务的连接 可能被执行多次 事务外的副作用需要能重复执行
+    支持同步和异步函数 异步函数使用 AsyncTransaction
+    :param db:
+    :param policy: 默认 RetryPolicy()
+    :param unit_of_work: 同步事务是否缓冲写入 参考 Transaction
+    :return:
+    """
+    if policy is None:
+        policy = RetryPolicy()
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                stats = get_retry_stats(db)
+                attempt = 1
+                while True:
+                    try:
+                        async with get_async_tx(db) as tx:
+                            res = await func(tx, *args, **kwargs)
+                    except Exception as e:
+                        delay = _should_retry(e, attempt, policy, stats)
+                        if delay is None:
+                            raise e
+                        await asyncio.sleep(delay)
+                        attempt += 1
+                        continue
+                    stats.record_transaction(attempt - 1)
+                    return res
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = get_retry_stats(db)
+            attempt = 1
+            while True:
+                try:
+                    with get_tx(db, unit_of_work=unit_of_work) as tx:
+                        res = func(tx, *args, **kwargs)
+                except Exception as e:
+                    delay = _should_retry(e, attempt, policy, stats)
+                    if delay is None:
+                        raise e
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                stats.record_transaction(attempt - 1)
+                return res
 
+        return wrapper
 
-def get_tx(db):
-    return Transaction(db)
+    return decorator
@@ -0,0 +1,236 @@
+import logging
+from collections import OrderedDict
+from sqlalchemy.exc import CircularDependencyError
+from sqlalchemy.sql import case
+from sqlalchemy.sql.util import sort_tables
+
+logger = logging.getLogger(__name__)
+
+
+def _id_key(where: dict):
+    """
+    按 id 修改时 合并同一行的修改使用的 key
+    :param where:
+    :return: 不是按单个 id 修改时返回 None
+    """
+    if where.get('id') is None or type(where['id']) in (list, tuple, set, dict):
+        return None
+    try:
+        key = tuple(sorted(where.items()))
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _where(sql, table, where: dict):
+    for key, value in where.items():
+        if hasattr(table.c, key):
+            sql = sql.where(getattr(table.c, key) == value)
+    return sql
+
+
+class _IdUpdates:
+    """
+    一组按 id 修改的语句 同一行的修改合并成一次
+    """
+
+    def __init__(self):
+        self.rows = OrderedDict()
+
+    def add(self, key: tuple, where: dict, data: dict) -> bool:
+        """
+        :param key:
+        :param where:
+        :param data:
+        :return: 不能合并时返回 False
+            前一次修改改了条件里的字段
+            或者同一行另一个条件的修改和这次修改的字段冲突 合并会跳过中间的那次修改
+        """
+        columns = set(where) | set(data)
+        for other_key, (other_where, other_data) in self.rows.items():
+            if other_key != key and other_where['id'] == where['id'] and \
+                    (columns & set(other_data) or set(other_where) & set(data)):
+                return False
+        row = self.rows.get(key)
+        if row is None:
+            self.rows[key] = (where, data)
+        elif any(k in row[1] for k in where):
+            return False
+        else:
+            self.rows[key] = (where, {**row[1], **data})
+        return True
+
+    def statements(self, table) -> list:
+        """
+        条件和修改的字段都相同的行合并成一条 CASE 语句
+        :param table:
+        :return:
+        """
+        groups = OrderedDict()
+        for where, data in self.rows.values():
+            other = tuple(sorted((k, v) for k, v in where.items() if k != 'id'))
+            groups.setdefault((other, tuple(data.keys())), []).append((where['id'], data))
+        statements = []
+        for (other, columns), rows in groups.items():
+            if len(rows) == 1:
+                _id, data = rows[0]
+                sql = table.update().where(table.c.id == _id)
+            else:
+                data = {c: case([(_id, row[c]) for _id, row in rows], value=table.c.id, else_=table.c[c])
+                        for c in columns}
+                sql = table.update().where(table.c.id.in_([_id for _id, _ in rows]))
+            statements.append(_where(sql, table, dict(other)).values(**data))
+        return statements
+
+
+class _TableWrites:
+    """
+    一张表缓冲的写入
+    插入和修改按原来的顺序分段 相邻的插入合并 相邻的按 id 修改合并 删除单独记录
+    """
+
+    def __init__(self, dao):
+        self.dao = dao
+        self.saves = []
+        self.deletes = OrderedDict()
+
+    def insert(self, rows: list):
+        if self.saves and type(self.saves[-1]) is list:
+            self.saves[-1].extend(rows)
+        else:
+            self.saves.append(list(rows))
+
+    def update(self, where: dict, data: dict):
+        key = _id_key(where)
+        if key is None:
+            # 按其他条件修改 不能和前后的修改合并
+            self.saves.append((where, data))
+            return
+        if self.saves and type(self.saves[-1]) is _IdUpdates and self.saves[-1].add(key, where, data):
+            return
+        self.saves.append(_IdUpdates())
+        self.saves[-1].add(key, where, data)
+
+    def delete(self, where: dict):
+        key = _id_key(where)
+        if key is None:
+            self.deletes[object()] = where
+            return
+        other = tuple(k for k in key if k[0] != 'id')
+        self.deletes.setdefault(other, []).append(where['id'])
+
+    def save_statements(self) -> list:
+        table = self.dao.__table__
+        statements = []
+        for item in self.saves:
+            if type(item) is list:
+                statements += [table.insert().values(chunk) for chunk in self.dao._chunk_rows(item)]
+            elif type(item) is _IdUpdates:
+                statements += item.statements(table)
+            else:
+                where, data = item
+                statements.append(_where(table.update(), table, where).values(**data))
+        return statements
+
+    def delete_statements(self) -> list:
+        table = self.dao.__table__
+        statements = []
+        for key, value in self.deletes.items():
+            if type(value) is dict:
+                statements.append(_where(table.delete(), table, value))
+            else:
+                ids = list(OrderedDict.fromkeys(value))
+                sql = table.delete().where(table.c.id == ids[0] if len(ids) == 1 else table.c.id.in_(ids))
+                statements.append(_where(sql, table, dict(key)))
+        return statements
+
+
+class UnitOfWork:
+    """
+    事务里缓冲的插入 修改和删除 flush 时合并成尽量少的语句执行
+    按外键依赖的顺序 先插入和修改父表 再倒序删除子表
+    同一张表删除之后的插入和修改会先 flush 之前缓冲的写入
+    缓冲的写入拿不到自增 id 和影响的行数 dao 返回 None
+    """
+
+    def __init__(self, conn):
+        """
+        :param conn: 事务的连接
+        """
+        self._conn = conn
+        self._tables = OrderedDict()
+        self._flushing = False
+
+    def _writes(self, dao) -> _TableWrites:
+        table = dao.__table__
+        writes = self._tables.get(table)
+        if writes is None:
+            writes = self._tables[table] = _TableWrites(dao)
+        return writes
+
+    def _save_writes(self, dao) -> _TableWrites:
+        """
+        删除在插入和修改之后执行 这张表有缓冲的删除时先 flush 保证后面的写入不会被提前
+        :param dao:
+        :return:
+        """
+        writes = self._writes(dao)
+        if writes.deletes:
+            self.flush()
+            writes = self._writes(dao)
+        return writes
+
+    def insert(self, dao, rows: list):
+        """
+        :param dao:
+        :param rows: reformatter 之后的行
+        :return:
+        """
+        self._save_writes(dao).insert(rows)
+
+    def update(self, dao, where: dict, data: dict):
+        """
+        :param dao:
+        :param where: reformatter 之后的条件
+        :param data: reformatter 之后的数据
+        :return:
+        """
+        self._save_writes(dao).update(where, data)
+
+    def delete(self, dao, where: dict):
+        self._writes(dao).delete(where)
+
+    def __bool__(self):
+        return bool(self._tables)
+
+    def _sorted_tables(self) -> list:
+        tables = list(self._tables.keys())
+        try:
+            order = sort_tables(tables)
+        except CircularDependencyError:
+            logger.warning('circular foreign keys, flush in write order')
+            return tables
+        return [t for t in order if t in self._tables]
+
+    def flush(self) -> int:
+        """
+        执行缓冲的写入
+        :return: 执行的语句数
+        """
+        if not self._tables or self._flushing:
+            return 0
+        tables = self._sorted_tables()
+        writes, self._tables = self._tables, OrderedDict()
+        statements = []
+        for table in tables:
+            statements += writes[table].save_statements()
+        for table in reversed(tables):
+            statements += writes[table].delete_statements()
+        self._flushing = True
+        try:
+            for sql in statements:
+                self._conn.execute(sql)
+        finally:
+            self._flushing = False
+        return len(statements)
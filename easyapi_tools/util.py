@@ -1,7 +1,9 @@
 import abc
 from decimal import Decimal
 from datetime import datetime, date, time
-from easyapi.sql import Pager, Sorter
+from sqlalchemy import Table
+from easyapi.sql import Pager, Sorter, Row, FieldError, parse_fields, check_fields
+from easyapi_tools.errors import BusinessError
 
 def str2hump(listx):
     listy = listx[0]
@@ -19,48 +21,154 @@ def str2hump(listx):
     return listy.lower()
 
 
+def value_to_json(value):
+    """
+    把 json 不支持的类型转换成字符串或数字
+    :param value:
+    :return:
+    """
+    if isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    elif isinstance(value, time):
+        return value.strftime("%H:%M:%S")
+    return value
+
+
 def type_to_json(data):
     new_data = dict()
     for key, value in data.items():
-        if isinstance(value, Decimal):
-            new_data[key] = float(value)
-        elif isinstance(value, datetime):
-            new_data[key] = value.strftime("%Y-%m-%d %H:%M:%S")
-        elif isinstance(value, date):
-            new_data[key] = value.strftime("%Y-%m-%d")
-        elif isinstance(value, time):
-            new_data[key] = value.strftime("%H:%M:%S")
-        else:
-            new_data[key] = value
+        new_data[key] = value_to_json(value)
     return new_data
 
 
+def _decimal_to_json(value):
+    if type(value) is Decimal:
+        return float(value)
+    return value_to_json(value)
+
+
+def _datetime_to_json(value):
+    if type(value) is datetime:
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value_to_json(value)
+
+
+def _date_to_json(value):
+    if type(value) is date:
+        return value.strftime("%Y-%m-%d")
+    return value_to_json(value)
+
+
+def _time_to_json(value):
+    if type(value) is time:
+        return value.strftime("%H:%M:%S")
+    return value_to_json(value)
+
+
+def row_to_dict(data) -> dict:
+    """
+    把一行数据复制成新的 dict
+    :param data: dict 或者数据库返回的行
+    :return:
+    """
+    if type(data) is Row:
+        return dict(data.items())
+    return dict(data)
+
+
+_TYPE_CONVERTERS = {
+    Decimal: _decimal_to_json,
+    datetime: _datetime_to_json,
+    date: _date_to_json,
+    time: _time_to_json,
+}
+
+
+def _column_converter(column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        # 不知道类型的字段 按值判断
+        return value_to_json
+    return _TYPE_CONVERTERS.get(python_type)
+
+
+def row_serializer(table: Table):
+    """
+    按表的字段类型生成行的转换函数 效果和 type_to_json 一样
+    只转换 Decimal 和日期时间类型的字段 其他字段原样复制
+    :param table:
+    :return: 函数 参数是一行数据 返回新的 dict
+    """
+    converters = tuple((c.name, converter) for c, converter in
+                       ((c, _column_converter(c)) for c in table.c) if converter is not None)
+    if not converters:
+        return row_to_dict
+
+    def serializer(data):
+        data = row_to_dict(data)
+        for key, converter in converters:
+            value = data.get(key)
+            if value is not None:
+                data[key] = converter(value)
+        return data
+
+    return serializer
+
+
 class AbcUrlCondition(metaclass=abc.ABCMeta):
 
     @classmethod
     @abc.abstractmethod
-    def parser(cls, args: dict) -> (dict, dict, dict):
+    def parser(cls, args: dict) -> (dict, Pager, Sorter):
+        """
+        解析url参数
+        :param args: 不包含 _fields
+        :return: (查询条件, 分页, 排序)
+        """
         raise NotImplementedError
 
+    @classmethod
+    def parse_fields(cls, args: dict, table: Table = None) -> list:
+        """
+        解析 _fields 参数 按表检查字段
+        :param args:
+        :param table:
+        :return: 返回的字段 为 None 时返回全部字段
+        """
+        fields = parse_fields(args.get('_fields')) if args else None
+        if table is not None:
+            try:
+                check_fields(table, fields)
+            except FieldError as e:
+                raise BusinessError(code=400, http_code=400, err_info=str(e))
+        return fields
+
 
 class DefaultUrlCondition(AbcUrlCondition):
 
     @classmethod
-    def parser(cls, args: dict) -> (dict, dict, dict):
+    def parser(cls, args: dict) -> (dict, Pager, Sorter):
         """
         默认的url参数条件解析
         :param args:
         :return:
         """
         query = {}
-        pager = Pager
-        sorter = Sorter
+        pager = Pager()
+        sorter = Sorter()
         if args:
             for k, v in args.items():
                 if k == '_per_page':
                     pager.per_page = v
                 elif k == '_page':
                     pager.page = v
+                elif k == '_cursor':
+                    pager.cursor = v
                 elif k == '_order_by':
                     sorter.sort_by = v
                 elif k == '_desc':
@@ -68,3 +176,34 @@ class DefaultUrlCondition(AbcUrlCondition):
                 else:
                     query[k] = v
         return query, pager, sorter
+
+
+def parse_url_fields(url_condition, args: dict, table: Table = None) -> list:
+    """
+    用 url_condition 的 parse_fields 解析 _fields 没有继承 AbcUrlCondition 时使用默认的解析
+    :param url_condition:
+    :param args:
+    :param table:
+    :return:
+    """
+    parse = getattr(url_condition, 'parse_fields', None) or AbcUrlCondition.parse_fields
+    return parse(args, table=table)
+
+
+def parse_url_args(url_condition, args: dict, table: Table = None) -> (dict, Pager, Sorter, list):
+    """
+    解析查询的参数 _fields 单独解析 不传给 parser
+    parser 返回 (查询条件, 分页, 排序) 或者在最后带上返回的字段
+    :param url_condition:
+    :param args:
+    :param table:
+    :return: (查询条件, 分页, 排序, 返回的字段)
+    """
+    fields = parse_url_fields(url_condition, args, table=table)
+    if args and '_fields' in args:
+        args = {k: v for k, v in args.items() if k != '_fields'}
+    parsed = url_condition.parser(args)
+    query, pager, sorter = parsed[:3]
+    if len(parsed) > 3 and parsed[3] is not None:
+        fields = parsed[3]
+    return query, pager, sorter, fields
@@ -7,3 +7,17 @@ class AbcValidator(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def validate(cls, data):
         pass
+
+    @classmethod
+    def validate_many(cls, data_list: list):
+        """
+        批量检验 可以重载成整批一起检验
+        :param data_list:
+        :return: {行号: 错误} 没有错误返回空
+        """
+        errors = {}
+        for index, data in enumerate(data_list):
+            err = cls.validate(data)
+            if err:
+                errors[index] = err
+        return errors
@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+import easyapi
+
+
+@pytest.fixture(scope="module")
+def async_session(request, db_session):
+    loop = asyncio.new_event_loop()
+    mysql_db = easyapi.AsyncMysqlDB(
+        host=request.config.getoption("db_host"),
+        port=request.config.getoption("db_port"),
+        user=request.config.getoption("db_user"),
+        password=request.config.getoption("db_password"),
+        database='easy_api_for_test'
+    )
+    loop.run_until_complete(mysql_db.connect())
+
+    class UserDao(easyapi.AsyncBusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = mysql_db
+
+    yield {
+        'loop': loop,
+        'db': mysql_db,
+        'dao': UserDao
+    }
+    loop.run_until_complete(mysql_db.close())
+    loop.close()
+
+
+@pytest.mark.run(order=1)
+def test_async_curd(db_session, async_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    loop = async_session['loop']
+    dao = async_session['dao']
+
+    user_id = loop.run_until_complete(dao.insert(data={'name': 'test', 'note': 'test'}))
+    user = loop.run_until_complete(dao.get(query={'id': user_id}))
+    assert user['name'] == 'test'
+
+    count = loop.run_until_complete(dao.update(where_dict={'id': user_id}, data={'name': 'test1'}))
+    assert count == 1
+    users = loop.run_until_complete(dao.query(query={dao._like_name: 'test'}))
+    assert len(users) == 1
+    assert users[0]['name'] == 'test1'
+
+    loop.run_until_complete(dao.delete(where_dict={'id': user_id}))
+    assert loop.run_until_complete(dao.get(query={'id': user_id})) is None
+
+
+@pytest.mark.run(order=2)
+def test_async_transaction(db_session, async_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    loop = async_session['loop']
+    db = async_session['db']
+    dao = async_session['dao']
+
+    async def insert_and_fail():
+        async with easyapi.get_async_tx(db) as tx:
+            ctx = easyapi.EasyApiContext(tx)
+            await dao.insert(ctx=ctx, data={'name': 'test', 'note': 'test'})
+            raise ValueError()
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(insert_and_fail())
+    assert loop.run_until_complete(dao.count()) == 0
+
+
+@pytest.mark.run(order=3)
+def test_async_load(db_session, async_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    loop = async_session['loop']
+    dao = async_session['dao']
+    # mysql 拿不到 insert_many 生成的 id 使用指定的 id
+    rows = [{'id': i + 1, 'name': 'test{}'.format(i)} for i in range(3)]
+    loop.run_until_complete(dao.insert_many(rows=rows))
+    ids = [row['id'] for row in rows]
+
+    async def load():
+        ctx = easyapi.EasyApiContext()
+        return await asyncio.gather(*[dao.load(ctx, i) for i in [ids[2], ids[0], 0]])
+
+    users = loop.run_until_complete(load())
+    assert [u and u['name'] for u in users] == ['test2', 'test0', None]
+
+    # 排队中 clear 的 key 也能拿到结果
+    async def load_and_clear():
+        loader = dao._loader(easyapi.EasyApiContext())
+        future = loader.load(ids[1])
+        loader.clear()
+        return await asyncio.wait_for(future, 5)
+
+    assert loop.run_until_complete(load_and_clear())['name'] == 'test1'
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+import quart
+import easyapi
+
+
+@pytest.fixture(scope="module")
+def async_app(request, db_session):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    mysql_db = easyapi.AsyncMysqlDB(
+        host=request.config.getoption("db_host"),
+        port=request.config.getoption("db_port"),
+        user=request.config.getoption("db_user"),
+        password=request.config.getoption("db_password"),
+        database='easy_api_for_test'
+    )
+    loop.run_until_complete(mysql_db.connect())
+
+    class UserDao(easyapi.AsyncBusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = mysql_db
+
+    class UserController(easyapi.AsyncBaseController):
+        __dao__ = UserDao
+
+    class UserHandler(easyapi.AsyncBaseHandler):
+        __controller__ = UserController
+
+    app = quart.Quart(__name__)
+    easyapi.register_async_api(app=app, view=UserHandler, endpoint='user_api', url='/users')
+    yield loop, app
+    loop.run_until_complete(mysql_db.close())
+    loop.close()
+
+
+@pytest.mark.run(order=1)
+def test_async_post_and_query(db_session, async_app):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    loop, app = async_app
+
+    async def run():
+        client = app.test_client()
+        resp = await client.post('/users', json={'name': 'test1', 'note': 'test'})
+        assert resp.status_code == 200
+        user_id = (await resp.get_json())['id']
+
+        resp = await client.get('/users/{}'.format(user_id))
+        assert (await resp.get_json())['user']['name'] == 'test1'
+
+        resp = await client.put('/users/{}'.format(user_id), json={'name': 'test2'})
+        assert (await resp.get_json())['count'] == 1
+
+        resp = await client.post('/users', json={'_method': 'GET', '_args': {'name': 'test2'}})
+        data = await resp.get_json()
+        assert data['total'] == 1
+        assert len(data['users']) == 1
+
+        resp = await client.delete('/users/{}'.format(user_id))
+        assert (await resp.get_json())['count'] == 1
+        resp = await client.get('/users/{}'.format(user_id))
+        assert resp.status_code == 404
+
+    loop.run_until_complete(run())
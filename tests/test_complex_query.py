@@ -4,6 +4,9 @@ import easyapi
 import pymysql
 import flask as fk
 import requests
+from easyapi_tools.util import type_to_json
+from sqlalchemy.sql import select
+from easyapi.sql import FieldError
 
 @pytest.mark.run(order=1)
 def test_post_and_handler(esayapi_session):
@@ -15,4 +18,399 @@ def test_post_and_handler(esayapi_session):
     
     user = dao.query(query={dao._like_name: 'test'})
     
-    assert user != 0
\ No newline at end of file
+    assert user != 0
+
+@pytest.mark.run(order=2)
+def test_query_with_total(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    for i in range(3):
+        dao.insert(data={'name': 'test{}'.format(i), 'note': 'test'})
+
+    for total in (easyapi.TOTAL_COUNT, easyapi.TOTAL_CONNECTION, easyapi.TOTAL_WINDOW):
+        pager = easyapi.Pager(page=1, per_page=2)
+        users, count = dao.query_with_total(pager=pager, total=total)
+        assert len(users) == 2
+        assert count == 3
+        assert pager.has_more
+
+    pager = easyapi.Pager(page=2, per_page=2)
+    users, count = dao.query_with_total(pager=pager, total=easyapi.TOTAL_HAS_MORE)
+    assert len(users) == 1
+    assert count is None
+    assert not pager.has_more
+
+
+@pytest.mark.run(order=3)
+def test_insert_many(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    rows = [{'name': 'test{}'.format(i), 'note': 'test'} for i in range(25)]
+    dao.insert_many(rows=rows, chunk_size=10)
+    assert dao.count() == 25
+
+
+@pytest.mark.run(order=4)
+def test_upsert_and_update_many(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    dao.upsert_many(rows=[{'id': 1, 'name': 'test1'}, {'id': 2, 'name': 'test2'}])
+    dao.upsert(data={'id': 1, 'name': 'test3'})
+    assert dao.count() == 2
+    assert dao.get(query={'id': 1})['name'] == 'test3'
+
+    dao.update_many(rows=[{'id': 1, 'note': 'a'}, {'id': 2, 'note': 'b'}])
+    assert dao.get(query={'id': 1})['note'] == 'a'
+    assert dao.get(query={'id': 2})['note'] == 'b'
+
+
+@pytest.mark.run(order=5)
+def test_load_many(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    # mysql 拿不到 insert_many 生成的 id 使用指定的 id
+    rows = [{'id': i + 1, 'name': 'test{}'.format(i), 'note': 'test'} for i in range(3)]
+    dao.insert_many(rows=rows)
+    ids = [row['id'] for row in rows]
+    dao.delete(where_dict={'id': ids[2]})
+
+    ctx = easyapi.EasyApiContext()
+    users = dao.load_many(ctx, [ids[1], ids[0], ids[1], ids[2]])
+    assert [u and u['name'] for u in users] == ['test1', 'test0', 'test1', None]
+    assert dao.load(ctx, ids[0]) is users[1]
+
+    dao.update(ctx=ctx, where_dict={'id': ids[0]}, data={'name': 'test3'})
+    assert dao.load(ctx, ids[0])['name'] == 'test3'
+
+
+@pytest.mark.run(order=6)
+def test_read_replica(request, db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    primary = esayapi_session['db']
+    db = easyapi.MysqlDB(
+        host=primary.host,
+        port=primary.port,
+        user=primary.user,
+        password=primary.password,
+        database=primary.database,
+        replicas=[{'weight': 1}],
+        routing=easyapi.ROUTING_LEAST_CONNECTIONS
+    )
+    db.connect()
+
+    class UserDao(easyapi.BusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    ctx = easyapi.EasyApiContext(read_your_writes=60)
+    query_sql, _ = UserDao._query_sql(ctx=ctx)
+    assert db._route(ctx, query_sql) is db._replicas.engines[0]
+
+    UserDao.insert(ctx=ctx, data={'name': 'test', 'note': 'test'})
+    assert db._route(ctx, query_sql) is db._engine
+    assert UserDao.count(ctx=ctx) == 1
+
+
+@pytest.mark.run(order=7)
+def test_pool_config(esayapi_session):
+    primary = esayapi_session['db']
+    db = easyapi.MysqlDB(
+        host=primary.host,
+        port=primary.port,
+        user=primary.user,
+        password=primary.password,
+        database=primary.database,
+        pool_config=easyapi.PoolConfig(size=2, max_overflow=0, pre_ping=easyapi.PRE_PING_IDLE, warm_up=2)
+    )
+    db.connect()
+
+    class UserDao(easyapi.BusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    UserDao.count()
+    stats = db.pool_stats()['primary']
+    assert stats['size'] == 2
+    assert stats['connects'] == 2
+    assert stats['checked_out'] == 0
+    assert sum(stats['wait_histogram'].values()) >= 1
+
+
+@pytest.mark.run(order=8)
+def test_schema_snapshot(tmp_path, esayapi_session):
+    primary = esayapi_session['db']
+    snapshot = str(tmp_path / 'schema.pickle')
+
+    def connect():
+        db = easyapi.MysqlDB(
+            host=primary.host,
+            port=primary.port,
+            user=primary.user,
+            password=primary.password,
+            database=primary.database,
+            schema_snapshot=snapshot
+        )
+        db.connect()
+        return db
+
+    db = connect()
+    assert 'users' not in db._tables
+    assert db['users'].name == 'users'
+    assert list(db._tables.keys()) == ['users']
+    assert db.save_schema()
+    assert not db.save_schema()
+
+    db = connect()
+    assert 'users' in db._tables
+    assert not db.save_schema()
+
+
+@pytest.mark.run(order=9)
+def test_get_cache(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    db = esayapi_session['db']
+    cache = easyapi.LRU(maxsize=10, ttl=60)
+
+    class UserDao(easyapi.BusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+        __cache__ = cache
+
+    user_id = UserDao.insert(data={'name': 'test', 'note': 'test'})
+    assert UserDao.get(query={'id': user_id})['name'] == 'test'
+    assert len(cache) == 1
+
+    with easyapi.get_tx(db) as tx:
+        ctx = easyapi.EasyApiContext(tx)
+        UserDao.update(ctx=ctx, where_dict={'id': user_id}, data={'name': 'test1'})
+        assert len(cache) == 1
+    assert len(cache) == 0
+    assert UserDao.get(query={'id': user_id})['name'] == 'test1'
+
+    # 事务外的修改在语句执行之后才让缓存失效
+    seen = []
+    delete = cache.delete
+
+    def record(keys):
+        sql = select([UserDao.__table__.c.name]).where(UserDao.__table__.c.id == user_id)
+        seen.append(db.execute(easyapi.EasyApiContext(), sql).scalar())
+        delete(keys)
+
+    cache.delete = record
+    UserDao.update(where_dict={'id': user_id}, data={'name': 'test2'})
+    assert seen == ['test2']
+    del cache.delete
+
+    # reformatter 加了过滤条件时不走缓存
+    class TenantDao(easyapi.BaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+        __cache__ = easyapi.LRU(maxsize=10, ttl=60)
+
+        @classmethod
+        def reformatter(cls, ctx=None, data=None):
+            data = super().reformatter(ctx=ctx, data=data)
+            if ctx is not None and ctx.read('tenant') is not None:
+                data = {**data, 'name': ctx.read('tenant')}
+            return data
+
+    ctx_a, ctx_b = easyapi.EasyApiContext(), easyapi.EasyApiContext()
+    ctx_a.set('tenant', 'test2')
+    ctx_b.set('tenant', 'other')
+    assert TenantDao.get(ctx=ctx_a, query={'id': user_id})['name'] == 'test2'
+    assert TenantDao.get(ctx=ctx_b, query={'id': user_id}) is None
+    assert len(TenantDao.__cache__) == 0
+
+    UserDao.delete(where_dict={'id': user_id})
+    assert UserDao.get(query={'id': user_id}) is None
+
+
+@pytest.mark.run(order=10)
+def test_row_serializer(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    user_id = dao.insert(data={'name': 'test', 'note': 'test'})
+    row = esayapi_session['db'].execute(easyapi.EasyApiContext(),
+                                        dao.__table__.select().where(dao.__table__.c.id == user_id)).first()
+    assert dao.formatter(data=row) == type_to_json(row)
+    assert isinstance(dao.get(query={'id': user_id})['created_at'], str)
+    # orjson 是可选依赖
+    pytest.importorskip('orjson')
+    assert easyapi.OrjsonEncoder().dumps({'id': user_id}) == easyapi.StdJsonEncoder().dumps({'id': user_id})
+
+
+@pytest.mark.run(order=11)
+def test_no_copy(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    data = {'name': 'test', 'note': 'test'}
+    user_id = dao.insert(data=data)
+    assert data == {'name': 'test', 'note': 'test'}
+
+    query = {'id': user_id}
+    user = dao.get(query=query)
+    assert query == {'id': user_id}
+    assert dao.get(query=query) is not user
+
+    class UserController(easyapi.BaseController):
+        __dao__ = dao
+
+    assert UserController.formatter(ctx=None, data=user) is user
+
+
+@pytest.mark.run(order=12)
+def test_format_many(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    for i in range(3):
+        dao.insert(data={'name': 'test{}'.format(i), 'note': 'test'})
+    pages = []
+
+    class UserController(easyapi.BaseController):
+        __dao__ = dao
+
+        @classmethod
+        def format_many(cls, ctx, rows):
+            pages.append(len(rows))
+            return [{**row, 'rank': i} for i, row in enumerate(rows)]
+
+    users, total = UserController.query(pager=easyapi.Pager(page=1, per_page=2))
+    assert pages == [2]
+    assert [user['rank'] for user in users] == [0, 1]
+
+
+@pytest.mark.run(order=13)
+def test_instrument(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    primary = esayapi_session['db']
+    db = easyapi.MysqlDB(
+        host=primary.host,
+        port=primary.port,
+        user=primary.user,
+        password=primary.password,
+        database=primary.database
+    )
+    db.connect()
+    stats = easyapi.QueryStats()
+    db.add_instrument(stats)
+    db.add_instrument(easyapi.SlowQueryLog(threshold=1))
+
+    class UserDao(easyapi.BusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    user_id = UserDao.insert(data={'name': 'test', 'note': 'test'})
+    UserDao.get(query={'id': user_id})
+    UserDao.query(query={'_in_id': [user_id]})
+    UserDao.query(query={'_in_id': [user_id, user_id + 1]})
+
+    operations = {(item['dao'], item['operation']): item for item in stats.snapshot().values()}
+    assert operations[('UserDao', 'insert')]['count'] == 1
+    assert operations[('UserDao', 'get')]['rows'] == 1
+    # IN 的长度不同是同一个指纹
+    assert operations[('UserDao', 'query')]['count'] == 2
+
+
+@pytest.mark.run(order=14)
+def test_index_advisor(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    db = esayapi_session['db']
+    db.advisor = easyapi.IndexAdvisor()
+
+    class UserDao(easyapi.BaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    try:
+        UserDao.insert(data={'name': 'test', 'note': 'test'})
+        UserDao.query(query={'name': 'test'})
+        UserDao.query(query={'name': 'other'})
+        UserDao.query(query={'_search_note': 'te'})
+        UserDao.get(query={'id': 1})
+
+        report = {tuple(item['conditions']): item for item in db.advisor.report()}
+        # 只记录形状 值不同是同一种查询
+        assert report[('name',)]['count'] == 2
+        assert report[('name',)]['suggest'] == ['name']
+        assert report[('_search_note',)]['no_index'] == ['_search_note']
+        assert report[('id',)]['index'] == 'PRIMARY'
+        assert ('users', ('name',)) in db.advisor.missing_indexes()
+    finally:
+        db.advisor = None
+
+
+@pytest.mark.run(order=15)
+def test_match(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+        cursor.execute("""
+            alter table users add fulltext index ft_note (note);
+        """)
+    db = esayapi_session['db']
+
+    class UserDao(easyapi.BaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+        __fulltext__ = ('note',)
+
+    try:
+        UserDao.insert_many(rows=[
+            {'name': 'test1', 'note': 'apple banana'},
+            {'name': 'test2', 'note': 'banana banana cherry'},
+            {'name': 'test3', 'note': 'durian'},
+        ])
+        assert UserDao._match_note == '_match_note'
+        data = UserDao.query(query={UserDao._match_note: 'banana'}, sorter=easyapi.Sorter(sort_by=easyapi.RELEVANCE))
+        assert [row['name'] for row in data] == ['test2', 'test1']
+        assert UserDao.count(query={UserDao._match_note: 'durian'}) == 1
+        with pytest.raises(FieldError):
+            UserDao.query(query={'_match_name': 'test'})
+
+        # 全文索引字段属于 dao 同一张表的其他 dao 不受影响
+        class PlainUserDao(easyapi.BaseDao):
+            __tablename__ = 'users'
+            __db__ = db
+
+        with pytest.raises(FieldError):
+            PlainUserDao.query(query={'_match_note': 'banana'})
+        assert UserDao.count(query={UserDao._match_note: 'banana'}) == 2
+    finally:
+        with db_session.cursor() as cursor:
+            cursor.execute("""
+                alter table users drop index ft_note;
+            """)
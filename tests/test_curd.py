@@ -1,6 +1,8 @@
 import pytest
+import json
 import threading
 import easyapi
+import easyapi_tools.util
 import pymysql
 import flask as fk
 import requests
@@ -90,3 +92,140 @@ def test_post_and_query(db_session):
     resp = req.json()
     assert resp['code'] == 200
     assert len(resp['users']) == 1
+
+
+@pytest.mark.run(order=3)
+def test_cursor_query(db_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    for i in range(5):
+        req = requests.post('http://127.0.0.1:5000/users', json={
+            'name': 'test{}'.format(i),
+            'note': 'test'
+        })
+        assert req.status_code == 200
+
+    ids = []
+    next_cursor = ''
+    while next_cursor is not None:
+        req = requests.post('http://127.0.0.1:5000/users', json={
+            "_method": "GET",
+            "_args": {
+                '_per_page': 2,
+                '_cursor': next_cursor
+            }
+        })
+        assert req.status_code == 200
+        resp = req.json()
+        ids += [user['id'] for user in resp['users']]
+        next_cursor = resp['next_cursor']
+    assert ids == [5, 4, 3, 2, 1]
+
+
+@pytest.mark.run(order=4)
+def test_fields(db_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    req = requests.post('http://127.0.0.1:5000/users', json={
+        'name': 'test',
+        'note': 'test'
+    })
+    user_id = req.json()['id']
+
+    req = requests.post('http://127.0.0.1:5000/users', json={
+        "_method": "GET",
+        "_args": {
+            '_fields': ['name']
+        }
+    })
+    assert req.status_code == 200
+    assert req.json()['users'] == [{'id': user_id, 'name': 'test'}]
+
+    req = requests.get(f"http://127.0.0.1:5000/users/{user_id}?_fields=note")
+    assert req.json()['user'] == {'id': user_id, 'note': 'test'}
+
+    req = requests.post('http://127.0.0.1:5000/users', json={
+        "_method": "GET",
+        "_args": {
+            '_fields': ['unknown']
+        }
+    })
+    assert req.status_code == 400
+
+
+@pytest.mark.run(order=4)
+def test_legacy_url_condition(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+
+    # 只实现 parser(args) 返回三个值的旧写法
+    class LegacyUrlCondition(easyapi_tools.util.AbcUrlCondition):
+
+        @classmethod
+        def parser(cls, args: dict):
+            query, pager, sorter = {}, easyapi.Pager(), easyapi.Sorter()
+            for k, v in (args or {}).items():
+                query[k] = v
+            return query, pager, sorter
+
+    class LegacyHandler(easyapi.FlaskBaseHandler):
+        __controller__ = esayapi_session['controller']
+        __resource__ = 'user'
+        __url_condition__ = LegacyUrlCondition
+
+    app = fk.Flask(__name__)
+    easyapi.register_api(app=app, view=LegacyHandler, endpoint='legacy_api', url='/legacy')
+    client = app.test_client()
+    user_id = client.post('/legacy', json={'name': 'test', 'note': 'test'}).get_json()['id']
+
+    resp = client.post('/legacy', json={'_method': 'GET', '_args': {'name': 'test', '_fields': ['name']}})
+    assert resp.status_code == 200
+    assert resp.get_json()['users'] == [{'id': user_id, 'name': 'test'}]
+    assert client.get('/legacy/{}'.format(user_id)).get_json()['user']['note'] == 'test'
+
+
+@pytest.mark.run(order=5)
+def test_stream(db_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    for i in range(3):
+        requests.post('http://127.0.0.1:5000/users', json={
+            'name': 'test%d' % i,
+            'note': 'test'
+        })
+
+    req = requests.post('http://127.0.0.1:5000/users', json={
+        "_method": "GET",
+        "_stream": "ndjson",
+        "_args": {
+            '_fields': ['name'],
+            '_order_by': 'name',
+            '_desc': False
+        }
+    }, stream=True)
+    assert req.headers['Content-Type'] == 'application/x-ndjson'
+    assert [json.loads(line)['name'] for line in req.iter_lines() if line] == ['test0', 'test1', 'test2']
+
+    req = requests.post('http://127.0.0.1:5000/users', json={
+        "_method": "GET",
+        "_stream": "json"
+    })
+    assert req.json()['code'] == 200
+    assert len(req.json()['users']) == 3
+
+    req = requests.post('http://127.0.0.1:5000/users', json={
+        "_method": "GET",
+        "_stream": "ndjson",
+        "_args": {
+            '_fields': ['unknown']
+        }
+    })
+    assert req.status_code == 400
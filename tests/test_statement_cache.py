@@ -0,0 +1,27 @@
+import pytest
+import easyapi
+
+
+@pytest.mark.run(order=1)
+def test_statement_cache(db_session, esayapi_session):
+    with db_session.cursor() as cursor:
+        cursor.execute("""
+            truncate table users;
+        """)
+    dao = esayapi_session['dao']
+    dao.__statement_cache__.clear()
+    dao.insert(data={'name': 'test1', 'note': 'test'})
+    dao.insert(data={'name': 'test2', 'note': 'test'})
+
+    users = dao.query(query={dao._like_name: 'test1'}, pager=easyapi.Pager(page=1, per_page=10))
+    assert len(users) == 1
+    users = dao.query(query={dao._like_name: 'test'}, pager=easyapi.Pager(page=1, per_page=10))
+    assert len(users) == 2
+    # 形状相同 复用同一个语句
+    assert len(dao.__statement_cache__) == 1
+
+    users = dao.query(query={dao._in_name: ['test1', 'test2']})
+    assert len(users) == 2
+    users = dao.query(query={dao._in_name: ['test1']})
+    assert len(users) == 1
+    assert len(dao.__statement_cache__) == 3
@@ -1,4 +1,5 @@
 import pytest
+import sqlite3
 import threading
 import easyapi
 import pymysql
@@ -32,3 +33,249 @@ import requests
 #     new_share = ShareDao.get()
 #     assert old_share['id'] == new_share['id']
 #     assert old_user['id'] == new_user['id']
+
+
+@pytest.mark.run(order=2)
+def test_sqlite_transaction(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE users (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          name VARCHAR(32) NOT NULL DEFAULT '',
+          note VARCHAR(234) NOT NULL DEFAULT '123',
+          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+          updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+          deleted_at TIMESTAMP NULL,
+          updated_by VARCHAR(255) NULL,
+          created_by VARCHAR(255) NOT NULL DEFAULT ''
+        )
+    """)
+    conn.close()
+    db = easyapi.SqliteDB(path, write_queue=True)
+    db.connect()
+
+    class UserDao(easyapi.BusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    try:
+        assert db.execute(None, 'PRAGMA journal_mode').scalar() == 'wal'
+        with easyapi.get_tx(db) as tx:
+            ctx = easyapi.EasyApiContext(tx)
+            user_id = UserDao.insert(ctx=ctx, data={'name': 'test1', 'note': 'test'})
+            UserDao.update(ctx=ctx, where_dict={'id': user_id}, data={'note': 'updated'})
+        with pytest.raises(RuntimeError):
+            with easyapi.get_tx(db) as tx:
+                UserDao.insert(ctx=easyapi.EasyApiContext(tx), data={'name': 'test2', 'note': 'test'})
+                raise RuntimeError()
+        assert [(u['name'], u['note']) for u in UserDao.query()] == [('test1', 'updated')]
+
+        # 多个线程同时写 写语句在一个线程里排队提交
+        def insert(n):
+            for i in range(20):
+                UserDao.insert(data={'name': 'thread{}'.format(n), 'note': str(i)})
+                UserDao.query(query={'name': 'thread{}'.format(n)})
+
+        threads = [threading.Thread(target=insert, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert UserDao.count() == 81
+    finally:
+        db.close()
+
+
+def test_sqlite_thread_connection(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(32) NOT NULL DEFAULT '')")
+    conn.execute("INSERT INTO users (name) VALUES ('test1')")
+    conn.commit()
+    conn.close()
+    db = easyapi.SqliteDB(path, pool_config=easyapi.PoolConfig(size=4, max_overflow=0, timeout=2))
+    db.connect()
+
+    class UserDao(easyapi.BaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    # 存活的线程各自持有连接 不占用事务的连接池
+    ready = threading.Barrier(5)
+    done = threading.Event()
+
+    def worker():
+        UserDao.get(query={'id': 1})
+        ready.wait()
+        done.wait()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        ready.wait()
+        with easyapi.get_tx(db) as tx:
+            UserDao.update(ctx=easyapi.EasyApiContext(tx), where_dict={'id': 1}, data={'name': 'test2'})
+        assert UserDao.get(query={'id': 1})['name'] == 'test2'
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+        db.close()
+
+
+def test_sqlite_unit_of_work(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE users (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          name VARCHAR(32) NOT NULL DEFAULT '',
+          note VARCHAR(234) NOT NULL DEFAULT '123',
+          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+          updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+          deleted_at TIMESTAMP NULL,
+          updated_by VARCHAR(255) NULL,
+          created_by VARCHAR(255) NOT NULL DEFAULT ''
+        );
+        INSERT INTO users (name) VALUES ('test1'), ('test2'), ('test3');
+        CREATE TABLE shares (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          username VARCHAR(32) NOT NULL DEFAULT '',
+          note VARCHAR(234) NOT NULL DEFAULT '123'
+        );
+        INSERT INTO shares (username) VALUES ('test1'), ('test1');
+    """)
+    conn.close()
+    db = easyapi.SqliteDB(path)
+    db.connect()
+
+    class UserDao(easyapi.BusinessBaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    class ShareDao(easyapi.BaseDao):
+        __tablename__ = 'shares'
+        __db__ = db
+
+    try:
+        tx = easyapi.get_tx(db, unit_of_work=True)
+        with tx as conn:
+            ctx = easyapi.EasyApiContext(conn)
+            for i in range(3):
+                assert UserDao.insert(ctx=ctx, data={'name': 'new{}'.format(i)}) is None
+            for user_id in (1, 2):
+                UserDao.update(ctx=ctx, where_dict={'id': user_id}, data={'note': 'note{}'.format(user_id)})
+                UserDao.update(ctx=ctx, where_dict={'id': user_id}, data={'updated_by': 'test'})
+            # 一条插入 一条 CASE 修改
+            assert tx.flush() == 2
+            UserDao.delete(ctx=ctx, where_dict={'id': 3})
+            # 查询之前自动 flush
+            assert UserDao.get(ctx=ctx, query={'id': 3}) is None
+            assert UserDao.count(ctx=ctx) == 5
+            assert UserDao.count(ctx=ctx, unscoped=True) == 6
+            UserDao.delete(ctx=ctx, where_dict={'id': 1})
+            # 软删除之后按 deleted_at IS NULL 修改 不能合并到删除里
+            UserDao.update(ctx=ctx, where_dict={'id': 1}, data={'note': 'deleted'})
+        # 删除之后重新插入 新插入的行不能被删除
+        with easyapi.get_tx(db, unit_of_work=True) as conn:
+            ctx = easyapi.EasyApiContext(conn)
+            ShareDao.delete(ctx=ctx, where_dict={'username': 'test1'})
+            ShareDao.insert(ctx=ctx, data={'username': 'test1', 'note': 'new'})
+        assert [s['note'] for s in ShareDao.query()] == ['new']
+        # 同一行中间夹着另一个条件的修改 后面的修改不能合并到前面
+        share_id = ShareDao.query()[0]['id']
+        with easyapi.get_tx(db, unit_of_work=True) as conn:
+            ctx = easyapi.EasyApiContext(conn)
+            ShareDao.update(ctx=ctx, where_dict={'id': share_id}, data={'note': 'a'})
+            ShareDao.update(ctx=ctx, where_dict={'id': share_id, 'username': 'test1'}, data={'note': 'b'})
+            ShareDao.update(ctx=ctx, where_dict={'id': share_id}, data={'note': 'c'})
+        assert ShareDao.get(query={'id': share_id})['note'] == 'c'
+        with pytest.raises(RuntimeError):
+            with easyapi.get_tx(db, unit_of_work=True) as conn:
+                UserDao.insert(ctx=easyapi.EasyApiContext(conn), data={'name': 'rollback'})
+                raise RuntimeError()
+        users = UserDao.query()
+        assert [u['name'] for u in users] == ['test2', 'new0', 'new1', 'new2']
+        assert (users[0]['note'], users[0]['updated_by']) == ('note2', 'test')
+        assert UserDao.get(query={'id': 1}, unscoped=True)['note'] == 'note1'
+    finally:
+        db.close()
+
+
+def test_retry_tx(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(32) NOT NULL DEFAULT '')")
+    conn.close()
+    db = easyapi.SqliteDB(path, pragmas={'busy_timeout': 0})
+    db.connect()
+
+    class UserDao(easyapi.BaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    # 另一个连接拿着写锁 一段时间后释放
+    holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    holder.execute('BEGIN IMMEDIATE')
+    timer = threading.Timer(0.1, holder.execute, args=('COMMIT',))
+    timer.start()
+
+    @easyapi.retry_tx(db, easyapi.RetryPolicy(attempts=20, base_delay=0.02, max_delay=0.05))
+    def insert(tx, name):
+        return UserDao.insert(ctx=easyapi.EasyApiContext(tx), data={'name': name})
+
+    @easyapi.retry_tx(db)
+    def fail(tx):
+        raise ValueError()
+
+    try:
+        assert insert('test1') == 1
+        stats = db.retry_stats()
+        assert stats['transactions'] == 1 and stats['recovered'] == 1 and stats['retries']['busy'] >= 1
+        with pytest.raises(ValueError):
+            fail()
+        assert db.retry_stats()['retries'] == stats['retries']
+    finally:
+        timer.join()
+        holder.close()
+        db.close()
+
+
+def test_lazy_read_only_transaction(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(32) NOT NULL DEFAULT '')")
+    conn.close()
+    db = easyapi.SqliteDB(path, pragmas={'busy_timeout': 0})
+    db.connect()
+
+    class UserDao(easyapi.BaseDao):
+        __tablename__ = 'users'
+        __db__ = db
+
+    pool = db._engine.pool
+    try:
+        checked_out = pool.checkedout()
+        with easyapi.get_tx(db, lazy=True) as tx:
+            assert not tx.acquired and pool.checkedout() == checked_out
+            UserDao.insert(ctx=easyapi.EasyApiContext(tx), data={'name': 'test1'})
+            assert tx.acquired and pool.checkedout() == checked_out + 1
+        assert pool.checkedout() == checked_out
+        with easyapi.get_tx(db, lazy=True, unit_of_work=True) as tx:
+            UserDao.insert(ctx=easyapi.EasyApiContext(tx), data={'name': 'test2'})
+            assert not tx.acquired
+        assert UserDao.count() == 2
+
+        # 只读事务不等待写锁
+        holder = sqlite3.connect(path, isolation_level=None)
+        holder.execute('BEGIN IMMEDIATE')
+        try:
+            with easyapi.get_tx(db, read_only=True) as tx:
+                assert UserDao.count(ctx=easyapi.EasyApiContext(tx)) == 2
+        finally:
+            holder.execute('COMMIT')
+            holder.close()
+    finally:
+        db.close()